@@ -1,25 +1,33 @@
 # app.py — fixed navigation, working buttons, and improved stability
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 import pandas as pd
 import streamlit as st
 from streamlit_autorefresh import st_autorefresh
-import altair as alt
-import plotly.express as px
 import os
-import numpy as np
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
+import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+# plotly is imported inside the functions that draw charts: it is the
+# heaviest import in the app and most reruns never draw a chart.
 
 # Local modules
-from devices import load_devices, save_devices
+from devices import load_devices, save_devices, get_device, device_ids, device_groups, search_devices, apply_device_edits
 from get_power_data import fetch_and_log_once
-from tuya_api import control_device, get_token
-from tuya_api_mongo import latest_docs, range_docs
-from billing import daily_monthly_for, _latest_power_voltage
-from helpers import go_home as _go_home
-from billing import aggregate_timeseries_24h, aggregate_totals_all_devices
+from tuya_api import get_client, account_of, accounts
+from tuya_api_mongo import latest_docs, range_docs, latest_states
+from billing import daily_monthly_for, _latest_power_voltage, _tier_cost
+from billing import aggregate_timeseries_24h, aggregate_instant, energy_by_device, energy_totals
+import profiler
+from profiler import span
+from live import LiveDeviceView
+from helpers import dhaka_tz
+from export import RESOLUTIONS, export_readings, local_day_range
+import bulk_control
+import load_profile
+import projection
 
 
 # ------------------------------------------------------------------------------------
@@ -103,6 +111,7 @@ def go_home(): set_route("home")
 def go_mydevices(): set_route("mydevices")
 def go_add(): set_route("add")
 def go_manage(): set_route("manage")
+def go_control(): set_route("control")
 
 def go_device_detail(device_id: str, device_name: str):
     st.session_state.current_device_id = device_id
@@ -110,56 +119,142 @@ def go_device_detail(device_id: str, device_name: str):
     set_route("device")
 
 def get_device_by_id(device_id: str):
-    for d in (load_devices() or []):
-        if d.get("id") == device_id:
-            return d
-    return None
+    return get_device(device_id)
 
 
 # ------------------------------------------------------------------------------------
-# Pages
-
-def page_home():
-    st.title("📊 Smart Enegry Monitoring System Dashboard")
-    st.caption("At-a-glance overview of your smart energy setup.")
-
-    devices = load_devices() or []
-    try:
-        total_power_now, present_voltage, today_kwh, today_bill_bdt, month_kwh, month_bill_bdt = \
-            aggregate_totals_all_devices(devices)
-    except Exception as e:
-        st.error(f"Aggregation error: {e}")
-        total_power_now = present_voltage = today_kwh = today_bill_bdt = month_kwh = month_bill_bdt = 0
+# Live device section. Two Streamlit fragments re-run on their own timers:
+# - tiles + short chart every RING_REFRESH_SECONDS from the collector's
+#   shared-memory ring buffer (no database traffic), when the device is in it
+# - bill totals every LIVE_REFRESH_SECONDS, pulling only readings newer than
+#   what is already shown (and the tiles/chart too when there is no ring)
+# The ring file outlives the collector, so a sample older than
+# RING_STALE_PERIODS collector cycles (the period the collector publishes in
+# the ring header) is ignored and the page falls back to the reading it just
+# fetched and the Mongo live section. It switches back only once a sample is
+# within RING_FRESH_PERIODS again, so a device at the edge does not flap.
+LIVE_REFRESH_SECONDS = 10
+RING_REFRESH_SECONDS = 1
+LIVE_WINDOW_SECONDS = 3600
+RING_STALE_PERIODS = 2.5
+RING_FRESH_PERIODS = 1.5
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+HAS_FRAGMENTS = _fragment is not None
+
+def _live_fragment(run_every):
+    def wrap(fn):
+        return _fragment(run_every=run_every)(fn) if HAS_FRAGMENTS else fn
+    return wrap
+
+@st.cache_resource(ttl=60)
+def get_ring_reader():
+    from ringbuf import open_reader
+    return open_reader()
+
+def get_live_view(dev_id: str) -> LiveDeviceView:
+    views = st.session_state.setdefault("live_views", {})
+    view = views.get(dev_id)
+    if view is None:
+        # Full day/month scan once per device per session; deltas after that
+        with span("billing:daily_monthly_for"):
+            d_units, _, m_units, _ = daily_monthly_for(dev_id)
+        view = views[dev_id] = LiveDeviceView(dev_id, d_units, m_units)
+    return view
+
+def _live_tiles(row: dict):
+    m1, m2, m3 = st.columns(3)
+    m1.metric("🔋 Voltage (V)", f"{float(row.get('voltage') or 0.0):.1f}")
+    m2.metric("⚡ Power (W)", f"{float(row.get('power') or 0.0):.1f}")
+    m3.metric("🔌 Current (A)", f"{float(row.get('current') or 0.0):.3f}")
 
-    c1, c2, c3, c4, c5 = st.columns(5)
-    c1.metric("Devices", len(devices))
-    c2.metric("Total Power (now)", f"{total_power_now:.1f} W")
-    c3.metric("Present Voltage (max)", f"{present_voltage:.1f} V")
-    c4.metric("Today’s Bill (BDT)", f"{today_bill_bdt:.2f}")
-    c5.metric("Monthly Bill (BDT)", f"{month_bill_bdt:.2f}")
+def _live_chart(df: pd.DataFrame):
+    if df.empty:
+        return
+    import plotly.express as px
+    fig = px.line(df, x="timestamp", y="power", title="Power — last hour (live)")
+    fig.update_layout(hovermode="x unified", xaxis_title="Time", yaxis_title="Power (W)",
+                      template="plotly_white", height=300, margin=dict(t=40, b=30))
+    fig.update_yaxes(rangemode="tozero")
+    st.plotly_chart(fig, use_container_width=True)
 
-    st.markdown("---")
-    st.subheader("Device Management")
-    a1, a2, a3, a4 = st.columns(4)
-    if a1.button("📂 My Devices"): go_mydevices(); st.rerun()
-    if a2.button("➕ Add Device"): go_add(); st.rerun()
-    if a3.button("⚙️ Manage Devices"): go_manage(); st.rerun()
-    if a4.button("📘 User Manual"):
-        set_route("manual")
+def fresh_ring_sample(dev_id: str):
+    """(ring reader, newest sample) while the collector keeps publishing
+    the device, else (None, None)."""
+    ring = get_ring_reader()
+    row = ring.latest(dev_id) if ring is not None else None
+    stale = st.session_state.setdefault("ring_stale", {})
+    if row is None:
+        stale[dev_id] = True
+        return None, None
+    periods = RING_FRESH_PERIODS if stale.get(dev_id) else RING_STALE_PERIODS
+    stale[dev_id] = time.time() - row["ts"] > periods * ring.period
+    if stale[dev_id]:
+        return None, None
+    return ring, row
+
+@_live_fragment(RING_REFRESH_SECONDS)
+def render_ring_tiles(dev_id: str):
+    ring, row = fresh_ring_sample(dev_id)
+    if row is None:
+        # collector stopped publishing: rerun the page on the Mongo live section
         st.rerun()
+    _live_tiles(row)
+    st.caption(f"Sample from {max(0.0, time.time() - row['ts']):.0f}s ago (collector ring buffer)")
+    win = ring.window(dev_id, LIVE_WINDOW_SECONDS)
+    df = pd.DataFrame({
+        "timestamp": pd.to_datetime(win[:, 0], unit="s", utc=True).tz_convert("Asia/Dhaka"),
+        "power": win[:, 3],
+    })
+    _live_chart(df)
+
+@_live_fragment(LIVE_REFRESH_SECONDS)
+def render_live_section(dev_id: str, fallback_row: dict, with_tiles: bool = True):
+    view = get_live_view(dev_id)
+    with span("mongo:readings_since"):
+        view.poll()
+    if with_tiles:
+        _live_tiles(view.latest or fallback_row)
+
+    st.markdown("### 💰 Bill Estimate")
+    d_units, d_cost, m_units, m_cost = view.bill()
+    b1, b2 = st.columns(2)
+    b1.metric("📅 Today kWh", f"{d_units:.3f}")
+    b1.metric("💸 Today BDT", f"{d_cost:.2f}")
+    b2.metric("🗓 Month kWh", f"{m_units:.3f}")
+    b2.metric("💰 Month BDT", f"{m_cost:.2f}")
+    _projection_row(projection.project_device(dev_id, today_kwh=d_units))
+
+    if with_tiles:
+        _live_chart(view.frame())
+    st.caption(f"Live: {view.last_new} new reading(s) at {datetime.now().strftime('%H:%M:%S')}")
+
+def _projection_row(proj: dict, slots=None):
+    """Month-end forecast with its 80% band."""
+    p1, p2 = slots or st.columns(2)
+    if proj["expected_kwh"] is None:
+        p1.metric("🔮 Month-end kWh (forecast)", "—", help="Insufficient history: no closed day yet")
+        p2.metric("🔮 Month-end BDT (forecast)", "—", help="Insufficient history: no closed day yet")
+        return
+    p1.metric("🔮 Month-end kWh (forecast)", f"{proj['expected_kwh']:.2f}",
+              help=f"80% range {proj['low_kwh']:.2f} – {proj['high_kwh']:.2f} kWh, "
+                   f"from {proj['history_days']} day(s) of history")
+    p2.metric("🔮 Month-end BDT (forecast)", f"{proj['expected_bdt']:.2f}",
+              help=f"80% range {proj['low_bdt']:.2f} – {proj['high_bdt']:.2f} BDT")
+
+def render_live(dev_id: str, fallback_row: dict):
+    if fresh_ring_sample(dev_id)[1] is not None:
+        render_ring_tiles(dev_id)
+        render_live_section(dev_id, fallback_row, with_tiles=False)
+    else:
+        render_live_section(dev_id, fallback_row)
 
-    st.markdown("---")
-    st.subheader("Last 24h — Power & Voltage (All Devices)")
 
-    ts = pd.DataFrame()
-    try:
-        ts = aggregate_timeseries_24h(devices, resample_rule="5T")
-    except Exception as e:
-        st.error(f"Timeseries aggregation failed: {e}")
+# ------------------------------------------------------------------------------------
+# Pages
 
-    if ts.empty:
-        st.info("No data available for the last 24 hours.")
-        st.stop()
+def build_24h_figure(ts: pd.DataFrame):
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
 
     # Create figure with secondary y-axis
     fig = make_subplots(specs=[[{"secondary_y": True}]])
@@ -251,28 +346,176 @@ def page_home():
 
     # Clean hover format
     fig.update_traces(hovertemplate="%{y:.2f}<extra></extra>")
+    return fig
 
-    # Render in Streamlit
-    st.plotly_chart(fig, use_container_width=True)
+
+# ------------------------------------------------------------------------------------
+# Home page sections are fetched concurrently on a small shared pool. Each
+# section gets HOME_SECTION_TIMEOUT seconds; a slower one shows a
+# placeholder and its result is picked up on the next rerun instead of
+# being queried again. Results are reused for HOME_RESULT_TTL seconds.
+HOME_WORKERS = 4
+HOME_SECTION_TIMEOUT = float(os.getenv("HOME_SECTION_TIMEOUT", "8"))
+HOME_RESULT_TTL = LIVE_REFRESH_SECONDS
+
+@st.cache_resource
+def get_home_jobs():
+    return {"pool": ThreadPoolExecutor(max_workers=HOME_WORKERS, thread_name_prefix="home"),
+            "jobs": {}, "lock": threading.Lock()}
+
+def home_job(name: str, fn, *args):
+    """Future for section `name`: an in-flight or fresh one if there is
+    one, else a new submission."""
+    h = get_home_jobs()
+    with h["lock"]:
+        job = h["jobs"].get(name)
+        if job and job["args"] == args and (not job["future"].done()
+                                            or time.monotonic() - job["started"] < HOME_RESULT_TTL):
+            return job["future"]
+        fut = h["pool"].submit(profiler.bind(fn), *args)
+        h["jobs"][name] = {"future": fut, "started": time.monotonic(), "args": args}
+        return fut
+
+
+def fleet_projection(devices: tuple, energy_job):
+    """Fleet projection reusing today's per-device kWh of the energy job."""
+    return projection.project_fleet(devices, today_kwh={d: t for d, (t, _) in energy_job.result().items()})
+
+
+def page_home():
+    st.title("📊 Smart Enegry Monitoring System Dashboard")
+    st.caption("At-a-glance overview of your smart energy setup.")
+
+    devices = tuple(device_ids())
+    started = time.monotonic()
+    jobs = {
+        "instant": home_job("instant", aggregate_instant, devices),
+        "energy": home_job("energy", energy_by_device, devices),
+        "timeseries": home_job("timeseries", aggregate_timeseries_24h, devices, "5T"),
+    }
+    # queued after the energy job, whose per-device totals it reuses
+    jobs["projection"] = home_job("projection", fleet_projection, devices, jobs["energy"])
+
+    c1, c2, c3, c4, c5 = st.columns(5)
+    c1.metric("Devices", len(devices))
+    slots = {"instant": (c2.empty(), c3.empty()), "energy": (c4.empty(), c5.empty())}
+    f1, f2, _, _, _ = st.columns(5)
+    slots["projection"] = (f1.empty(), f2.empty())
+    for a, b in slots.values():
+        a.caption("⏳ loading…"); b.caption("")
+
+    st.markdown("---")
+    st.subheader("Device Management")
+    a1, a2, a3, a4, a5 = st.columns(5)
+    if a1.button("📂 My Devices"): go_mydevices(); st.rerun()
+    if a2.button("➕ Add Device"): go_add(); st.rerun()
+    if a3.button("⚙️ Manage Devices"): go_manage(); st.rerun()
+    if a4.button("🎛️ Bulk Control"): go_control(); st.rerun()
+    if a5.button("📘 User Manual"):
+        set_route("manual")
+        st.rerun()
+
+    st.markdown("---")
+    st.subheader("Last 24h — Power & Voltage (All Devices)")
+    chart = st.empty()
+    chart.caption("⏳ loading…")
+
+    def render(name, fut):
+        try:
+            result = fut.result(timeout=0)
+        except Exception as e:
+            target = chart if name == "timeseries" else slots[name][0]
+            target.error(f"{'Timeseries' if name == 'timeseries' else 'Aggregation'} failed: {e}")
+            return
+        if name == "instant":
+            total_power_now, present_voltage = result
+            slots[name][0].metric("Total Power (now)", f"{total_power_now:.1f} W")
+            slots[name][1].metric("Present Voltage (max)", f"{present_voltage:.1f} V")
+        elif name == "energy":
+            _, today_bill_bdt, _, month_bill_bdt = energy_totals(result)
+            slots[name][0].metric("Today’s Bill (BDT)", f"{today_bill_bdt:.2f}")
+            slots[name][1].metric("Monthly Bill (BDT)", f"{month_bill_bdt:.2f}")
+        elif name == "projection":
+            _projection_row(result["fleet"], slots[name])
+        elif result.empty:
+            chart.info("No data available for the last 24 hours.")
+        else:
+            with span("plotly:build_24h_figure"):
+                fig = build_24h_figure(result)
+            with span("streamlit:plotly_chart"):
+                chart.plotly_chart(fig, use_container_width=True)
+
+    # fill each section as soon as its data arrives
+    by_future = {f: n for n, f in jobs.items()}
+    with span("home:wait_sections"):
+        try:
+            remaining = max(0.0, HOME_SECTION_TIMEOUT - (time.monotonic() - started))
+            for fut in as_completed(by_future, timeout=remaining):
+                render(by_future.pop(fut), fut)
+        except FuturesTimeout:
+            pass
+    for name in by_future.values():
+        msg = f"⏳ still loading after {HOME_SECTION_TIMEOUT:.0f}s — refresh to update"
+        (chart if name == "timeseries" else slots[name][0]).caption(msg)
+
+
+DEVICE_PAGE_SIZES = [12, 24, 48, 96]
+ONLINE_WITHIN_SECONDS = 60
+
+
+@st.cache_data(ttl=LIVE_REFRESH_SECONDS, show_spinner=False)
+def get_latest_states(device_ids: tuple) -> dict:
+    return latest_states(list(device_ids))
+
+
+def device_search(prefix: str):
+    """Search box, group filter and pager; returns (devices on this page, total matches)."""
+    c1, c2, c3 = st.columns([4, 2, 1])
+    query = c1.text_input("Search", placeholder="name, ID or group", key=f"{prefix}_q")
+    groups = device_groups()
+    group = c2.selectbox("Group", ["All groups"] + groups, key=f"{prefix}_group") if groups else "All groups"
+    size = c3.selectbox("Per page", DEVICE_PAGE_SIZES, index=1, key=f"{prefix}_size")
+    _, total = search_devices(query, None if group == "All groups" else group, 1, 0)
+    pages = max(1, -(-total // size))
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, key=f"{prefix}_page")
+    items, total = search_devices(query, None if group == "All groups" else group, int(page), size)
+    st.caption(f"{total} device(s) match")
+    return items, total
+
+
+def _status_line(state):
+    if not state:
+        return "⚪ no data yet"
+    ts = state["timestamp"]
+    ts = ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+    age = (datetime.now(timezone.utc) - ts).total_seconds()
+    dot = "🟢" if age <= ONLINE_WITHIN_SECONDS else "🔴"
+    when = f"{age:.0f}s ago" if age < 120 else ts.astimezone(dhaka_tz).strftime("%d %b %H:%M")
+    return f"{dot} {float(state.get('power') or 0):.1f} W · {float(state.get('voltage') or 0):.0f} V · {when}"
 
 
 def page_mydevices():
     st.title("⚡ My Devices")
     st.caption("Browse and open a device to view live data.")
 
-    devices = load_devices() or []
-    if not devices:
+    if not device_ids():
         st.info("No devices added yet. Click **Add Device** to get started.")
         if st.button("➕ Add Device"):
             go_add(); st.rerun()
         return
 
+    items, _ = device_search("my")
+    with span("mongo:latest_states"):
+        states = get_latest_states(tuple(d["id"] for d in items))
     cols = st.columns(3)
-    for i, d in enumerate(devices):
+    for i, d in enumerate(items):
         with cols[i % 3]:
             st.markdown(f"#### 🔌 {d['name']}")
-            st.markdown(f"**Device ID:** `{d['id']}`")
-            if st.button(f"View Details ({d['name']})", key=f"view_{i}"):
+            st.markdown(f"**Device ID:** `{d['id']}`" + (f" · {d['group']}" if d.get("group") else ""))
+            st.caption(_status_line(states.get(d["id"])))
+            if st.button(f"View Details ({d['name']})", key=f"view_{d['id']}"):
                 go_device_detail(d["id"], d["name"])
                 st.rerun()
             st.markdown("---")
@@ -282,6 +525,8 @@ def page_add():
     st.header("➕ Add Device")
     name = st.text_input("Device Name")
     dev_id = st.text_input("Device ID")
+    group = st.text_input("Group (optional)", help="e.g. Building A; used by Bulk Control")
+    account = st.selectbox("Tuya account", accounts()) if len(accounts()) > 1 else None
     c1, c2 = st.columns([1,1])
     if c1.button("Save"):
         if name and dev_id:
@@ -289,7 +534,8 @@ def page_add():
             if any(d.get("id") == dev_id for d in devs):
                 st.warning("Device ID already exists.")
             else:
-                devs.append({"name": name, "id": dev_id})
+                devs.append({"name": name, "id": dev_id, **({"group": group} if group else {}),
+                             **({"account": account} if account and account != accounts()[0] else {})})
                 save_devices(devs)
                 st.success("Device added.")
                 go_home(); st.rerun()
@@ -301,32 +547,56 @@ def page_add():
 
 def page_manage():
     st.header("⚙️ Manage Devices")
-    devs = load_devices() or []
-    if not devs:
+    if not device_ids():
         st.info("No devices to manage.")
         return
 
-    for i, d in enumerate(devs):
-        c1, c2, c3 = st.columns([3, 3, 2])
-        new_name = c1.text_input("Name", value=d["name"], key=f"nm_{i}")
-        new_id = c2.text_input("ID", value=d["id"], key=f"id_{i}")
-        save_clicked = c3.button("Save", key=f"sv_{i}")
-        del_clicked = c3.button("Delete", key=f"dl_{i}")
-        open_clicked = c3.button("Open", key=f"open_{i}")
-
-        if save_clicked:
-            devs[i] = {"name": new_name, "id": new_id}
-            save_devices(devs)
-            st.success("Saved."); st.rerun()
-
-        if del_clicked:
-            devs.pop(i)
-            save_devices(devs)
-            st.warning("Deleted."); st.rerun()
-
-        if open_clicked:
-            go_device_detail(d["id"], d["name"])
+    items, _ = device_search("mg")
+    if not items:
+        return
+    multi_account = len(accounts()) > 1
+    cols = ["name", "id", "group", "critical"] + (["account"] if multi_account else [])
+    before = pd.DataFrame([{c: d.get(c, False if c == "critical" else "") for c in cols} for d in items])
+    if multi_account:
+        before["account"] = [account_of(d) for d in items]
+    before["delete"] = False
+
+    with st.form("manage_devices"):
+        st.caption("Edit cells, tick rows to delete, then save all changes at once.")
+        after = st.data_editor(before, hide_index=True, num_rows="fixed", use_container_width=True,
+                               disabled=False, key="manage_editor",
+                               column_config={"account": st.column_config.SelectboxColumn(
+                                   "account", options=accounts(), required=True)})
+        submitted = st.form_submit_button("💾 Save changes")
+
+    if submitted:
+        all_ids = set(device_ids())
+        updates, deletes, problems = {}, [], []
+        for (_, old), (_, new) in zip(before.iterrows(), after.iterrows()):
+            if new["delete"]:
+                deletes.append(old["id"])
+                continue
+            changes = {c: new[c] for c in cols if new[c] != old[c]}
+            if "id" in changes and (not new["id"] or new["id"] in all_ids):
+                problems.append(f"ID '{new['id']}' is empty or already used")
+                continue
+            if not new["name"]:
+                problems.append(f"Device {old['id']} needs a name")
+                continue
+            if "critical" in changes:
+                changes["critical"] = bool(new["critical"]) or None
+            if changes.get("account") == accounts()[0]:
+                changes["account"] = None  # the default account is implied
+            if changes:
+                updates[old["id"]] = changes
+        if problems:
+            st.error("; ".join(problems))
+        elif updates or deletes:
+            n_upd, n_del = apply_device_edits(updates, deletes)
+            st.success(f"Saved: {n_upd} updated, {n_del} deleted.")
             st.rerun()
+        else:
+            st.info("Nothing changed.")
 
 
 def page_device():
@@ -339,14 +609,18 @@ def page_device():
             go_home(); st.rerun()
         return
 
+    d = get_device_by_id(dev_id)
     if not dev_name:
-        d = get_device_by_id(dev_id)
         dev_name = d["name"] if d else dev_id
+    tuya = get_client(account_of(d))
 
-    st_autorefresh(interval=30000, key=f"data_refresh_{dev_id}")  # 30 sec refresh
+    if not HAS_FRAGMENTS:
+        # Older Streamlit: fall back to re-running the whole page
+        st_autorefresh(interval=30000, key=f"data_refresh_{dev_id}")  # 30 sec refresh
     st.title(f"🔌 {dev_name} — Live")
 
-    result = fetch_and_log_once(dev_id, dev_name)
+    with span("tuya:fetch_and_log_once"):
+        result = fetch_and_log_once(dev_id, dev_name, account=tuya.name)
     if "error" in result:
         st.error(f"Tuya API error: {result['error']}")
         if st.button("⬅️ Back to Home"): go_home(); st.rerun()
@@ -354,33 +628,26 @@ def page_device():
         return
 
     row = result.get("row", {})
-    v = float(row.get("voltage", 0.0))
-    c = float(row.get("current", 0.0))
     p = float(row.get("power", 0.0))
     # Simple status logic: if power > 1 W, assume ON
     is_on = p > 1.0
     status_text = "🟢 Device is ON" if is_on else "🔴 Device is OFF"
 
-    m1, m2, m3 = st.columns(3)
-    m1.metric("🔋 Voltage (V)", f"{v:.1f}")
-    m2.metric("⚡ Power (W)", f"{p:.1f}")
-    m3.metric("🔌 Current (A)", f"{c:.3f}")
+    render_live(dev_id, row)
 
     colA, colB, colC, colD = st.columns([1,1,1,2])
 
     with colA:
         if st.button("Turn ON"):
             try:
-                token = get_token()
-                st.info(control_device(dev_id, token, "switch_1", True))
+                st.info(tuya.control_device(dev_id, tuya.get_token(), "switch_1", True))
             except Exception as e:
                 st.error(e)
 
     with colB:
         if st.button("Turn OFF"):
             try:
-                token = get_token()
-                st.info(control_device(dev_id, token, "switch_1", False))
+                st.info(tuya.control_device(dev_id, tuya.get_token(), "switch_1", False))
             except Exception as e:
                 st.error(e)
 
@@ -393,14 +660,6 @@ def page_device():
             go_home()
             st.rerun()
 
-    st.markdown("### 💰 Bill Estimate")
-    d_units, d_cost, m_units, m_cost = daily_monthly_for(dev_id)
-    b1, b2 = st.columns(2)
-    b1.metric("📅 Today kWh", f"{d_units:.3f}")
-    b1.metric("💸 Today BDT", f"{d_cost:.2f}")
-    b2.metric("🗓 Month kWh", f"{m_units:.3f}")
-    b2.metric("💰 Month BDT", f"{m_cost:.2f}")
-
     st.markdown("### 🕰️ Historical Data")
     c1, c2, c3 = st.columns(3)
     start_date = c1.date_input("Start", value=datetime.now().date() - timedelta(days=1))
@@ -409,32 +668,69 @@ def page_device():
 
     start_dt = datetime.combine(start_date, datetime.min.time())
     end_dt = datetime.combine(end_date, datetime.max.time())
-    df = range_docs(dev_id, start_dt, end_dt)
+    with span("mongo:range_docs"):
+        df = range_docs(dev_id, start_dt, end_dt)
 
     if df is not None and not df.empty:
-        df = df.sort_values("timestamp").set_index("timestamp")
-        if agg != "raw":
-            rule = {"1-min": "1T", "5-min": "5T", "15-min": "15T"}[agg]
-            df = df.resample(rule).mean(numeric_only=True).dropna()
-
-        plot_df = df.reset_index()
-        fig = px.line(plot_df, x="timestamp", y="power", title=f"Power over time ({agg})", markers=(agg == "raw"))
-        fig.update_layout(hovermode="x unified", xaxis_title="Time", yaxis_title="Power (W)", template="plotly_white")
-        fig.update_yaxes(rangemode="tozero")
-        fig.update_xaxes(
-            rangeslider=dict(visible=True),
-            rangeselector=dict(buttons=[
-                dict(count=6, step="hour", stepmode="backward", label="6h"),
-                dict(count=12, step="hour", stepmode="backward", label="12h"),
-                dict(count=1, step="day", stepmode="backward", label="1d"),
-                dict(step="all", label="All")
-            ])
-        )
-        st.plotly_chart(fig, use_container_width=True)
-        st.dataframe(plot_df.tail(200))
+        with span("pandas:resample"):
+            df = df.sort_values("timestamp").set_index("timestamp")
+            if agg != "raw":
+                rule = {"1-min": "1T", "5-min": "5T", "15-min": "15T"}[agg]
+                df = df.resample(rule).mean(numeric_only=True).dropna()
+            plot_df = df.reset_index()
+
+        with span("plotly:build_history_figure"):
+            import plotly.express as px
+            fig = px.line(plot_df, x="timestamp", y="power", title=f"Power over time ({agg})", markers=(agg == "raw"))
+            fig.update_layout(hovermode="x unified", xaxis_title="Time", yaxis_title="Power (W)", template="plotly_white")
+            fig.update_yaxes(rangemode="tozero")
+            fig.update_xaxes(
+                rangeslider=dict(visible=True),
+                rangeselector=dict(buttons=[
+                    dict(count=6, step="hour", stepmode="backward", label="6h"),
+                    dict(count=12, step="hour", stepmode="backward", label="12h"),
+                    dict(count=1, step="day", stepmode="backward", label="1d"),
+                    dict(step="all", label="All")
+                ])
+            )
+        with span("streamlit:plotly_chart"):
+            st.plotly_chart(fig, use_container_width=True)
+        with span("streamlit:dataframe"):
+            st.dataframe(plot_df.tail(200))
     else:
         st.info("No data in selected range.")
 
+    render_export(dev_id, start_date, end_date)
+
+
+def render_export(dev_id: str, start_date, end_date):
+    """Stream the selected range to a temp file in chunks, then offer it for
+    download. For multi-month fleet exports use `python export.py`."""
+    st.markdown("#### ⬇️ Export")
+    e1, e2, e3 = st.columns(3)
+    fmt = e1.selectbox("Format", ["csv", "parquet"], key="export_fmt")
+    resolution = e2.selectbox("Resolution", list(RESOLUTIONS), key="export_res")
+    if e3.button("Prepare export"):
+        old = st.session_state.pop("export_file", None)
+        if old and os.path.exists(old["path"]):
+            os.remove(old["path"])
+        tmp = tempfile.NamedTemporaryFile(prefix="export-", suffix=f".{fmt}", delete=False)
+        tmp.close()
+        try:
+            with span("export:stream"):
+                n = export_readings([dev_id], *local_day_range(start_date, end_date), tmp.name, fmt, resolution)
+            st.session_state["export_file"] = {"path": tmp.name, "rows": n, "fmt": fmt,
+                                               "name": f"{dev_id}_{start_date}_{end_date}_{resolution}.{fmt}"}
+        except Exception as e:
+            os.remove(tmp.name)
+            st.error(f"Export failed: {e}")
+
+    f = st.session_state.get("export_file")
+    if f and os.path.exists(f["path"]):
+        with open(f["path"], "rb") as fh:
+            st.download_button(f"Download {f['rows']} rows", fh, file_name=f["name"],
+                               mime="text/csv" if f["fmt"] == "csv" else "application/octet-stream")
+
 
 # ------------------------------------------------------------------------------------
 # FULL User Manual (Option C — exact manual text)
@@ -559,33 +855,235 @@ def page_manual():
         st.success("✅ You’re now ready to explore your Smart Energy Monitoring Dashboard with confidence!")
 
 
+def _bulk_results(results):
+    if not results:
+        return
+    ok = sum(r["ok"] for r in results)
+    slowest = max(r["seconds"] for r in results)
+    st.success(f"{ok}/{len(results)} devices succeeded (slowest {slowest:.2f}s).") if ok == len(results) \
+        else st.warning(f"{ok}/{len(results)} devices succeeded (slowest {slowest:.2f}s).")
+    st.dataframe(pd.DataFrame(results)[["name", "device_id", "ok", "seconds"]
+                                       + (["error"] if any(r.get("error") for r in results) else [])])
+
+
+def page_control():
+    st.header("🎛️ Bulk Control")
+    devs = load_devices() or []
+    if not devs:
+        st.info("No devices to control.")
+        return
+    names = {d["id"]: d.get("name") or d["id"] for d in devs}
+
+    t_switch, t_scenes, t_shed = st.tabs(["Switch", "Scenes", "Load shedding"])
+    with t_switch:
+        pick = "(choose devices)"
+        group = st.selectbox("Group", [pick, "all"] + bulk_control.groups(devs))
+        picked = st.multiselect("Devices", list(names), format_func=names.get) if group == pick else []
+        targets = bulk_control.resolve_targets(picked, None if group == pick else group, devs)
+        st.caption(f"{len(targets)} device(s) selected")
+        c1, c2 = st.columns(2)
+        for col, label, on in ((c1, "Switch ON", True), (c2, "Switch OFF", False)):
+            if col.button(label, disabled=not targets):
+                with span("tuya:bulk_switch"):
+                    st.session_state.bulk_results = bulk_control.switch(targets, on, source="ui")
+
+    with t_scenes:
+        scenes = bulk_control.load_scenes()
+        if not scenes:
+            st.info("No scenes yet. Add one below.")
+        for s in scenes:
+            c1, c2, c3 = st.columns([4, 1, 1])
+            c1.markdown(f"**{s['name']}** — {len(s.get('actions', []))} action(s)")
+            if c2.button("Run", key=f"scene_{s['name']}"):
+                with span("tuya:run_scene"):
+                    st.session_state.bulk_results = bulk_control.run_scene(s["name"])
+            if c3.button("Delete", key=f"scene_del_{s['name']}"):
+                bulk_control.delete_scene(s["name"])
+                st.rerun()
+
+        with st.expander("➕ New scene / add an action"):
+            with st.form("scene_form", clear_on_submit=True):
+                name = st.text_input("Scene name", help="An existing name adds the action to that scene")
+                pick = "(choose devices)"
+                group = st.selectbox("Group", [pick, "all"] + bulk_control.groups(devs), key="scene_group")
+                picked = st.multiselect("Devices", list(names), format_func=names.get, key="scene_devices")
+                on = st.radio("Switch", ["ON", "OFF"], horizontal=True) == "ON"
+                if st.form_submit_button("Save scene"):
+                    action = {"command": bulk_control.SWITCH_CODE, "value": on}
+                    if group != pick:
+                        action["group"] = group
+                    elif picked:
+                        action["devices"] = picked
+                    if not name.strip() or len(action) == 2:
+                        st.error("Give the scene a name and pick a group or devices.")
+                    else:
+                        name = name.strip()
+                        actions = next((s.get("actions", []) for s in scenes if s["name"] == name), [])
+                        if action not in actions:  # saving the same action twice is a no-op
+                            bulk_control.set_scene(name, actions + [action])
+                        st.rerun()
+
+    with t_shed:
+        group = st.selectbox("Devices", ["all"] + bulk_control.groups(devs), key="shed_group")
+        limit_w = st.number_input("Power limit (W)", min_value=0.0, value=5000.0, step=100.0)
+        dry_run = st.checkbox("Dry run (only show what would be switched off)", value=True)
+        if st.button("Shed load"):
+            with span("tuya:shed_load"):
+                out = bulk_control.shed_load(limit_w, bulk_control.resolve_targets(group=group, devices=devs),
+                                             dry_run=dry_run)
+            st.info(f"Now {out['total_w']:.0f} W; switching off {len(out['plan'])} device(s) "
+                    f"brings it to ~{out['expected_w']:.0f} W.")
+            if out["plan"]:
+                st.write(", ".join(names.get(d, d) for d in out["plan"]))
+            st.session_state.bulk_results = out["results"]
+
+    _bulk_results(st.session_state.get("bulk_results"))
+
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_load_profile(device_id, days: int):
+    return load_profile.profile_matrix(device_id), load_profile.daily_calendar(device_id, days)
+
+
+def page_profiles():
+    import plotly.graph_objects as go
+    st.header("🗓️ Load Profiles")
+    st.caption("Hour-of-week power and daily energy, maintained by the collector as readings arrive.")
+
+    fleet = "All devices (fleet)"
+    c1, c2, c3 = st.columns([3, 1, 1])
+    items, _ = search_devices(c1.text_input("Find device", key="lp_q"), page_size=200)
+    options = [fleet] + [d["id"] for d in items]
+    names = {d["id"]: d.get("name") or d["id"] for d in items}
+    choice = c1.selectbox("Device", options, format_func=lambda x: names.get(x, x))
+    stat = c2.radio("Power", ["mean", "p95"], horizontal=True)
+    days = c3.selectbox("Days", [31, 92, 183, 365], index=1)
+
+    with span("mongo:load_profile"):
+        matrix, calendar = get_load_profile(None if choice == fleet else choice, days)
+
+    if not any(matrix["n"]):
+        st.info("No profile recorded yet. The collector builds it from new readings; "
+                "run `python load_profile.py rebuild --all` to include history.")
+        return
+
+    vals = [matrix[stat][d * 24:(d + 1) * 24] for d in range(7)]
+    fig = go.Figure(go.Heatmap(z=vals, x=[f"{h:02d}:00" for h in range(24)], y=WEEKDAYS,
+                               colorscale="YlOrRd", colorbar=dict(title="W"),
+                               hovertemplate="%{y} %{x}: %{z:.1f} W<extra></extra>"))
+    fig.update_yaxes(autorange="reversed")
+    fig.update_layout(title=f"{stat} power by hour of week", template="plotly_white",
+                      height=330, margin=dict(l=40, r=20, t=50, b=30))
+    st.plotly_chart(fig, use_container_width=True)
+
+    # calendar: one column per week, Monday on top
+    dates = [datetime.fromisoformat(k).date() for k in calendar]
+    first = dates[0] - timedelta(days=dates[0].weekday())
+    n_weeks = (dates[-1] - first).days // 7 + 1
+    z = [[None] * n_weeks for _ in range(7)]
+    text = [[""] * n_weeks for _ in range(7)]
+    for d, kwh in zip(dates, calendar.values()):
+        w = (d - first).days // 7
+        z[d.weekday()][w] = kwh
+        text[d.weekday()][w] = d.isoformat()
+    cal = go.Figure(go.Heatmap(z=z, text=text, y=WEEKDAYS, x=[(first + timedelta(weeks=w)).strftime("%d %b")
+                                                             for w in range(n_weeks)],
+                               colorscale="Greens", colorbar=dict(title="kWh"), xgap=2, ygap=2,
+                               hovertemplate="%{text}: %{z:.3f} kWh<extra></extra>"))
+    cal.update_yaxes(autorange="reversed")
+    cal.update_layout(title="Daily energy (kWh)", template="plotly_white",
+                      height=280, margin=dict(l=40, r=20, t=50, b=30))
+    st.plotly_chart(cal, use_container_width=True)
+    total = sum(calendar.values())
+    st.caption(f"{total:.2f} kWh over {days} days · {_tier_cost(total / max(1, days / 30)):.2f} BDT per 30 days at this rate")
+
+
+# ------------------------------------------------------------------------------------
+# Render profiler (opt-in from the sidebar or DASHBOARD_PROFILE=1)
+def render_profile_panel(prof):
+    import plotly.graph_objects as go
+    data = prof.as_dict()
+    st.markdown("---")
+    st.subheader(f"⏱ Render profile — {data['total_ms']:.0f} ms")
+    if not data["spans"]:
+        st.caption("No spans recorded.")
+        return
+
+    spans = pd.DataFrame(data["spans"])
+    for col in ("tuya_calls", "tuya_bytes", "mongo_calls", "mongo_bytes"):
+        if col not in spans.columns:
+            spans[col] = 0
+    spans[["tuya_calls", "tuya_bytes", "mongo_calls", "mongo_bytes"]] = \
+        spans[["tuya_calls", "tuya_bytes", "mongo_calls", "mongo_bytes"]].fillna(0).astype(int)
+    labels = [f"{i:02d} {'  ' * d}{n}" for i, (d, n) in enumerate(zip(spans["depth"], spans["name"]))]
+
+    fig = go.Figure(go.Bar(
+        y=labels, x=spans["duration_ms"], base=spans["start_ms"], orientation="h",
+        marker_color="#6C63FF",
+        customdata=spans[["mongo_calls", "mongo_bytes", "tuya_calls"]],
+        hovertemplate="%{x:.1f} ms<br>mongo: %{customdata[0]} queries, %{customdata[1]} B"
+                      "<br>tuya: %{customdata[2]} calls<extra></extra>",
+    ))
+    fig.update_yaxes(autorange="reversed")
+    fig.update_layout(template="plotly_white", xaxis_title="ms since page start",
+                      height=120 + 28 * len(labels), margin=dict(l=10, r=10, t=10, b=40))
+    st.plotly_chart(fig, use_container_width=True)
+    st.dataframe(spans[["name", "start_ms", "duration_ms", "mongo_calls", "mongo_bytes",
+                        "tuya_calls", "tuya_bytes", "thread"]])
+    st.caption(f"Saved to {profiler.PROFILE_LOG} (rolling).")
+    with st.expander("Recent renders by page"):
+        recent = profiler.summarize(profiler.load_recent())
+        if recent:
+            st.dataframe(pd.DataFrame.from_dict(recent, orient="index"))
+        else:
+            st.caption("No saved profiles yet.")
+
+
 # ------------------------------------------------------------------------------------
 # Sidebar navigation (single source of truth) + Router
-route_to_index = {"home":0, "mydevices":1, "add":2, "manage":3, "manual":4}
+route_to_index = {"home":0, "mydevices":1, "add":2, "manage":3, "control":4, "profiles":5, "manual":6}
 index = route_to_index.get(st.session_state.route, 0)
 
-nav_choice = st.sidebar.radio("Navigate", ["Home", "My Devices", "Add Device", "Manage Devices", "User Manual"], index=index)
+nav_choice = st.sidebar.radio("Navigate", ["Home", "My Devices", "Add Device", "Manage Devices", "Bulk Control", "Load Profiles", "User Manual"], index=index)
 st.sidebar.markdown("---")
-st.sidebar.caption("Auto-logging every 5s while a device page is open.")
+st.sidebar.caption(f"Live values refresh every {LIVE_REFRESH_SECONDS}s while a device page is open.")
+profile_on = st.sidebar.checkbox("⏱ Profile page render", value=profiler.enabled_by_env())
 
-sidebar_map = {"Home":"home", "My Devices":"mydevices", "Add Device":"add", "Manage Devices":"manage", "User Manual":"manual"}
+sidebar_map = {"Home":"home", "My Devices":"mydevices", "Add Device":"add", "Manage Devices":"manage", "Bulk Control":"control", "Load Profiles":"profiles", "User Manual":"manual"}
 
 # Only change route from sidebar when not on a device detail page
 if st.session_state.route != "device":
     set_route(sidebar_map.get(nav_choice, "home"))
 
 # Router
-if st.session_state.route == "home":
-    page_home()
-elif st.session_state.route == "mydevices":
-    page_mydevices()
-elif st.session_state.route == "add":
-    page_add()
-elif st.session_state.route == "manage":
-    page_manage()
-elif st.session_state.route == "device":
-    page_device()
-elif st.session_state.route == "manual":
-    page_manual()
+def render_route():
+    if st.session_state.route == "home":
+        page_home()
+    elif st.session_state.route == "mydevices":
+        page_mydevices()
+    elif st.session_state.route == "add":
+        page_add()
+    elif st.session_state.route == "manage":
+        page_manage()
+    elif st.session_state.route == "control":
+        page_control()
+    elif st.session_state.route == "profiles":
+        page_profiles()
+    elif st.session_state.route == "device":
+        page_device()
+    elif st.session_state.route == "manual":
+        page_manual()
+    else:
+        page_home()
+
+if profile_on:
+    _prof = profiler.Profile(st.session_state.route)
+    with profiler.activate(_prof):
+        with span(f"page:{st.session_state.route}"):
+            render_route()
+    render_profile_panel(_prof)
+    profiler.save(_prof)
 else:
-    page_home()
+    render_route()
@@ -0,0 +1,338 @@
+"""
+benchmark.py
+------------
+Benchmarks for the storage/billing hot paths on a synthetic fleet.
+
+    # 50 devices x 30 days of 10 s readings into a local mongod, then measure
+    python benchmark.py --uri mongodb://localhost:27017 --devices 50 --days 30 --generate
+
+    # same, in-process (needs `pip install mongomock`, no server required)
+    python benchmark.py --embedded --devices 5 --days 3 --generate
+
+    # keep numbers, and fail (exit 1) when a later run regresses
+    python benchmark.py --uri ... --save-baseline bench_baseline.json
+    python benchmark.py --uri ... --compare bench_baseline.json
+
+For every hot path it reports latency percentiles over --repeat runs, the
+peak Python heap (tracemalloc, from one extra run so tracing does not
+slow the timed ones) and, on a real mongod, the number of Mongo
+commands issued, the documents/bytes returned and the documents the
+server examined (serverStatus queryExecutor.scannedObjects delta).
+mongomock has no command monitoring, so --embedded reports those as n/a.
+
+The benchmark never touches MONGODB_URI from .env: it injects its own
+client into tuya_api_mongo, so point --uri/--db at a throwaway database.
+"""
+
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import tuya_api_mongo
+
+READING_INTERVAL_S = 10
+
+
+# ---------- Command accounting ----------
+class _CommandStats:
+    """pymongo CommandListener counting commands and returned documents.
+    `available` is False when no listener is attached (--embedded)."""
+
+    def __init__(self):
+        self.available = True
+        self.reset()
+
+    def reset(self):
+        self.commands = 0
+        self.docs_returned = 0
+        self.bytes_returned = 0
+
+    def started(self, event):
+        self.commands += 1
+
+    def succeeded(self, event):
+        import bson
+        cursor = event.reply.get("cursor") if isinstance(event.reply, dict) else None
+        if cursor:
+            self.docs_returned += len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+        try:
+            self.bytes_returned += len(bson.encode(event.reply))
+        except Exception:
+            pass
+
+    def failed(self, event):
+        pass
+
+
+def _make_listener(stats):
+    from pymongo import monitoring
+
+    class Listener(monitoring.CommandListener):
+        def started(self, event): stats.started(event)
+        def succeeded(self, event): stats.succeeded(event)
+        def failed(self, event): stats.failed(event)
+
+    return Listener()
+
+
+def connect(uri: str, db_name: str, embedded: bool, stats: _CommandStats):
+    if embedded:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("--embedded needs mongomock (pip install mongomock)")
+        client = mongomock.MongoClient(tz_aware=False)
+        stats.available = False  # mongomock takes no event listeners
+    else:
+        from pymongo import MongoClient
+        client = MongoClient(uri, event_listeners=[_make_listener(stats)])
+    # Route every tuya_api_mongo call to the benchmark database
+    tuya_api_mongo._client = client
+    tuya_api_mongo.MONGODB_DB = db_name
+    return client, client[db_name]
+
+
+def _scanned_objects(db):
+    try:
+        status = db.client.admin.command("serverStatus")
+        return int(status["metrics"]["queryExecutor"]["scannedObjects"])
+    except Exception:
+        return None
+
+
+# ---------- Synthetic fleet ----------
+def device_ids(n: int):
+    return [f"benchdev{i:05d}" for i in range(n)]
+
+def _device_profile(rng: random.Random):
+    """Base load, daily swing and duty cycle of a plausible plug load."""
+    kind = rng.choice(["fridge", "fan", "ac", "tv", "charger", "idle"])
+    base = {"fridge": 90, "fan": 55, "ac": 1100, "tv": 80, "charger": 15, "idle": 0.8}[kind]
+    return {
+        "base": base * rng.uniform(0.7, 1.3),
+        "swing": rng.uniform(0.1, 0.6),
+        "duty": {"fridge": 0.45, "ac": 0.6}.get(kind, 1.0),
+        "period_s": rng.uniform(600, 2400),
+        "phase": rng.uniform(0, 2 * math.pi),
+    }
+
+def synthetic_reading(profile: dict, ts: datetime, rng: random.Random):
+    """(voltage V, current A, power W) at `ts` for a device profile."""
+    from helpers import dhaka_tz
+    secs = ts.timestamp()
+    local = ts.astimezone(dhaka_tz)
+    hour = local.hour + local.minute / 60.0
+    daily = 1.0 + profile["swing"] * math.sin((hour - 14) / 24.0 * 2 * math.pi)
+    on = ((secs / profile["period_s"] + profile["phase"]) % 1.0) < profile["duty"]
+    power = profile["base"] * daily * rng.uniform(0.95, 1.05) if on else profile["base"] * 0.01
+    voltage = 230 + 6 * math.sin(hour / 24.0 * 2 * math.pi) + rng.gauss(0, 1.5)
+    if rng.random() < 0.0005:
+        voltage *= 0.85  # occasional sag
+    current = power / voltage if voltage else 0.0
+    return round(voltage, 1), round(current, 3), round(power, 1)
+
+def synthetic_status(v: float, c: float, p: float) -> dict:
+    """A Tuya status response carrying the given metrics."""
+    return {"success": True, "result": [
+        {"code": "switch_1", "value": True},
+        {"code": "cur_voltage", "value": int(v * 10)},
+        {"code": "cur_current", "value": int(c * 1000)},
+        {"code": "cur_power", "value": int(p)},
+    ]}
+
+def generate_fleet(db, n_devices: int, days: int, seed: int = 407, batch: int = 5000):
+    from helpers import build_doc, parse_metrics
+    from energy import DeviceIntegrator
+    rng = random.Random(seed)
+    end = datetime.now(timezone.utc).replace(microsecond=0)
+    start = end - timedelta(days=days)
+    steps = int((end - start).total_seconds() // READING_INTERVAL_S)
+    total = 0
+    for did in device_ids(n_devices):
+        profile = _device_profile(rng)
+        coll = db[f"readings_{did}"]
+        coll.drop()
+        buf = []
+        integ = DeviceIntegrator()
+        for i in range(steps + 1):
+            ts = start + timedelta(seconds=i * READING_INTERVAL_S)
+            v, c, p, meter = parse_metrics(synthetic_status(*synthetic_reading(profile, ts, rng)))
+            doc = build_doc(did, f"Bench {did}", v, c, p, integ.step(ts.timestamp(), p, meter))
+            doc["timestamp"] = ts
+            buf.append(doc)
+            if len(buf) >= batch:
+                coll.insert_many(buf, ordered=False)
+                total += len(buf)
+                buf = []
+        if buf:
+            coll.insert_many(buf, ordered=False)
+            total += len(buf)
+        tuya_api_mongo.get_collection(did)  # builds the timestamp index
+        print(f"[bench] generated {did}: {steps + 1} readings")
+    return total
+
+
+# ---------- Measurement ----------
+def _percentile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    k = (len(sorted_vals) - 1) * q
+    lo, hi = math.floor(k), math.ceil(k)
+    return sorted_vals[lo] + (sorted_vals[hi] - sorted_vals[lo]) * (k - lo)
+
+def measure(name, fn, repeat, db, stats):
+    latencies = []
+    scanned_before = _scanned_objects(db)
+    stats.reset()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+    commands, docs, nbytes = stats.commands, stats.docs_returned, stats.bytes_returned
+    scanned_after = _scanned_objects(db)
+    # tracing slows allocation-heavy code several-fold: one separate run for memory
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies.sort()
+    scanned = None
+    if scanned_before is not None and scanned_after is not None:
+        scanned = (scanned_after - scanned_before) // repeat
+    return {
+        "name": name,
+        "p50_ms": round(_percentile(latencies, 0.50), 2),
+        "p95_ms": round(_percentile(latencies, 0.95), 2),
+        "p99_ms": round(_percentile(latencies, 0.99), 2),
+        "max_ms": round(latencies[-1], 2),
+        "peak_mem_mb": round(peak / 1e6, 2),
+        "commands": commands // repeat if stats.available else None,
+        "docs_returned": docs // repeat if stats.available else None,
+        "bytes_returned": nbytes // repeat if stats.available else None,
+        "docs_scanned": scanned,
+    }
+
+def collector_throughput(n_readings: int, seed: int = 1):
+    """Readings/s through parse_metrics -> energy -> build_doc -> insert_reading."""
+    from helpers import build_doc, parse_metrics
+    from energy import EnergyIntegrator
+    rng = random.Random(seed)
+    profile = _device_profile(rng)
+    did = "benchingest"
+    tuya_api_mongo.get_collection(did).drop()
+    now = datetime.now(timezone.utc)
+    statuses = [synthetic_status(*synthetic_reading(profile, now, rng)) for _ in range(n_readings)]
+    energy = EnergyIntegrator()
+    t0 = time.perf_counter()
+    for raw in statuses:
+        v, c, p, meter = parse_metrics(raw)
+        doc = build_doc(did, "ingest", v, c, p, 0.0)
+        doc["energy_kWh"] = energy.update(did, doc["timestamp"], p, meter)
+        tuya_api_mongo.insert_reading(did, doc)
+    elapsed = time.perf_counter() - t0
+    return round(n_readings / elapsed, 1) if elapsed else 0.0
+
+
+def hot_paths(devs):
+    import billing
+    one = devs[0]
+    end = datetime.now(timezone.utc).replace(tzinfo=None)
+    return [
+        ("range_docs_24h", lambda: tuya_api_mongo.range_docs(one, end - timedelta(hours=24), end)),
+        ("latest_docs_100", lambda: tuya_api_mongo.latest_docs(one, n=100)),
+        ("daily_monthly_for", lambda: billing.daily_monthly_for(one)),
+        ("aggregate_totals_all_devices", lambda: billing.aggregate_totals_all_devices(devs)),
+        ("aggregate_timeseries_24h", lambda: billing.aggregate_timeseries_24h(devs)),
+    ]
+
+
+# ---------- Baselines ----------
+def compare(results, ingest_rps, baseline, tolerance):
+    """Return human-readable regressions versus a saved baseline."""
+    by_name = {r["name"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        old = by_name.get(r["name"])
+        if not old:
+            continue
+        for key in ("p50_ms", "p95_ms", "peak_mem_mb", "commands", "docs_returned", "docs_scanned"):
+            a, b = old.get(key), r.get(key)  # None: not measured in one of the runs
+            if a and b is not None and b > a * (1 + tolerance):
+                regressions.append(f"{r['name']}.{key}: {a} -> {b} (+{(b / a - 1) * 100:.0f}%)")
+    old_rps = baseline.get("ingest_readings_per_s")
+    if old_rps and ingest_rps < old_rps * (1 - tolerance):
+        regressions.append(f"ingest_readings_per_s: {old_rps} -> {ingest_rps}")
+    return regressions
+
+
+def print_table(results):
+    cols = ["name", "p50_ms", "p95_ms", "p99_ms", "max_ms", "peak_mem_mb",
+            "commands", "docs_returned", "bytes_returned", "docs_scanned"]
+    cell = lambda v: "n/a" if v is None else str(v)
+    widths = [max(len(c), *(len(cell(r[c])) for r in results)) for c in cols]
+    print("  ".join(c.ljust(w) for c, w in zip(cols, widths)))
+    for r in results:
+        print("  ".join(cell(r[c]).ljust(w) for c, w in zip(cols, widths)))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark storage and billing hot paths")
+    ap.add_argument("--uri", default="mongodb://localhost:27017")
+    ap.add_argument("--db", default="tuya_bench")
+    ap.add_argument("--embedded", action="store_true", help="use in-process mongomock instead of a server")
+    ap.add_argument("--devices", type=int, default=10)
+    ap.add_argument("--days", type=int, default=7)
+    ap.add_argument("--generate", action="store_true", help="(re)generate the synthetic fleet first")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--ingest", type=int, default=2000, help="readings for the collector throughput run")
+    ap.add_argument("--save-baseline", metavar="PATH")
+    ap.add_argument("--compare", metavar="PATH")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="allowed regression ratio (0.2 = 20%%)")
+    args = ap.parse_args(argv)
+
+    stats = _CommandStats()
+    client, db = connect(args.uri, args.db, args.embedded, stats)
+
+    if args.generate:
+        t0 = time.perf_counter()
+        n = generate_fleet(db, args.devices, args.days)
+        print(f"[bench] generated {n} readings in {time.perf_counter() - t0:.1f}s\n")
+
+    devs = device_ids(args.devices)
+    results = [measure(name, fn, args.repeat, db, stats) for name, fn in hot_paths(devs)]
+    ingest_rps = collector_throughput(args.ingest)
+
+    print(f"[bench] {args.devices} devices x {args.days} days, {args.repeat} runs each\n")
+    print_table(results)
+    print(f"\ncollector ingest: {ingest_rps} readings/s")
+
+    report = {
+        "devices": args.devices, "days": args.days, "repeat": args.repeat, "embedded": args.embedded,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "results": results, "ingest_readings_per_s": ingest_rps,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"[bench] baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, ingest_rps, baseline, args.tolerance)
+        if regressions:
+            print("\n[bench] REGRESSIONS vs baseline:")
+            for r in regressions:
+                print("  " + r)
+            return 1
+        print("\n[bench] no regressions vs baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,15 @@
+import os
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from tuya_api_mongo import range_docs, latest_docs
+import profiler
+from tuya_api_mongo import range_docs, latest_docs, latest_states, energy_sum
 from datetime import timedelta,timezone
 dhaka_tz = timezone(timedelta(hours=6))
 
+# Per-device queries of one aggregate run on this many threads
+DEVICE_WORKERS = int(os.getenv("BILLING_DEVICE_WORKERS", "8"))
+
 # Bangladesh slab rates (example)
 RATES = [
     (50, 4.63), (75, 5.26), (200, 7.20), (300, 7.59),
@@ -20,35 +26,45 @@ def _tier_cost(units_kwh: float) -> float:
         last_upper = upper
     return round(cost, 2)
 
-def daily_monthly_for(device_id: str):
-    # Current time in Dhaka
-    now = datetime.now(dhaka_tz)
+def _utc_naive(dt: datetime) -> datetime:
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
 
-    # -------- Dhaka "today" → UTC-naive for Mongo --------
+def _today_and_month_bounds():
+    """((day_start, day_end), (month_start, month_end)) of Dhaka's today and
+    this month, as UTC-naive datetimes for Mongo."""
+    now = datetime.now(dhaka_tz)
     day_start_local = datetime(now.year, now.month, now.day, tzinfo=dhaka_tz)
     day_end_local   = day_start_local.replace(
         hour=23, minute=59, second=59, microsecond=999999
     )
-
-    day_start = day_start_local.astimezone(timezone.utc).replace(tzinfo=None)
-    day_end   = day_end_local.astimezone(timezone.utc).replace(tzinfo=None)
-
-    ddf = range_docs(device_id, day_start, day_end)
-    d_units = round(float(ddf["energy_kWh"].sum()) if not ddf.empty else 0.0, 3)
-    d_cost  = _tier_cost(d_units)
-
-    # -------- Dhaka "this month" → UTC-naive for Mongo --------
     m_start_local = datetime(now.year, now.month, 1, tzinfo=dhaka_tz)
     if now.month == 12:
         next_month_local = datetime(now.year + 1, 1, 1, tzinfo=dhaka_tz)
     else:
         next_month_local = datetime(now.year, now.month + 1, 1, tzinfo=dhaka_tz)
+    return ((_utc_naive(day_start_local), _utc_naive(day_end_local)),
+            (_utc_naive(m_start_local), _utc_naive(next_month_local)))
+
+def map_devices(fn, dev_ids, max_workers: int = DEVICE_WORKERS) -> list:
+    """fn(device_id) for every device on a bounded thread pool, in order.
+    Workers join the caller's render profile."""
+    if len(dev_ids) <= 1 or max_workers <= 1:
+        return [fn(did) for did in dev_ids]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(dev_ids)),
+                            thread_name_prefix="billing") as pool:
+        return list(pool.map(profiler.bind(fn), dev_ids))
 
-    m_start = m_start_local.astimezone(timezone.utc).replace(tzinfo=None)
-    m_end   = next_month_local.astimezone(timezone.utc).replace(tzinfo=None)
+def _ids(devices) -> list:
+    return [d["id"] if isinstance(d, dict) else d for d in devices]
 
-    mdf = range_docs(device_id, m_start, m_end)
-    m_units = round(float(mdf["energy_kWh"].sum()) if not mdf.empty else 0.0, 3)
+
+def daily_monthly_for(device_id: str):
+    (day_start, day_end), (m_start, m_end) = _today_and_month_bounds()
+
+    d_units = round(energy_sum(device_id, day_start, day_end), 3)
+    d_cost  = _tier_cost(d_units)
+
+    m_units = round(energy_sum(device_id, m_start, m_end), 3)
     m_cost  = _tier_cost(m_units)
 
     return d_units, d_cost, m_units, m_cost
@@ -65,91 +81,65 @@ def _latest_power_voltage(device_id: str):
     v = float(v) if v is not None else None
     return p, v
 
+def aggregate_instant(devices: list[str | dict]):
+    """(total_power_now_W, present_voltage_max_V). One latest_state query
+    for the fleet; devices missing there fall back to their newest reading."""
+    dev_ids = _ids(devices)
+    states = latest_states(dev_ids)
+    pv = [(float(states[d].get("power") or 0), states[d].get("voltage")) for d in dev_ids if d in states]
+    pv += map_devices(_latest_power_voltage, [d for d in dev_ids if d not in states])
+
+    total_power_now = sum(p for p, _ in pv)
+    latest_voltages = [float(v) for _, v in pv if v is not None]
+    present_voltage = round(max(latest_voltages), 2) if latest_voltages else 0.0
+    return round(total_power_now, 2), present_voltage
+
+def energy_by_device(devices: list[str | dict]) -> dict:
+    """{device_id: (today_kwh, month_kwh)} for Dhaka's today and this
+    month, queried concurrently."""
+    (day_start, day_end), (m_start, m_end) = _today_and_month_bounds()
+    dev_ids = _ids(devices)
+    per_device = map_devices(
+        lambda did: (energy_sum(did, day_start, day_end), energy_sum(did, m_start, m_end)),
+        dev_ids)
+    return dict(zip(dev_ids, per_device))
+
+def energy_totals(per_device: dict):
+    """(today_kwh, today_bill_bdt, month_kwh, month_bill_bdt) of an
+    energy_by_device result."""
+    total_kwh_today = round(sum(d for d, _ in per_device.values()), 3)
+    total_kwh_month = round(sum(m for _, m in per_device.values()), 3)
+    return (total_kwh_today, _tier_cost(total_kwh_today),
+            total_kwh_month, _tier_cost(total_kwh_month))
+
+def aggregate_energy(devices: list[str | dict]):
+    """(today_kwh, today_bill_bdt, month_kwh, month_bill_bdt) for Dhaka's
+    today and this month, summed across devices concurrently."""
+    return energy_totals(energy_by_device(devices))
+
 def aggregate_totals_all_devices(devices: list[str | dict]):
     """Return (total_power_now_W, present_voltage_max_V,
                today_kwh, today_bill_bdt, month_kwh, month_bill_bdt)"""
-    dev_ids = [d["id"] if isinstance(d, dict) else d for d in devices]
-
-    # ---- Instant totals ----
-    total_power_now = 0.0
-    latest_voltages = []
-    for did in dev_ids:
-        p, v = _latest_power_voltage(did)
-        total_power_now += p
-        if v is not None:
-            latest_voltages.append(float(v))
-    present_voltage = round(max(latest_voltages), 2) if latest_voltages else 0.0
-
-    # ---- Today (Dhaka) ----
-    now = datetime.now(dhaka_tz)
-
-    day_start_local = datetime(now.year, now.month, now.day, tzinfo=dhaka_tz)
-    day_end_local   = day_start_local.replace(
-        hour=23, minute=59, second=59, microsecond=999999
-    )
-
-    day_start = day_start_local.astimezone(timezone.utc).replace(tzinfo=None)
-    day_end   = day_end_local.astimezone(timezone.utc).replace(tzinfo=None)
-
-    total_kwh_today = 0.0
-    for did in dev_ids:
-        ddf = range_docs(did, day_start, day_end)
-        if not ddf.empty and "energy_kWh" in ddf.columns:
-            total_kwh_today += float(ddf["energy_kWh"].sum())
-    total_kwh_today = round(total_kwh_today, 3)
-    today_bill_bdt  = _tier_cost(total_kwh_today)
-
-    # ---- This month (Dhaka) ----
-    m_start_local = datetime(now.year, now.month, 1, tzinfo=dhaka_tz)
-    if now.month == 12:
-        next_month_local = datetime(now.year + 1, 1, 1, tzinfo=dhaka_tz)
-    else:
-        next_month_local = datetime(now.year, now.month + 1, 1, tzinfo=dhaka_tz)
-
-    m_start = m_start_local.astimezone(timezone.utc).replace(tzinfo=None)
-    m_end   = next_month_local.astimezone(timezone.utc).replace(tzinfo=None)
-
-    total_kwh_month = 0.0
-    for did in dev_ids:
-        mdf = range_docs(did, m_start, m_end)
-        if not mdf.empty and "energy_kWh" in mdf.columns:
-            total_kwh_month += float(mdf["energy_kWh"].sum())
-    total_kwh_month = round(total_kwh_month, 3)
-    month_bill_bdt  = _tier_cost(total_kwh_month)
-
-    return (
-        round(total_power_now, 2),
-        present_voltage,
-        total_kwh_today,
-        today_bill_bdt,
-        total_kwh_month,
-        month_bill_bdt,
-    )
-
-
-
-
-
-
+    return aggregate_instant(devices) + aggregate_energy(devices)
 
 
 def aggregate_timeseries_24h(devices: list[str|dict], resample_rule="5T") -> pd.DataFrame:
     """Return DataFrame with columns: timestamp, power_sum_W, voltage_avg_V for last 24h."""
-    dev_ids = [d["id"] if isinstance(d, dict) else d for d in devices]
+    dev_ids = _ids(devices)
     end = datetime.now()
     start = end - timedelta(hours=24)
 
-    frames = []
-    for did in dev_ids:
+    def device_frame(did):
         df = range_docs(did, start, end)
         if df.empty:
-            continue
+            return None
         cols = [c for c in ["timestamp", "power", "voltage"] if c in df.columns]
         if "timestamp" not in cols:
-            continue
+            return None
         df = df[cols].sort_values("timestamp").set_index("timestamp")
-        df = df.resample(resample_rule).mean(numeric_only=True)
-        frames.append(df)
+        return df.resample(resample_rule).mean(numeric_only=True)
+
+    frames = [f for f in map_devices(device_frame, dev_ids) if f is not None]
 
     if not frames:
         return pd.DataFrame(columns=["timestamp", "power_sum_W", "voltage_avg_V"])
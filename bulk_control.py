@@ -0,0 +1,233 @@
+"""
+bulk_control.py
+---------------
+Send commands to many devices at once: groups, scenes and load shedding.
+
+- Targets are device ids, a group (the optional "group" field of a device
+  in devices.json, e.g. "Building A"), or "all".
+- Commands are dispatched from a thread pool of MAX_WORKERS; every call
+  still goes through the rate limiter and pooled session of the device's
+  Tuya account, so a bulk action never exceeds an account's rate limit.
+- Every action returns one result per device (ok, Tuya response or
+  error, seconds) and is recorded in the `control_log` collection.
+
+Scenes live in scenes.json, written from the dashboard's Scenes tab
+(or by hand):
+
+    [{"name": "Night", "actions": [
+        {"group": "Building A", "command": "switch_1", "value": false},
+        {"devices": ["bf190540abb03010c9ukey"], "command": "switch_1", "value": true}]}]
+
+Load shedding reads the current power of the targets, then switches off
+the largest loads first until the total is under the limit. Devices with
+"critical": true in devices.json are never shed.
+
+    python bulk_control.py off --group "Building A"
+    python bulk_control.py scene Night
+    python bulk_control.py shed --limit-w 5000 --dry-run
+"""
+
+import os
+import json
+import time
+import argparse
+from pathlib import Path
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers import load_devices
+from metrics import counter
+from tuya_api import get_client, account_of
+from tuya_api_mongo import insert_events
+
+SCENES_JSON_PATH = Path("scenes.json")
+MAX_WORKERS = int(os.getenv("BULK_MAX_WORKERS", "16"))
+SWITCH_CODE = "switch_1"
+LOG_COLLECTION = "control_log"
+
+BULK_COMMANDS = counter("bulk_commands_total", "Device commands sent by bulk actions", ["result"])
+
+
+# ---------- Targets ----------
+def groups(devices=None) -> list:
+    return sorted({d["group"] for d in (devices or load_devices()) if d.get("group")})
+
+def resolve_targets(device_ids=None, group: str = None, devices=None) -> list:
+    """Devices (dicts from devices.json) selected by ids and/or group;
+    group "all" selects every device."""
+    devices = devices if devices is not None else load_devices()
+    wanted = set(device_ids or [])
+    return [d for d in devices if d.get("id") and (
+        d["id"] in wanted or group == "all" or (group and d.get("group") == group))]
+
+
+# ---------- Dispatch ----------
+def _run_pool(fn, devices, max_workers):
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(devices)))) as pool:
+        return list(pool.map(fn, devices))
+
+def bulk_command(devices, command: str, value, max_workers: int = MAX_WORKERS, source: str = "bulk") -> list:
+    """Send one command to every device concurrently.
+    Returns [{device_id, name, ok, seconds, response | error}]."""
+    if not devices:
+        return []
+
+    def send(d):
+        t0 = time.perf_counter()
+        res = {"device_id": d["id"], "name": d.get("name", "")}
+        try:
+            client = get_client(account_of(d))
+            resp = client.control_device(d["id"], client.get_token(), command, value)
+            res.update(ok=bool(resp.get("success")), response=resp)
+            if not res["ok"]:
+                res["error"] = resp.get("msg") or resp.get("code")
+        except Exception as e:
+            res.update(ok=False, error=f"{type(e).__name__}: {e}")
+        res["seconds"] = round(time.perf_counter() - t0, 3)
+        BULK_COMMANDS.inc(result="ok" if res["ok"] else "error")
+        return res
+
+    results = _run_pool(send, devices, max_workers)
+    _log(source, command, value, results)
+    return results
+
+def switch(devices, on: bool, **kw) -> list:
+    return bulk_command(devices, SWITCH_CODE, bool(on), **kw)
+
+def _log(source, command, value, results):
+    now = datetime.now(timezone.utc)
+    insert_events(LOG_COLLECTION, [
+        {"timestamp": now, "source": source, "command": command, "value": value,
+         "device_id": r["device_id"], "ok": r["ok"], "seconds": r["seconds"], "error": r.get("error")}
+        for r in results])
+
+def fleet_power(devices, max_workers: int = MAX_WORKERS) -> dict:
+    """{device_id: current power in W} read live from Tuya; unreachable
+    devices are left out."""
+    if not devices:
+        return {}
+
+    def read(d):
+        try:
+            raw = get_client(account_of(d)).get_device_status(d["id"])
+        except Exception:
+            return d["id"], None
+        if not raw.get("success"):
+            return d["id"], None
+        m = {x.get("code"): x.get("value") for x in raw.get("result", [])}
+        return d["id"], float(m.get("cur_power") or 0)
+
+    return {did: p for did, p in _run_pool(read, devices, max_workers) if p is not None}
+
+
+# ---------- Scenes ----------
+def load_scenes() -> list:
+    if not SCENES_JSON_PATH.exists():
+        return []
+    try:
+        return json.loads(SCENES_JSON_PATH.read_text(encoding="utf-8"))
+    except Exception:
+        return []
+
+def save_scenes(scenes: list):
+    tmp = SCENES_JSON_PATH.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(scenes, indent=4), encoding="utf-8")
+    os.replace(tmp, SCENES_JSON_PATH)
+
+def set_scene(name: str, actions: list):
+    """Create or replace the scene `name`."""
+    scenes = [s for s in load_scenes() if s.get("name") != name]
+    scenes.append({"name": name, "actions": actions})
+    save_scenes(scenes)
+
+def delete_scene(name: str):
+    save_scenes([s for s in load_scenes() if s.get("name") != name])
+
+def run_scene(name: str, max_workers: int = MAX_WORKERS) -> list:
+    """Apply a scene's actions in order, each one concurrently across its
+    devices."""
+    scene = next((s for s in load_scenes() if s.get("name") == name), None)
+    if scene is None:
+        raise KeyError(f"No scene named {name!r}")
+    devices = load_devices()
+    results = []
+    for a in scene.get("actions", []):
+        targets = resolve_targets(a.get("devices"), a.get("group"), devices)
+        results += bulk_command(targets, a.get("command", SWITCH_CODE), a.get("value"),
+                                max_workers, source=f"scene:{name}")
+    return results
+
+
+# ---------- Load shedding ----------
+def plan_shed(power: dict, limit_w: float, protected=()) -> list:
+    """Device ids to switch off, largest load first, until the remaining
+    total is at or below `limit_w`."""
+    total = sum(power.values())
+    plan = []
+    for did, p in sorted(power.items(), key=lambda kv: kv[1], reverse=True):
+        if total <= limit_w:
+            break
+        if did in protected or p <= 0:
+            continue
+        plan.append(did)
+        total -= p
+    return plan
+
+def shed_load(limit_w: float, devices=None, dry_run: bool = False, max_workers: int = MAX_WORKERS) -> dict:
+    """Bring the targets' total power under `limit_w` by switching off the
+    biggest non-critical loads. Returns {total_w, plan, expected_w, results}."""
+    devices = devices if devices is not None else resolve_targets(group="all")
+    power = fleet_power(devices, max_workers)
+    protected = {d["id"] for d in devices if d.get("critical")}
+    plan = plan_shed(power, limit_w, protected)
+    by_id = {d["id"]: d for d in devices}
+    total = sum(power.values())
+    out = {"total_w": total, "plan": plan, "expected_w": total - sum(power[d] for d in plan),
+           "results": []}
+    if plan and not dry_run:
+        out["results"] = switch([by_id[d] for d in plan], False, max_workers=max_workers, source="shed")
+    return out
+
+
+def _print_results(results):
+    for r in results:
+        status = "ok " if r["ok"] else "ERR"
+        print(f"{status} {r['seconds']:6.3f}s  {r['name'] or r['device_id']}"
+              + (f"  {r['error']}" if r.get("error") else ""))
+    ok = sum(r["ok"] for r in results)
+    print(f"[bulk] {ok}/{len(results)} succeeded")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Bulk device control")
+    sub = ap.add_subparsers(dest="action", required=True)
+    for name in ("on", "off"):
+        p = sub.add_parser(name, help=f"switch devices {name}")
+        p.add_argument("--group", help='group name, or "all"')
+        p.add_argument("--device", action="append", help="device id (repeat for several)")
+    p = sub.add_parser("scene", help="run a scene from scenes.json")
+    p.add_argument("name")
+    p = sub.add_parser("shed", help="switch off the largest loads until under a limit")
+    p.add_argument("--limit-w", type=float, required=True)
+    p.add_argument("--group", default="all")
+    p.add_argument("--dry-run", action="store_true")
+    ap.add_argument("--workers", type=int, default=MAX_WORKERS)
+    args = ap.parse_args(argv)
+
+    if args.action in ("on", "off"):
+        targets = resolve_targets(args.device, args.group)
+        if not targets:
+            ap.error("no devices match")
+        _print_results(switch(targets, args.action == "on", max_workers=args.workers))
+    elif args.action == "scene":
+        _print_results(run_scene(args.name, args.workers))
+    else:
+        out = shed_load(args.limit_w, resolve_targets(group=args.group), args.dry_run, args.workers)
+        print(f"[shed] now {out['total_w']:.0f} W, limit {args.limit_w:.0f} W, "
+              f"switching off {len(out['plan'])} device(s) -> ~{out['expected_w']:.0f} W"
+              + (" (dry run)" if args.dry_run else ""))
+        _print_results(out["results"])
+
+
+if __name__ == "__main__":
+    main()
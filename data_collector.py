@@ -15,13 +15,61 @@ Requirements:
     TUYA_API_ENDPOINT
     MONGODB_URI
     MONGODB_DB
+
+Sharded mode (see sharding.py):
+    python data_collector.py --sharded                 # one worker, joins the cluster
+    python data_collector.py --sharded --processes 4   # four local workers
+Each worker only collects devices in partitions it holds a lease for, so
+any number of workers on any number of hosts can run side by side without
+double-logging a device.
+
+Metrics (Prometheus text format) are served on
+http://127.0.0.1:<COLLECTOR_METRICS_PORT>/metrics (default 9108, 0 = off;
+with --processes N, worker i uses port + i). Per-device results are no
+longer printed; each cycle logs one summary line and repeated errors are
+rate-limited.
+
+Readings go to a durable on-disk spool first (see spool.py) and a
+background thread drains it into MongoDB in bulk, so a slow or
+unavailable database neither stalls collection nor loses readings.
+--no-spool writes straight to MongoDB as before.
+
+Each reading also feeds per-device online statistics and anomaly
+detection (see online_stats.py); events land in the `anomalies`
+collection. --no-analytics turns this off.
+
+The last RING_HOURS of every device's readings are also published to a
+shared-memory ring buffer (see ringbuf.py) that the dashboard reads for
+live tiles without querying MongoDB. It is the one collector path that
+loads numpy (about 75 ms and 14 MB RSS, see import_budget.py);
+--no-ring turns it off.
+
+Hour-of-week and daily kWh load profiles are maintained from the same
+readings (see load_profile.py). --no-profiles turns this off.
+
+Devices can belong to different Tuya accounts ("account" in devices.json,
+see tuya_api.py). Each account is collected in its own lane (thread) with
+its own rate limit, so one account's quota or latency does not hold up
+the others.
+
+energy_kWh of each reading is integrated over the time since the device's
+previous reading and reconciled against the plug's meter (see energy.py).
 """
 
+import os
 import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from helpers import load_devices
 from get_power_data import fetch_and_log_once
+from energy import EnergyIntegrator
+from tuya_api import account_of
+from tuya_api_mongo import upsert_latest_states
+from metrics import counter, gauge, histogram, start_http_server, RateLimitedLogger
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo  # built-in in Python 3.9+
 
@@ -30,55 +78,330 @@ DHAKA_TZ = ZoneInfo("Asia/Dhaka")
 
 # How often to log data (seconds)
 INTERVAL_SECONDS = 10  # change this if you want slower/faster collection
+METRICS_PORT = int(os.getenv("COLLECTOR_METRICS_PORT", "9108"))
+
+log = logging.getLogger("collector")
+rlog = RateLimitedLogger(log, interval=60)
+
+CYCLE_SECONDS = histogram("collector_cycle_seconds", "Duration of one collection cycle",
+                          buckets=(0.5, 1, 2.5, 5, 7.5, 10, 15, 20, 30, 60, 120))
+CYCLE_OVERRUNS = counter("collector_cycle_overruns_total", "Cycles that took longer than the interval")
+READINGS = counter("collector_readings_total", "Readings fetched and handed to the store")
+ERRORS = counter("collector_errors_total", "Collection errors by type", ["type"])
+STALENESS = gauge("collector_device_staleness_seconds",
+                  "Seconds since the last good reading (or since collection began)", ["device"])
+BUFFER_DEPTH = gauge("collector_buffer_depth", "Readings waiting to be collected or stored")
+DEVICES_OWNED = gauge("collector_devices_owned", "Devices this worker is responsible for")
+LANE_SECONDS = gauge("collector_account_lane_seconds", "Time to collect one account's devices", ["account"])
+PARTITIONS_OWNED = gauge("collector_partitions_owned", "Partitions this worker holds a lease for")
+
+_last_ok = {}  # device_id -> monotonic time of the last good reading (or of the first attempt)
+_stale_reported = set()  # devices with a staleness series
 
 
-def main():
+def _collect_device(d, account, sink, energy, analytics, profiles, ring):
+    """Fetch, store and fan out one reading; returns the row, or None on failure."""
+    dev_id = d["id"]
+    dev_name = d.get("name", "")
+    try:
+        result = fetch_and_log_once(dev_id, dev_name, sink=sink, integrator=energy, account=account)
+        if "error" in result:
+            ERRORS.inc(type="tuya_api")
+            rlog.warning(("api", dev_id), "Tuya error for %s: %s", dev_name or dev_id, result["error"])
+            return None
+        if not result.get("stored"):
+            ERRORS.inc(type="store")
+            rlog.warning(("store", dev_id), "Reading for %s not stored", dev_name or dev_id)
+            return None
+        READINGS.inc()
+        _last_ok[dev_id] = time.monotonic()
+        if analytics is not None:
+            analytics.update(dev_id, result["row"])
+        if profiles is not None:
+            profiles.update(dev_id, result["row"])
+        if ring is not None and not ring.publish_doc(dev_id, result["row"]):
+            rlog.warning("ring-full", "Ring buffer full; raise RING_MAX_DEVICES")
+        return result["row"]
+    except Exception as e:
+        ERRORS.inc(type=type(e).__name__)
+        rlog.error((type(e).__name__, dev_id), "ERROR for device %s: %s", dev_name or dev_id, e)
+        return None
+
+
+def collect_cycle(devices, member=None, sink=None, analytics=None, ring=None, energy=None,
+                  profiles=None):
+    """Fetch and log every device once. With a ShardMember, devices in
+    partitions owned by other workers are skipped; `sink` and the `energy`
+    integrator are passed on to fetch_and_log_once and good readings are
+    fed to `analytics` and `profiles` and published to `ring`.
+    Returns (ok, failed)."""
+    mine = []
+    for d in devices:
+        dev_id = d.get("id")
+        if not dev_id:
+            rlog.warning("missing-id", "Skipping device with missing 'id' field: %s", d)
+            continue
+        if member is not None and not member.owns(dev_id):
+            continue
+        mine.append(d)
+    DEVICES_OWNED.set(len(mine))
+    started = time.monotonic()
+    for d in mine:
+        # a device that never answers must still show up as stale
+        _last_ok.setdefault(d["id"], started)
+    if analytics is not None:
+        try:
+            analytics.ensure_loaded([d["id"] for d in mine])
+        except Exception as e:
+            rlog.warning("analytics-load", "Could not restore analytics state: %s", e)
+    if energy is not None:
+        try:
+            energy.ensure_loaded([d["id"] for d in mine])
+        except Exception as e:
+            rlog.warning("energy-load", "Could not restore energy state: %s", e)
+
+    lanes = {}
+    for d in mine:
+        lanes.setdefault(account_of(d), []).append(d)
+    BUFFER_DEPTH.set(len(mine))
+
+    def run_lane(account, lane):
+        t0 = time.monotonic()
+        rows = []
+        for d in lane:
+            if member is not None and not member.owns(d["id"]):
+                # lease lost mid-cycle: another worker may be collecting it now
+                ERRORS.inc(type="lease_lost")
+                rlog.warning(("lease-lost", d["id"]), "Lease for %s lost mid-cycle; skipping", d["id"])
+                BUFFER_DEPTH.dec()
+                continue
+            row = _collect_device(d, account, sink, energy, analytics, profiles, ring)
+            if row is not None:
+                rows.append(row)
+            BUFFER_DEPTH.dec()
+        LANE_SECONDS.set(time.monotonic() - t0, account=account)
+        return rows
+
+    if len(lanes) <= 1:
+        results = [run_lane(a, lane) for a, lane in lanes.items()]
+    else:
+        # one lane per Tuya account: a throttled or slow account only delays its own devices
+        with ThreadPoolExecutor(max_workers=len(lanes), thread_name_prefix="lane") as pool:
+            results = list(pool.map(lambda kv: run_lane(*kv), lanes.items()))
+    stored_rows = [row for rows in results for row in rows]
+    ok, failed = len(stored_rows), len(mine) - len(stored_rows)
+    BUFFER_DEPTH.set(0)
+    if sink is None and stored_rows and not upsert_latest_states(stored_rows):
+        # with a spool the drainer keeps latest_state up to date instead
+        rlog.warning("latest-state", "Could not update latest_state")
+    if analytics is not None:
+        try:
+            analytics.flush()
+        except Exception as e:
+            rlog.warning("analytics-flush", "Could not store analytics: %s", e)
+    if energy is not None:
+        try:
+            energy.flush()
+        except Exception as e:
+            rlog.warning("energy-flush", "Could not store energy state: %s", e)
+    if profiles is not None:
+        try:
+            if not profiles.flush():
+                rlog.warning("profiles-flush", "Could not store load profiles; will retry")
+        except Exception as e:
+            rlog.warning("profiles-flush", "Could not store load profiles: %s", e)
+
+    now = time.monotonic()
+    for d in mine:
+        STALENESS.set(now - _last_ok[d["id"]], device=d["id"])
+        _stale_reported.add(d["id"])
+    # drop series of devices moved to another worker or deleted, so a frozen
+    # value is not read as healthy; if one comes back its clock restarts
+    for dev_id in _stale_reported - {d["id"] for d in mine}:
+        STALENESS.remove(device=dev_id)
+        _stale_reported.discard(dev_id)
+        _last_ok.pop(dev_id, None)
+    return ok, failed
+
+
+def run(member=None, use_spool=True, use_analytics=True, use_ring=True, use_profiles=True):
     devices = load_devices()
     if not devices:
-        print("[collector] No devices found in devices.json. Exiting.")
+        log.info("No devices found in devices.json. Exiting.")
         return
 
-    print(f"[collector] Starting data collector for {len(devices)} device(s).")
-    print(f"[collector] Collection interval: {INTERVAL_SECONDS} seconds.")
-    print("[collector] Press Ctrl+C to stop.\n")
+    spool = drainer = None
+    if use_spool:
+        from spool import Spool, Drainer
+        spool = Spool.open_slot()
+        drainer = Drainer(spool)
+        drainer.start()
+        log.info("Spooling readings to %s (%d pending from earlier runs).", spool.path, spool.depth)
+
+    energy = EnergyIntegrator()
+
+    analytics = None
+    if use_analytics:
+        from online_stats import OnlineAnalytics
+        analytics = OnlineAnalytics()
+
+    profiles = None
+    if use_profiles:
+        from load_profile import LoadProfiles
+        profiles = LoadProfiles()
+
+    ring = None
+    if use_ring:
+        try:
+            from ringbuf import RingWriter
+            ring = RingWriter(interval=INTERVAL_SECONDS)
+            log.info("Publishing live readings to %s (%d slots/device).", ring.path, ring.slots)
+        except Exception as e:
+            log.warning("Ring buffer disabled: %s", e)
+
+    log.info("Starting data collector for %d device(s).", len(devices))
+    log.info("Collection interval: %d seconds.", INTERVAL_SECONDS)
+    if member is not None:
+        log.info("Sharded mode as worker %s (%d partitions, lease TTL %ds).",
+                 member.worker_id, member.partitions, member.ttl)
+        def renewal_failed(e):
+            ERRORS.inc(type="lease_renewal")
+            rlog.error("lease-renewal", "Lease renewal failed; leases lapse within %ds: %s", member.ttl, e)
+        member.start_renewal(on_error=renewal_failed)
+    log.info("Press Ctrl+C to stop.")
 
     try:
         while True:
-            loop_start_utc = datetime.now(timezone.utc)
-            loop_start_local = loop_start_utc.astimezone(DHAKA_TZ)
-            print(f"[collector] ==== New cycle at {loop_start_local.isoformat(timespec='seconds')} ====")
+            cycle_start = time.monotonic()
 
+            if member is not None:
+                try:
+                    PARTITIONS_OWNED.set(len(member.rebalance()))
+                except Exception as e:
+                    # Without a fresh lease we must not collect: another worker may take over
+                    ERRORS.inc(type="lease")
+                    rlog.error("lease", "Lease store error, skipping cycle: %s", e)
+                    member.owned = set()
+                    PARTITIONS_OWNED.set(0)
+                    time.sleep(INTERVAL_SECONDS)
+                    continue
 
             # Reload devices each cycle (optional: comment out if you don't want dynamic changes)
             devices = load_devices()
+            ok, failed = collect_cycle(devices, member, sink=spool.append if spool else None,
+                                       analytics=analytics, ring=ring, energy=energy,
+                                       profiles=profiles)
+            if spool is not None:
+                try:
+                    spool.sync()  # the cycle's last readings are durable before we sleep
+                except OSError as e:
+                    rlog.error("spool-sync", "Could not fsync spool: %s", e)
 
-            for d in devices:
-                dev_id = d.get("id")
-                dev_name = d.get("name", "")
+            elapsed = time.monotonic() - cycle_start
+            CYCLE_SECONDS.observe(elapsed)
+            if ring is not None:
+                ring.set_period(elapsed)  # readers scale their staleness cutoff to it
+            if elapsed > INTERVAL_SECONDS:
+                CYCLE_OVERRUNS.inc()
+            now_local = datetime.now(timezone.utc).astimezone(DHAKA_TZ)
+            log.info("cycle at %s: %d ok, %d failed in %.2fs%s",
+                     now_local.isoformat(timespec="seconds"), ok, failed, elapsed,
+                     " (OVERRUN)" if elapsed > INTERVAL_SECONDS else "")
 
-                if not dev_id:
-                    print("[collector] Skipping device with missing 'id' field:", d)
-                    continue
+            # Sleep until next cycle (fixed rate: subtract the time the cycle took)
+            time.sleep(max(0.0, INTERVAL_SECONDS - elapsed))
 
-                try:
-                    result = fetch_and_log_once(dev_id, dev_name)
-                    now_local = datetime.now(timezone.utc).astimezone(DHAKA_TZ)
-                    print(
-                        f"[collector] {now_local.isoformat(timespec='seconds')} | "
-                        f"{dev_name or dev_id} -> {result}"
-                    )
-                except Exception as e:
-                    now_local = datetime.now(timezone.utc).astimezone(DHAKA_TZ)
-                    print(
-                        f"[collector] ERROR at {now_local.isoformat(timespec='seconds')} "
-                        f"for device {dev_name or dev_id}: {e}"
-                    )
+    except KeyboardInterrupt:
+        log.info("Stopped by user (Ctrl+C). Goodbye.")
+    finally:
+        try:
+            energy.flush(force=True)
+        except Exception:
+            pass
+        if analytics is not None:
+            try:
+                analytics.flush(force=True)
+            except Exception:
+                pass
+        if profiles is not None:
+            try:
+                profiles.flush(force=True)
+            except Exception:
+                pass
+        if member is not None:
+            try:
+                member.leave()
+            except Exception:
+                pass
+        if spool is not None:
+            drainer.stop()
+            spool.close()
+            if spool.depth:
+                log.info("%d readings left in %s; they are stored on the next start.",
+                         spool.depth, spool.path)
 
-            # Sleep until next cycle
-            time.sleep(INTERVAL_SECONDS)
 
+def _setup(metrics_port: int):
+    logging.basicConfig(level=logging.INFO, format="[%(name)s] %(asctime)s %(message)s")
+    if metrics_port:
+        try:
+            start_http_server(metrics_port)
+            log.info("Metrics on http://127.0.0.1:%d/metrics", metrics_port)
+        except OSError as e:
+            log.warning("Metrics endpoint disabled: %s", e)
+
+
+def _run_sharded_worker(worker_id=None, metrics_port=0, **opts):
+    from sharding import ShardMember, default_store
+    _setup(metrics_port)
+    run(ShardMember(default_store(), worker_id), **opts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless Tuya metrics collector")
+    parser.add_argument("--sharded", action="store_true",
+                        help="claim device partitions through leases instead of collecting every device")
+    parser.add_argument("--worker-id", default=None,
+                        help="stable worker name (default: <hostname>-<pid>)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of local sharded worker processes to start")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="port for the /metrics endpoint (0 disables)")
+    parser.add_argument("--no-spool", action="store_true",
+                        help="insert readings into MongoDB directly instead of through the disk spool")
+    parser.add_argument("--no-analytics", action="store_true",
+                        help="skip online statistics and anomaly detection")
+    parser.add_argument("--no-ring", action="store_true",
+                        help="do not publish readings to the shared-memory ring buffer")
+    parser.add_argument("--no-profiles", action="store_true",
+                        help="do not maintain hour-of-week / daily load profiles")
+    args = parser.parse_args(argv)
+    opts = dict(use_spool=not args.no_spool, use_analytics=not args.no_analytics,
+                use_ring=not args.no_ring, use_profiles=not args.no_profiles)
+
+    if not args.sharded:
+        _setup(args.metrics_port)
+        run(**opts)
+        return
+
+    if args.processes <= 1:
+        _run_sharded_worker(args.worker_id, args.metrics_port, **opts)
+        return
+
+    procs = []
+    for i in range(args.processes):
+        wid = f"{args.worker_id}-{i}" if args.worker_id else None
+        port = args.metrics_port + i if args.metrics_port else 0
+        p = multiprocessing.Process(target=_run_sharded_worker, args=(wid, port), kwargs=opts,
+                                    daemon=False)
+        p.start()
+        procs.append(p)
+    try:
+        for p in procs:
+            p.join()
     except KeyboardInterrupt:
-        print("\n[collector] Stopped by user (Ctrl+C). Goodbye.")
+        for p in procs:
+            p.join()
 
 
 if __name__ == "__main__":
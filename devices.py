@@ -1,15 +1,79 @@
+import os
 import json
+import threading
 from pathlib import Path
 
 DEVICES_JSON_PATH = Path("devices.json")
 
-def load_devices():
-    if not DEVICES_JSON_PATH.exists():
-        return []
+# Parsed registry, reused until the file's mtime/size changes
+_cache = {"key": None, "devices": [], "by_id": {}}
+_lock = threading.Lock()
+
+
+def _load_cached():
     try:
-        return json.loads(DEVICES_JSON_PATH.read_text(encoding="utf-8"))
-    except Exception:
-        return []
+        st = DEVICES_JSON_PATH.stat()
+    except OSError:
+        return [], {}
+    key = (st.st_mtime_ns, st.st_size)
+    with _lock:
+        if _cache["key"] != key:
+            try:
+                devs = json.loads(DEVICES_JSON_PATH.read_text(encoding="utf-8"))
+            except Exception:
+                devs = []
+            _cache.update(key=key, devices=devs, by_id={d.get("id"): d for d in devs})
+        return _cache["devices"], _cache["by_id"]
+
+def load_devices():
+    return [dict(d) for d in _load_cached()[0]]
 
 def save_devices(devs: list):
-    DEVICES_JSON_PATH.write_text(json.dumps(devs, indent=4), encoding="utf-8")
+    """Replace devices.json atomically (readers never see a half-written file)."""
+    tmp = DEVICES_JSON_PATH.with_name(DEVICES_JSON_PATH.name + ".tmp")
+    tmp.write_text(json.dumps(devs, indent=4), encoding="utf-8")
+    os.replace(tmp, DEVICES_JSON_PATH)
+
+def get_device(device_id: str):
+    d = _load_cached()[1].get(device_id)
+    return dict(d) if d else None
+
+def device_ids() -> list:
+    return [d["id"] for d in _load_cached()[0] if d.get("id")]
+
+def device_groups() -> list:
+    return sorted({d["group"] for d in _load_cached()[0] if d.get("group")})
+
+def search_devices(query: str = "", group: str = None, page: int = 1, page_size: int = 24):
+    """(devices on `page`, number of matches). `query` matches name, id or
+    group, case-insensitively."""
+    q = (query or "").strip().lower()
+    hits = [d for d in _load_cached()[0]
+            if (not group or d.get("group") == group)
+            and (not q or q in d.get("name", "").lower() or q in d.get("id", "").lower()
+                 or q in d.get("group", "").lower())]
+    start = max(0, (page - 1) * page_size)
+    return [dict(d) for d in hits[start:start + page_size]], len(hits)
+
+def apply_device_edits(updates: dict = None, deletes=()):
+    """Apply many edits in one write. `updates` maps an existing device id
+    to the fields to change (a new "id" renames it); None or "" values
+    remove a field. Returns (updated, deleted)."""
+    updates, deletes = updates or {}, set(deletes)
+    devs, n_upd, n_del = [], 0, 0
+    for d in load_devices():
+        if d.get("id") in deletes:
+            n_del += 1
+            continue
+        changes = updates.get(d.get("id"))
+        if changes:
+            for k, v in changes.items():
+                if v is None or v == "":
+                    d.pop(k, None)
+                else:
+                    d[k] = v
+            n_upd += 1
+        devs.append(d)
+    if n_upd or n_del:
+        save_devices(devs)
+    return n_upd, n_del
@@ -0,0 +1,224 @@
+"""
+energy.py
+---------
+Per-device energy integration for the collector, plus a repair job for
+readings already stored.
+
+Each reading's `energy_kWh` is the energy used since the device's previous
+reading: the trapezoid between the two power samples over the time that
+actually elapsed. That is correct whatever the collection interval, and
+ad-hoc samples taken by the dashboard (stored with energy_kWh = 0 and
+adhoc = True) do not count twice.
+
+- Gaps (collector down, device offline) longer than MAX_GAP_SECONDS are
+  counted as MAX_GAP_SECONDS: the power in between is unknown.
+- When the plug reports its cumulative meter (`add_ele`, kept on the
+  reading as add_ele_kWh), the integrated energy is reconciled against it
+  each time the meter advances, so totals follow the meter and energy used
+  during gaps is not lost. A meter that goes backwards (reset, re-pairing)
+  is treated as a new starting point. ENERGY_RECONCILE=0 turns this off.
+- The last sample of every device is snapshotted to `device_state`
+  (kind "energy") after every collect cycle (ENERGY_SNAPSHOT_SECONDS, 0 by
+  default), on shutdown and when a device moves to another worker, so
+  integration carries across restarts. When a device's stored
+  `latest_state` reading is newer than its snapshot (a crash between
+  storing readings and snapshotting), integration resumes from that
+  reading instead, so energy already booked is not booked again.
+
+Repair stored readings (e.g. those written with the old fixed 5 s
+assumption):
+
+    python energy.py --all
+    python energy.py --device bf190540abb03010c9ukey --since 2025-10-01
+"""
+
+import os
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from metrics import counter
+from tuya_api_mongo import get_collection, load_device_states, save_device_states, latest_states
+
+STATE_KIND = "energy"
+MAX_GAP_SECONDS = float(os.getenv("ENERGY_MAX_GAP_SECONDS", "60"))
+RECONCILE = os.getenv("ENERGY_RECONCILE", "1") != "0"
+SNAPSHOT_INTERVAL = float(os.getenv("ENERGY_SNAPSHOT_SECONDS", "0"))  # 0: every flush
+REPAIR_BATCH = 1000
+
+ENERGY_GAPS = counter("collector_energy_gaps_total", "Intervals longer than ENERGY_MAX_GAP_SECONDS")
+
+
+def trapezoid_kwh(p0: float, p1: float, seconds: float) -> float:
+    return (p0 + p1) / 2.0 * seconds / 3600.0 / 1000.0
+
+
+class DeviceIntegrator:
+    def __init__(self, state: dict = None):
+        state = state or {}
+        self.ts = state.get("ts")              # epoch seconds of the last sample
+        self.power = state.get("power")
+        self.meter = state.get("meter")        # add_ele (kWh) when the meter last moved
+        self.pending = float(state.get("pending", 0.0))  # booked since then, plus debt
+        self.debt = float(state.get("debt", 0.0))        # debt not yet held back
+
+    def to_state(self) -> dict:
+        return {"ts": self.ts, "power": self.power, "meter": self.meter,
+                "pending": self.pending, "debt": self.debt}
+
+    def resume_from(self, ts: float, power: float):
+        """Continue after a stored reading newer than this state. Energy
+        booked since the snapshot is unknown, so the meter baseline
+        restarts with the next meter reading."""
+        if self.ts is None or ts > self.ts:
+            self.ts, self.power = ts, power
+            self.meter, self.pending, self.debt = None, 0.0, 0.0
+
+    def step(self, ts: float, power: float, meter: float = None) -> float:
+        """kWh used since the previous sample. Out-of-order samples get 0
+        and leave the state alone."""
+        if self.ts is not None and ts <= self.ts:
+            return 0.0
+        e = 0.0
+        if self.ts is not None:
+            dt = ts - self.ts
+            if dt > MAX_GAP_SECONDS:
+                ENERGY_GAPS.inc()
+                dt = MAX_GAP_SECONDS
+            e = trapezoid_kwh(self.power or 0.0, power, dt)
+        self.ts, self.power = ts, power
+
+        if meter is None or not RECONCILE:
+            return e
+        if self.meter is None or meter < self.meter:
+            self.meter, self.pending, self.debt = meter, 0.0, 0.0
+        elif meter > self.meter:
+            # book the difference between meter and what was booked since it
+            # last moved; an overshoot is carried as (positive) debt and
+            # subtracted from the next advance
+            e = (meter - self.meter) - self.pending
+            self.meter, self.pending = meter, max(-e, 0.0)
+            self.debt = self.pending
+            e = max(e, 0.0)
+        else:
+            # while in debt, hold back integrated energy so the overshoot
+            # does not grow from one advance to the next
+            held = min(e, self.debt)
+            self.debt -= held
+            e -= held
+            self.pending += e
+        return e
+
+
+class EnergyIntegrator:
+    """Integrators for all devices handled by one collector process."""
+
+    def __init__(self):
+        self.devices = {}
+        self._unloaded = set()  # snapshot could not be read; retried next cycle
+        self._last_snapshot = time.monotonic()
+
+    def ensure_loaded(self, device_ids):
+        """Restore snapshots for devices not yet in memory (one query); save
+        and forget devices this worker no longer handles. When the store
+        cannot be read the missing devices stay unloaded, so their meter
+        baseline, pending energy and debt are not replaced by a fresh state;
+        the next call retries."""
+        wanted = set(device_ids)
+        gone = {d: s.to_state() for d, s in self.devices.items() if d not in wanted}
+        if gone:
+            save_device_states(STATE_KIND, gone)
+            for d in gone:
+                del self.devices[d]
+        missing = [d for d in wanted if d not in self.devices]
+        self._unloaded = set()
+        if missing:
+            saved = load_device_states(STATE_KIND, missing)
+            if saved is None:
+                self._unloaded = set(missing)
+                return
+            latest = latest_states(missing)
+            for d in missing:
+                integ = self.devices[d] = DeviceIntegrator(saved.get(d))
+                last = latest.get(d)
+                if last and last.get("timestamp") is not None:
+                    integ.resume_from(_epoch(last["timestamp"]), float(last.get("power") or 0.0))
+
+    def update(self, device_id: str, ts: datetime, power: float, meter: float = None) -> float:
+        """kWh to store on the reading. Unloaded devices get 0 and keep no
+        state; the meter reconciliation books what they used later."""
+        integ = self.devices.get(device_id)
+        if integ is None:
+            if device_id in self._unloaded:
+                return 0.0
+            integ = self.devices[device_id] = DeviceIntegrator()
+        return integ.step(ts.timestamp(), power, meter)
+
+    def flush(self, force: bool = False):
+        if force or time.monotonic() - self._last_snapshot >= SNAPSHOT_INTERVAL:
+            if save_device_states(STATE_KIND, {d: s.to_state() for d, s in self.devices.items()}):
+                self._last_snapshot = time.monotonic()
+
+
+# ---------- Repair ----------
+def _epoch(ts: datetime) -> float:
+    return (ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)).timestamp()
+
+def repair_energy(device_id: str, since: datetime = None, batch: int = REPAIR_BATCH) -> int:
+    """Recompute energy_kWh of a device's stored readings from `since`
+    (naive UTC, default: all) in one ordered pass. Returns how many
+    readings changed."""
+    coll = get_collection(device_id)
+    if coll is None:
+        return 0
+    fields = {"timestamp": 1, "power": 1, "add_ele_kWh": 1, "adhoc": 1, "energy_kWh": 1}
+    match = {"adhoc": {"$ne": True}}
+    integ = DeviceIntegrator()
+    if since is not None:
+        # seed from the last reading before the repaired range
+        prev = coll.find_one({**match, "timestamp": {"$lt": since}}, fields,
+                             sort=[("timestamp", DESCENDING)])
+        if prev:
+            integ.step(_epoch(prev["timestamp"]), float(prev.get("power") or 0.0), prev.get("add_ele_kWh"))
+        match["timestamp"] = {"$gte": since}
+
+    changed, ops = 0, []
+    cur = coll.find(match, fields).sort("timestamp", ASCENDING).batch_size(batch)
+    for doc in cur:
+        e = integ.step(_epoch(doc["timestamp"]), float(doc.get("power") or 0.0), doc.get("add_ele_kWh"))
+        if abs((doc.get("energy_kWh") or 0.0) - e) > 1e-12:
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"energy_kWh": e}}))
+        if len(ops) >= batch:
+            coll.bulk_write(ops, ordered=False)
+            changed += len(ops)
+            ops = []
+    if ops:
+        coll.bulk_write(ops, ordered=False)
+        changed += len(ops)
+    return changed
+
+
+def main(argv=None):
+    from helpers import load_devices, dhaka_tz
+    ap = argparse.ArgumentParser(description="Recompute energy_kWh of stored readings")
+    who = ap.add_mutually_exclusive_group(required=True)
+    who.add_argument("--device", action="append", help="device id (repeat for several)")
+    who.add_argument("--all", action="store_true", help="every device in devices.json")
+    ap.add_argument("--since", help="first day to repair, YYYY-MM-DD (Dhaka); default: everything")
+    args = ap.parse_args(argv)
+
+    since = None
+    if args.since:
+        local = datetime.strptime(args.since, "%Y-%m-%d").replace(tzinfo=dhaka_tz)
+        since = local.astimezone(timezone.utc).replace(tzinfo=None)
+    device_ids = args.device or [d["id"] for d in load_devices() if d.get("id")]
+    for did in device_ids:
+        t0 = time.monotonic()
+        n = repair_energy(did, since)
+        print(f"[energy] {did}: {n} readings updated in {timedelta(seconds=round(time.monotonic() - t0))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+export.py
+---------
+Stream readings out of MongoDB to CSV or Parquet in bounded memory.
+
+    # one device, raw readings, October
+    python export.py --device bf190540abb03010c9ukey --start 2025-10-01 --end 2025-10-31 --out fahim.csv
+
+    # every device in devices.json, 15-minute averages, Parquet
+    python export.py --all --start 2025-08-01 --end 2025-10-31 --resolution 15min \\
+        --format parquet --out fleet.parquet
+
+Readings are pulled with chunked cursors (tuya_api_mongo.iter_reading_chunks)
+and written one chunk at a time: a CSV is appended to, a Parquet file gets
+one row group per chunk. Memory use depends on --chunk-size, not on the
+length of the range or the number of devices. --resolution averages on the
+server, so only the buckets cross the network.
+
+Dates are Dhaka local days, like the dashboard; exported timestamps are
+ISO 8601 with the +06:00 offset.
+
+Parquet output needs pyarrow (pip install pyarrow).
+"""
+
+import csv
+import sys
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from helpers import dhaka_tz, load_devices
+from tuya_api_mongo import iter_reading_chunks
+
+COLUMNS = ["timestamp", "device_id", "device_name", "voltage", "current", "power", "energy_kWh"]
+RESOLUTIONS = {"raw": None, "1min": 60, "5min": 300, "15min": 900, "1h": 3600, "1d": 86400}
+DEFAULT_CHUNK = 5000
+
+
+def _local_iso(ts) -> str:
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)  # Mongo hands back naive UTC
+    return ts.astimezone(dhaka_tz).isoformat()
+
+def _rows(device_ids, start_utc, end_utc, resolution_s, chunk_size):
+    """Yield lists of export rows, chunk by chunk, device by device."""
+    for did in device_ids:
+        for chunk in iter_reading_chunks(did, start_utc, end_utc, chunk_size, resolution_s):
+            rows = []
+            for d in chunk:
+                row = {c: d.get(c) for c in COLUMNS}
+                row["device_id"] = row["device_id"] or did
+                row["timestamp"] = _local_iso(d["timestamp"])
+                if resolution_s:
+                    row["samples"] = d.get("samples")
+                rows.append(row)
+            yield rows
+
+
+def _write_csv(chunks, out, columns):
+    writer = csv.DictWriter(out, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    n = 0
+    for rows in chunks:
+        writer.writerows(rows)
+        n += len(rows)
+    return n
+
+def _write_parquet(chunks, out, columns):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    types = {"timestamp": pa.string(), "device_id": pa.string(), "device_name": pa.string(),
+             "samples": pa.int64()}
+    schema = pa.schema([(c, types.get(c, pa.float64())) for c in columns])
+    n = 0
+    with pq.ParquetWriter(out, schema) as writer:
+        for rows in chunks:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            n += len(rows)
+    return n
+
+
+def export_readings(device_ids, start_utc: datetime, end_utc: datetime, out,
+                    fmt: str = "csv", resolution: str = "raw", chunk_size: int = DEFAULT_CHUNK) -> int:
+    """Write readings of `device_ids` in [start_utc, end_utc] (naive UTC) to
+    `out` (a path, or a text file for CSV / binary file for Parquet).
+    Returns the number of rows written."""
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"resolution must be one of {', '.join(RESOLUTIONS)}")
+    resolution_s = RESOLUTIONS[resolution]
+    columns = COLUMNS + (["samples"] if resolution_s else [])
+    chunks = _rows(device_ids, start_utc, end_utc, resolution_s, chunk_size)
+
+    if fmt == "parquet":
+        return _write_parquet(chunks, out, columns)
+    if fmt != "csv":
+        raise ValueError("format must be csv or parquet")
+    if isinstance(out, str):
+        with open(out, "w", newline="", encoding="utf-8") as f:
+            return _write_csv(chunks, f, columns)
+    return _write_csv(chunks, out, columns)
+
+
+def local_day_range(start_date, end_date):
+    """Dhaka calendar days [start_date, end_date] -> naive UTC bounds."""
+    start = datetime(start_date.year, start_date.month, start_date.day, tzinfo=dhaka_tz)
+    end = datetime(end_date.year, end_date.month, end_date.day, tzinfo=dhaka_tz) + timedelta(days=1)
+    to_utc = lambda d: d.astimezone(timezone.utc).replace(tzinfo=None)
+    return to_utc(start), to_utc(end) - timedelta(microseconds=1)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Export readings to CSV or Parquet")
+    who = ap.add_mutually_exclusive_group(required=True)
+    who.add_argument("--device", action="append", help="device id (repeat for several)")
+    who.add_argument("--all", action="store_true", help="every device in devices.json")
+    ap.add_argument("--start", required=True, help="first day, YYYY-MM-DD (Dhaka)")
+    ap.add_argument("--end", required=True, help="last day, YYYY-MM-DD (Dhaka)")
+    ap.add_argument("--format", default="csv", choices=["csv", "parquet"])
+    ap.add_argument("--resolution", default="raw", choices=list(RESOLUTIONS))
+    ap.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK)
+    ap.add_argument("--out", required=True, help="output file, or - for CSV on stdout")
+    args = ap.parse_args(argv)
+
+    device_ids = args.device or [d["id"] for d in load_devices() if d.get("id")]
+    start_utc, end_utc = local_day_range(datetime.strptime(args.start, "%Y-%m-%d").date(),
+                                         datetime.strptime(args.end, "%Y-%m-%d").date())
+    out = sys.stdout if args.out == "-" else args.out
+    if out is sys.stdout and args.format != "csv":
+        ap.error("only CSV can be written to stdout")
+
+    n = export_readings(device_ids, start_utc, end_utc, out, args.format, args.resolution, args.chunk_size)
+    print(f"[export] wrote {n} rows for {len(device_ids)} device(s) to {args.out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
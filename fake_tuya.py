@@ -0,0 +1,301 @@
+"""
+fake_tuya.py
+------------
+A local stand-in for the Tuya OpenAPI, for load-testing the collector and
+the dashboard without real plugs or API quota.
+
+Implements the three endpoints tuya_api.py uses:
+    GET  /v1.0/token?grant_type=1
+    GET  /v1.0/devices/{id}/status
+    POST /v1.0/devices/{id}/commands
+and verifies the HMAC-SHA256 `sign` header exactly as tuya_api._make_sign
+builds it. GET /_stats (unsigned) returns request counters.
+
+Example — 5000 plugs, ~80 ms lognormal latency, 1 % errors, 500 req/s:
+    python fake_tuya.py --devices 5000 --latency-ms 80 --latency-dist lognormal \\
+        --error-rate 0.01 --rate-limit 500 --write-devices devices_fake.json
+
+then point the collector at it:
+    TUYA_API_ENDPOINT=http://127.0.0.1:8765 TUYA_ACCESS_ID=fake-id \\
+    TUYA_ACCESS_SECRET=fake-secret python data_collector.py
+(with devices_fake.json copied over devices.json, or a separate checkout).
+"""
+
+import os
+import json
+import math
+import time
+import hmac
+import random
+import hashlib
+import argparse
+import threading
+import secrets
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SIGN_MAX_SKEW_MS = 5 * 60 * 1000
+TOKEN_TTL_SECONDS = 7200
+PROFILES = ["constant", "cyclic", "noisy", "standby"]
+
+
+def expected_sign(client_id, secret, method, url, t, access_token="", body=b""):
+    """Server side of tuya_api._make_sign."""
+    string_to_sign = "\n".join([method.upper(), hashlib.sha256(body).hexdigest(), "", url])
+    msg = client_id + access_token + t + string_to_sign
+    return hmac.new(secret.encode("utf-8"), msg.encode("utf-8"), hashlib.sha256).hexdigest().upper()
+
+
+# ---------- Simulated devices ----------
+class FakeDevice:
+    def __init__(self, device_id: str, profile: str, rng: random.Random):
+        self.id = device_id
+        self.profile = profile
+        self.on = True
+        self.base_w = {"constant": rng.uniform(20, 200), "cyclic": rng.uniform(60, 1500),
+                       "noisy": rng.uniform(30, 800), "standby": rng.uniform(0.3, 3)}[profile]
+        self.period_s = rng.uniform(300, 1800)
+        self.phase = rng.random()
+        self.add_ele = 0.0          # kWh, reported in 0.001 kWh steps
+        self.last_read = time.time()
+
+    def power_w(self, now: float, rng: random.Random) -> float:
+        if not self.on:
+            return 0.0
+        if self.profile == "cyclic":
+            running = ((now / self.period_s + self.phase) % 1.0) < 0.5
+            return self.base_w * rng.uniform(0.95, 1.05) if running else self.base_w * 0.02
+        if self.profile == "noisy":
+            return max(0.0, rng.gauss(self.base_w, self.base_w * 0.3))
+        return self.base_w * rng.uniform(0.98, 1.02)
+
+    def status(self, rng: random.Random):
+        now = time.time()
+        p = self.power_w(now, rng)
+        self.add_ele += p * (now - self.last_read) / 3600.0 / 1000.0
+        self.last_read = now
+        v = rng.gauss(228, 3)
+        return [
+            {"code": "switch_1", "value": self.on},
+            {"code": "add_ele", "value": int(self.add_ele * 1000)},
+            {"code": "cur_current", "value": int(p / v * 1000)},
+            {"code": "cur_power", "value": int(round(p))},
+            {"code": "cur_voltage", "value": int(round(v * 10))},
+        ]
+
+
+class FakeCloud:
+    def __init__(self, access_id, access_secret, n_devices=1000, profile="mixed",
+                 latency_ms=0.0, latency_dist="fixed", error_rate=0.0,
+                 rate_limit=0.0, seed=407):
+        self.access_id = access_id
+        self.access_secret = access_secret
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.devices = {}
+        for i in range(n_devices):
+            did = f"fake{i:06d}"
+            prof = self.rng.choice(PROFILES) if profile == "mixed" else profile
+            self.devices[did] = FakeDevice(did, prof, self.rng)
+        # token bucket for the whole project, like Tuya's per-project QPS cap
+        self._bucket = rate_limit
+        self._bucket_ts = time.monotonic()
+        self.stats = {"requests": 0, "ok": 0, "sign_failed": 0, "rate_limited": 0,
+                      "injected_errors": 0, "not_found": 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def sleep_latency(self):
+        if self.latency_ms <= 0:
+            return
+        with self.lock:
+            if self.latency_dist == "uniform":
+                ms = self.rng.uniform(0, 2 * self.latency_ms)
+            elif self.latency_dist == "exp":
+                ms = self.rng.expovariate(1.0 / self.latency_ms)
+            elif self.latency_dist == "lognormal":
+                sigma = 0.6
+                ms = self.rng.lognormvariate(math.log(self.latency_ms) - sigma ** 2 / 2, sigma)
+            else:
+                ms = self.latency_ms
+        time.sleep(ms / 1000.0)
+
+    def take_rate_token(self) -> bool:
+        if self.rate_limit <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self._bucket = min(self.rate_limit, self._bucket + (now - self._bucket_ts) * self.rate_limit)
+            self._bucket_ts = now
+            if self._bucket < 1:
+                return False
+            self._bucket -= 1
+            return True
+
+    def inject_error(self) -> bool:
+        if self.error_rate <= 0:
+            return False
+        with self.lock:
+            return self.rng.random() < self.error_rate
+
+    def token_valid(self, token: str) -> bool:
+        with self.lock:
+            exp = self.tokens.get(token)
+        return exp is not None and exp > time.time()
+
+    def issue_token(self) -> str:
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.tokens[token] = time.time() + TOKEN_TTL_SECONDS
+        return token
+
+
+def _failure(code, msg):
+    return {"success": False, "code": code, "msg": msg, "t": int(time.time() * 1000)}
+
+def _success(result):
+    return {"success": True, "result": result, "t": int(time.time() * 1000)}
+
+
+def make_handler(cloud: FakeCloud):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            pass  # thousands of req/s; use /_stats instead
+
+        def _reply(self, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _check_sign(self, body: bytes, with_token: bool):
+            h = self.headers
+            client_id, t = h.get("client_id", ""), h.get("t", "")
+            token = h.get("access_token", "") if with_token else ""
+            if client_id != cloud.access_id:
+                return _failure(1005, "clientId invalid")
+            try:
+                skew = abs(int(time.time() * 1000) - int(t))
+            except ValueError:
+                return _failure(1004, "sign invalid")
+            if skew > SIGN_MAX_SKEW_MS:
+                return _failure(1013, "request time is invalid")
+            want = expected_sign(client_id, cloud.access_secret, self.command, self.path, t, token, body)
+            if not hmac.compare_digest(want, h.get("sign", "")):
+                return _failure(1004, "sign invalid")
+            if with_token and not cloud.token_valid(token):
+                return _failure(1010, "token invalid")
+            return None
+
+        def _handle(self, body: bytes):
+            cloud.count("requests")
+            path = urlsplit(self.path).path
+            if path == "/_stats":
+                with cloud.lock:
+                    return self._reply(dict(cloud.stats))
+
+            cloud.sleep_latency()
+            if not cloud.take_rate_token():
+                cloud.count("rate_limited")
+                return self._reply(_failure(40000309, "request frequency is too high"))
+
+            parts = path.strip("/").split("/")
+            is_token = self.command == "GET" and path == "/v1.0/token"
+            err = self._check_sign(body, with_token=not is_token)
+            if err:
+                cloud.count("sign_failed")
+                return self._reply(err)
+            if cloud.inject_error():
+                cloud.count("injected_errors")
+                return self._reply(_failure(500, "system error, please contact the admin"))
+
+            if is_token:
+                cloud.count("ok")
+                return self._reply(_success({
+                    "access_token": cloud.issue_token(), "expire_time": TOKEN_TTL_SECONDS,
+                    "refresh_token": secrets.token_hex(16), "uid": "fake-uid",
+                }))
+
+            if len(parts) == 4 and parts[:2] == ["v1.0", "devices"]:
+                dev = cloud.devices.get(parts[2])
+                if dev is None:
+                    cloud.count("not_found")
+                    return self._reply(_failure(2009, "device does not exist"))
+                if self.command == "GET" and parts[3] == "status":
+                    with cloud.lock:
+                        result = dev.status(cloud.rng)
+                    cloud.count("ok")
+                    return self._reply(_success(result))
+                if self.command == "POST" and parts[3] == "commands":
+                    try:
+                        cmds = json.loads(body or b"{}").get("commands", [])
+                    except ValueError:
+                        return self._reply(_failure(1109, "param is illegal"))
+                    with cloud.lock:
+                        for c in cmds:
+                            if c.get("code") == "switch_1":
+                                dev.on = bool(c.get("value"))
+                    cloud.count("ok")
+                    return self._reply(_success(True))
+
+            return self._reply(_failure(1108, "uri path invalid"), status=404)
+
+        def do_GET(self):
+            self._handle(b"")
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            self._handle(self.rfile.read(length) if length else b"")
+
+    return Handler
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Local fake Tuya OpenAPI for load testing")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--access-id", default=os.getenv("TUYA_ACCESS_ID") or "fake-id")
+    ap.add_argument("--access-secret", default=os.getenv("TUYA_ACCESS_SECRET") or "fake-secret")
+    ap.add_argument("--devices", type=int, default=1000)
+    ap.add_argument("--profile", default="mixed", choices=["mixed"] + PROFILES)
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="mean added latency per request")
+    ap.add_argument("--latency-dist", default="fixed", choices=["fixed", "uniform", "exp", "lognormal"])
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    ap.add_argument("--rate-limit", type=float, default=0.0, help="requests/s across the project (0 = unlimited)")
+    ap.add_argument("--seed", type=int, default=407)
+    ap.add_argument("--write-devices", metavar="PATH", help="write a devices.json listing the fake plugs")
+    args = ap.parse_args(argv)
+
+    cloud = FakeCloud(args.access_id, args.access_secret, args.devices, args.profile,
+                      args.latency_ms, args.latency_dist, args.error_rate, args.rate_limit, args.seed)
+    if args.write_devices:
+        with open(args.write_devices, "w") as f:
+            json.dump([{"name": f"Fake {d.profile} {did}", "id": did}
+                       for did, d in cloud.devices.items()], f, indent=4)
+        print(f"[fake-tuya] wrote {len(cloud.devices)} devices to {args.write_devices}")
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(cloud))
+    server.daemon_threads = True
+    print(f"[fake-tuya] serving {len(cloud.devices)} devices on http://{args.host}:{args.port}")
+    print(f"[fake-tuya] client_id={args.access_id} (stats at /_stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[fake-tuya] stopped.")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
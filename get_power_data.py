@@ -1,13 +1,23 @@
-from tuya_api import get_token, get_device_status
+from tuya_api import get_client
 from tuya_api_mongo import insert_reading
 from helpers import parse_metrics, build_doc
 
-def fetch_and_log_once(device_id: str, device_name: str = ""):
-    token = get_token()
-    raw = get_device_status(device_id, token)
+def fetch_and_log_once(device_id: str, device_name: str = "", sink=None, integrator=None, account=None):
+    """Read one device and store the reading. `sink(device_id, doc)` replaces
+    the direct MongoDB insert (the collector passes its spool's append).
+    Energy is integrated by the collector's `integrator`; readings taken
+    without one (the dashboard's ad-hoc refreshes) carry no energy and are
+    flagged adhoc. `account` names the Tuya account the device belongs to."""
+    raw = get_client(account).get_device_status(device_id)
     if not raw.get("success"):
         return {"error": raw}
-    v, c, p, e = parse_metrics(raw)
-    doc = build_doc(device_id, device_name, v, c, p, e)
-    insert_reading(device_id, doc)
-    return {"ok": True, "row": doc, "raw": raw}
+    v, c, p, meter = parse_metrics(raw)
+    doc = build_doc(device_id, device_name, v, c, p, 0.0)
+    if meter is not None:
+        doc["add_ele_kWh"] = meter
+    if integrator is not None:
+        doc["energy_kWh"] = integrator.update(device_id, doc["timestamp"], p, meter)
+    else:
+        doc["adhoc"] = True
+    stored = (sink or insert_reading)(device_id, doc)
+    return {"ok": True, "stored": stored, "row": doc, "raw": raw}
@@ -1,20 +1,21 @@
 import json
 import os
-import streamlit as st
 from datetime import datetime, timedelta, timezone
 
 dhaka_tz = timezone(timedelta(hours=6))
 
 
 def parse_metrics(status_json: dict):
+    """(voltage V, current A, power W, meter kWh). The meter is the plug's
+    cumulative add_ele, None when the device does not report it; energy
+    per reading comes from energy.EnergyIntegrator."""
     result = status_json.get("result", [])
     m = {x.get("code"): x.get("value") for x in result}
     voltage = (m.get("cur_voltage") or 0) / 10.0     # deciV → V
     power   = (m.get("cur_power") or 0) * 1.0        # W
     current = (m.get("cur_current") or 0) / 1000.0   # mA → A
-    # integrate power over 5s: kWh = W * (5/3600) / 1000
-    energy_kwh = power * (5.0 / 3600.0) / 1000.0
-    return voltage, current, power, energy_kwh
+    meter   = m["add_ele"] / 1000.0 if m.get("add_ele") is not None else None  # 0.001 kWh → kWh
+    return voltage, current, power, meter
 
 def build_doc(device_id: str, device_name: str, v: float, c: float, p: float, e: float):
     return {
@@ -41,8 +42,3 @@ def save_devices(devices):
     """Save all devices to the JSON file."""
     with open(DEVICE_FILE, "w") as f:
         json.dump(devices, f, indent=4)
-
-def go_home():
-    """Navigate back to home page."""
-    st.session_state.page = "home"
-
@@ -0,0 +1,130 @@
+"""
+import_budget.py
+----------------
+Guard for the headless core's import cost.
+
+The collector side (data_collector, sharding, get_power_data, tuya_api,
+tuya_api_mongo, helpers, metrics, profiler, spool) must stay free of the UI
+stack: Streamlit, pandas, plotting libraries and numpy belong to app.py
+and billing.py only. This script imports each core module in a fresh
+interpreter and fails (exit 1) when
+
+- a forbidden module shows up in sys.modules, or
+- the import takes longer than --max-seconds, or
+- the process peak RSS exceeds --max-rss-mb.
+
+It also checks RUNTIME_SETS: what a process has imported once it is
+running, lazy imports included. With default flags the collector loads
+the spool, analytics, load profiles and the ring buffer; the ring buffer
+is NumPy arrays over shared memory, so numpy is the one UI-side module
+allowed there (about 75 ms and 14 MB RSS; --no-ring avoids it). Its cost
+is printed with each run.
+
+    python import_budget.py                 # check with default budgets
+    python import_budget.py --show 15       # also list the 15 slowest imports
+
+Run it after adding an import to any core module.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+CORE_MODULES = [
+    "data_collector", "sharding", "get_power_data", "tuya_api",
+    "tuya_api_mongo", "helpers", "metrics", "profiler", "spool", "online_stats", "energy",
+    "load_profile",
+]
+# name -> (modules imported together, forbidden modules allowed in them)
+RUNTIME_SETS = {
+    "collector:run": ("data_collector, spool, online_stats, load_profile, sharding, ringbuf", ["numpy"]),
+}
+FORBIDDEN = ["streamlit", "streamlit_autorefresh", "pandas", "plotly", "altair", "numpy", "matplotlib"]
+
+DEFAULT_MAX_SECONDS = 1.0
+DEFAULT_MAX_RSS_MB = 80
+
+_PROBE = """
+import sys, time, json, resource
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{"elapsed": elapsed, "rss_mb": rss_kb / 1024.0, "modules": sorted(sys.modules)}}))
+"""
+
+
+def probe(module: str):
+    """Import `module` in a clean interpreter; returns (report, importtime stderr)."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _PROBE.format(module=module)],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if proc.returncode != 0:
+        tail = [l for l in proc.stderr.splitlines() if not l.startswith("import time:")]
+        raise RuntimeError("\n".join(tail[-5:]) or f"import {module} failed")
+    return json.loads(proc.stdout.strip().splitlines()[-1]), proc.stderr
+
+
+def _import_times(importtime_log: str):
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # "import time:  self_us |  cumulative_us | name"
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|", 2)
+        rows.append((int(cumulative_us), name.strip()))
+    return rows
+
+def slowest_imports(importtime_log: str, n: int):
+    return sorted(_import_times(importtime_log), reverse=True)[:n]
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Import-time / RSS budget for the headless core")
+    ap.add_argument("--max-seconds", type=float, default=DEFAULT_MAX_SECONDS)
+    ap.add_argument("--max-rss-mb", type=float, default=DEFAULT_MAX_RSS_MB)
+    ap.add_argument("--show", type=int, default=0, help="list the N slowest imports per module")
+    ap.add_argument("modules", nargs="*")
+    args = ap.parse_args(argv)
+
+    checks = [(m, m, []) for m in args.modules] if args.modules else \
+        [(m, m, []) for m in CORE_MODULES] + [(name, mods, allowed) for name, (mods, allowed) in RUNTIME_SETS.items()]
+    failures = []
+    for module, imports, allowed in checks:
+        try:
+            report, log = probe(imports)
+        except RuntimeError as e:
+            failures.append(f"{module}: import failed: {e}")
+            continue
+        loaded = set(report["modules"])
+        bad = sorted(m for m in FORBIDDEN if m in loaded and m not in allowed)
+        status = "ok"
+        if bad:
+            failures.append(f"{module}: pulls in {', '.join(bad)}")
+            status = "FORBIDDEN"
+        if report["elapsed"] > args.max_seconds:
+            failures.append(f"{module}: import took {report['elapsed']:.2f}s > {args.max_seconds}s")
+            status = "SLOW"
+        if report["rss_mb"] > args.max_rss_mb:
+            failures.append(f"{module}: peak RSS {report['rss_mb']:.1f} MB > {args.max_rss_mb} MB")
+            status = "FAT"
+        print(f"{module:16s} {report['elapsed'] * 1000:8.1f} ms {report['rss_mb']:7.1f} MB  {status}")
+        for us, name in _import_times(log):
+            if name in allowed:
+                print(f"    {us / 1000:8.1f} ms  {name} (allowed)")
+        for us, name in slowest_imports(log, args.show):
+            print(f"    {us / 1000:8.1f} ms  {name}")
+
+    if failures:
+        print("\nImport budget exceeded:")
+        for f in failures:
+            print("  " + f)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
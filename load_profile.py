@@ -0,0 +1,204 @@
+"""
+load_profile.py
+---------------
+Load profiles maintained at ingest, so hour-of-week and calendar views
+never scan raw readings.
+
+For every device one document in `load_profiles` holds:
+
+    how.hNNN.n / .sum      readings and summed power (W) in hour-of-week NNN
+                           (Monday 00:00-01:00 Dhaka = 0 ... Sunday 23:00 = 167)
+    how.hNNN.bKK           readings whose power fell in histogram bin KK
+                           (POWER_BINS), for percentiles
+    daily.YYYY-MM-DD       kWh used on that Dhaka day
+
+The collector folds each reading into in-memory increments (LoadProfiles)
+and applies them every FLUSH_INTERVAL seconds as one bulk of $inc upserts,
+so the cost per reading is O(1) and the documents never need rewriting.
+Increments not yet flushed when a collector dies are lost (at most one
+interval). Existing history can be folded in once with `rebuild`.
+
+Reading a profile is one small document per device whatever the length of
+history; the fleet view sums the device documents.
+
+    python load_profile.py rebuild --all                 # backfill from readings
+    python load_profile.py show bf190540abb03010c9ukey   # JSON profile
+    python load_profile.py show --fleet --days 30
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import bisect
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from helpers import dhaka_tz, load_devices
+from tuya_api_mongo import inc_docs, find_docs, get_named_collection, iter_reading_chunks
+
+COLLECTION = "load_profiles"
+HOURS_PER_WEEK = 168
+FLUSH_INTERVAL = int(os.getenv("PROFILE_FLUSH_SECONDS", "60"))
+# Upper edges (W) of the power histogram bins; the last bin is open-ended
+POWER_BINS = [0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 50, 75, 100, 150, 200, 300,
+              500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000]
+
+
+def hour_of_week(ts: datetime) -> int:
+    local = (ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)).astimezone(dhaka_tz)
+    return local.weekday() * 24 + local.hour
+
+def _local_day(ts: datetime) -> str:
+    return (ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)).astimezone(dhaka_tz).date().isoformat()
+
+def _bin(power: float) -> int:
+    return bisect.bisect_left(POWER_BINS, power)
+
+
+class LoadProfiles:
+    """Pending $inc increments for the devices handled by one collector."""
+
+    def __init__(self):
+        self._incs = {}
+        self._retry = None  # (token, incs) of a flush that may or may not have been applied
+        self._last_flush = time.monotonic()
+
+    def update(self, device_id: str, doc: dict):
+        ts = doc.get("timestamp")
+        if ts is None:
+            return
+        p = float(doc.get("power") or 0.0)
+        h = f"how.h{hour_of_week(ts):03d}"
+        inc = self._incs.setdefault(device_id, {})
+        for key, delta in ((f"{h}.n", 1), (f"{h}.sum", p), (f"{h}.b{_bin(p):02d}", 1),
+                           (f"daily.{_local_day(ts)}", float(doc.get("energy_kWh") or 0.0))):
+            inc[key] = inc.get(key, 0) + delta
+
+    def flush(self, force: bool = False) -> bool:
+        """Apply pending increments. Each batch carries a token so a failed
+        batch can be retried as it was without counting twice; new
+        increments keep accumulating until it has gone through."""
+        if self._retry is not None:
+            if not inc_docs(COLLECTION, self._retry[1], token=self._retry[0]):
+                return False
+            self._retry = None
+        if not self._incs or not (force or time.monotonic() - self._last_flush >= FLUSH_INTERVAL):
+            return True
+        batch, self._incs = self._incs, {}
+        token = uuid.uuid4().hex
+        if not inc_docs(COLLECTION, batch, token=token):
+            self._retry = (token, batch)
+            return False
+        self._last_flush = time.monotonic()
+        return True
+
+
+# ---------- Queries ----------
+def _percentile(hist: list, n: int, q: float) -> float:
+    """Interpolated percentile from bin counts."""
+    if not n:
+        return 0.0
+    target, seen = q * n, 0
+    for i, c in enumerate(hist):
+        if c and seen + c >= target:
+            lo = POWER_BINS[i - 1] if i > 0 else 0.0
+            if i >= len(POWER_BINS):
+                return lo
+            return lo + (POWER_BINS[i] - lo) * (target - seen) / c
+        seen += c
+    return POWER_BINS[-1]
+
+def _matrix(doc: dict, q: float = 0.95) -> dict:
+    how = (doc or {}).get("how", {})
+    n, mean, pq = [0] * HOURS_PER_WEEK, [None] * HOURS_PER_WEEK, [None] * HOURS_PER_WEEK
+    for h in range(HOURS_PER_WEEK):
+        cell = how.get(f"h{h:03d}")
+        if not cell or not cell.get("n"):
+            continue
+        n[h] = int(cell["n"])
+        mean[h] = cell.get("sum", 0.0) / n[h]
+        pq[h] = _percentile([cell.get(f"b{i:02d}", 0) for i in range(len(POWER_BINS) + 1)], n[h], q)
+    return {"n": n, "mean": mean, "p95": pq}
+
+def profile_matrix(device_id: str = None, device_ids: list = None) -> dict:
+    """Hour-of-week profile {"n", "mean", "p95"}: lists of 168 values (None
+    where nothing was recorded), Monday 00:00 first. Without `device_id`
+    the fleet of `device_ids` (default: all devices) is summed; its p95 is
+    then the sum of the devices' p95, an upper bound."""
+    if device_id:
+        return _matrix(find_docs(COLLECTION, [device_id], {"how": 1}).get(device_id))
+    ids = device_ids or [d["id"] for d in load_devices() if d.get("id")]
+    fleet = {"n": [0] * HOURS_PER_WEEK, "mean": [None] * HOURS_PER_WEEK, "p95": [None] * HOURS_PER_WEEK}
+    for doc in find_docs(COLLECTION, ids, {"how": 1}).values():
+        m = _matrix(doc)
+        for h in range(HOURS_PER_WEEK):
+            if m["n"][h]:
+                fleet["n"][h] += m["n"][h]
+                fleet["mean"][h] = (fleet["mean"][h] or 0.0) + m["mean"][h]
+                fleet["p95"][h] = (fleet["p95"][h] or 0.0) + m["p95"][h]
+    return fleet
+
+def daily_calendar(device_id: str = None, days: int = 365, device_ids: list = None) -> dict:
+    """{YYYY-MM-DD: kWh} for the last `days` Dhaka days, oldest first, for
+    one device or summed across the fleet."""
+    ids = [device_id] if device_id else (device_ids or [d["id"] for d in load_devices() if d.get("id")])
+    today = datetime.now(dhaka_tz).date()
+    keys = [(today - timedelta(days=i)).isoformat() for i in range(days - 1, -1, -1)]
+    out = dict.fromkeys(keys, 0.0)
+    projection = {f"daily.{k}": 1 for k in keys}
+    for doc in find_docs(COLLECTION, ids, projection).values():
+        for k, v in doc.get("daily", {}).items():
+            if k in out:
+                out[k] += float(v or 0.0)
+    return out
+
+
+# ---------- Backfill ----------
+def rebuild_profile(device_id: str, since: datetime = None) -> int:
+    """Recompute a device's profile from its stored readings (from `since`,
+    naive UTC, default all), replacing the stored document. Run it while
+    the collector is stopped, or accept the readings of the overlap twice."""
+    coll = get_named_collection(COLLECTION)
+    if coll is None:
+        return 0
+    end = datetime.now(timezone.utc).replace(tzinfo=None)
+    start = since or datetime(1970, 1, 1)
+    acc, n = LoadProfiles(), 0
+    coll.delete_one({"_id": device_id})
+    for chunk in iter_reading_chunks(device_id, start, end):
+        for doc in chunk:
+            if not doc.get("adhoc"):
+                acc.update(device_id, doc)
+                n += 1
+        acc.flush(force=True)
+    return n
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Load profiles (hour-of-week, daily kWh)")
+    sub = ap.add_subparsers(dest="action", required=True)
+    p = sub.add_parser("rebuild", help="recompute profiles from stored readings")
+    who = p.add_mutually_exclusive_group(required=True)
+    who.add_argument("--device", action="append")
+    who.add_argument("--all", action="store_true")
+    p = sub.add_parser("show", help="print a profile as JSON")
+    p.add_argument("device", nargs="?")
+    p.add_argument("--fleet", action="store_true")
+    p.add_argument("--days", type=int, default=31)
+    args = ap.parse_args(argv)
+
+    if args.action == "rebuild":
+        for did in args.device or [d["id"] for d in load_devices() if d.get("id")]:
+            print(f"[profile] {did}: {rebuild_profile(did)} readings")
+        return
+    if not args.device and not args.fleet:
+        ap.error("give a device id or --fleet")
+    json.dump({"hour_of_week": profile_matrix(args.device),
+               "daily_kwh": daily_calendar(args.device, args.days)}, sys.stdout, indent=1)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+metrics.py
+----------
+Tiny Prometheus-style metrics registry (stdlib only, thread-safe).
+
+    from metrics import counter, histogram
+    REQS = counter("tuya_requests_total", "Tuya calls", ["endpoint"])
+    REQS.inc(endpoint="status")
+    with histogram("x_seconds", "...").time():
+        ...
+
+`start_http_server(port)` serves the text exposition format on
+http://<host>:<port>/metrics from a daemon thread, so any Prometheus (or
+curl) can scrape the collector. `RateLimitedLogger` replaces per-row
+prints: the same message key is logged at most once per interval and the
+number of suppressed repeats is reported with the next one.
+"""
+
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0)
+
+_lock = threading.Lock()
+_registry = {}
+
+
+def _fmt_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+def _fmt_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def remove(self, **labels):
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_one(key, value))
+        return lines
+
+    def _render_one(self, key, value):
+        return [f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _render_one(self, key, state):
+        lines, cumulative = [], 0
+        for upper, n in zip(self.buckets, state["counts"]):
+            cumulative += n
+            le = _fmt_labels(self.labelnames, key, [("le", _fmt_value(upper))])
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+        base = _fmt_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{base} {_fmt_value(state['sum'])}")
+        lines.append(f"{self.name}_count{base} {state['count']}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, hist, labels):
+        self.hist, self.labels = hist, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, **self.labels)
+        return False
+
+
+def _get_or_create(cls, name, doc, labelnames, **kw):
+    with _lock:
+        m = _registry.get(name)
+        if m is None:
+            m = _registry[name] = cls(name, doc, labelnames, **kw)
+        elif not isinstance(m, cls):
+            raise ValueError(f"metric {name} already registered as {m.kind}")
+        return m
+
+def counter(name, doc, labelnames=()):
+    return _get_or_create(Counter, name, doc, labelnames)
+
+def gauge(name, doc, labelnames=()):
+    return _get_or_create(Gauge, name, doc, labelnames)
+
+def histogram(name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, doc, labelnames, buckets=buckets)
+
+
+def render() -> str:
+    with _lock:
+        metrics = list(_registry.values())
+    lines = []
+    for m in metrics:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- Exposition endpoint ----------
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+def start_http_server(port: int, host: str = "127.0.0.1"):
+    """Serve /metrics from a daemon thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+# ---------- Rate-limited logging ----------
+class RateLimitedLogger:
+    """Log each `key` at most once every `interval` seconds."""
+
+    def __init__(self, logger: logging.Logger, interval: float = 60.0):
+        self.logger = logger
+        self.interval = interval
+        self._last = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def log(self, level, key, msg, *args):
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and now - last < self.interval:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return
+            self._last[key] = now
+            dropped = self._suppressed.pop(key, 0)
+        if dropped:
+            msg = f"{msg} (+{dropped} similar suppressed)"
+        self.logger.log(level, msg, *args)
+
+    def info(self, key, msg, *args):
+        self.log(logging.INFO, key, msg, *args)
+
+    def warning(self, key, msg, *args):
+        self.log(logging.WARNING, key, msg, *args)
+
+    def error(self, key, msg, *args):
+        self.log(logging.ERROR, key, msg, *args)
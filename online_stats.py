@@ -0,0 +1,193 @@
+"""
+online_stats.py
+---------------
+Per-device streaming statistics and anomaly detection, updated by the
+collector as each reading arrives (O(1) per sample, no history scans).
+
+For every device it keeps:
+- EWMA of power
+- mean / variance of power (Welford)
+- rolling min / max power over the last ROLLING_SAMPLES readings
+  (monotonic deques, amortised O(1))
+- a standby-load estimate: a streaming low quantile (STANDBY_QUANTILE) of
+  power, i.e. what the load draws when nothing is actively running
+
+and raises events into the `anomalies` collection when a device enters
+one of these states (not on every sample while it stays there):
+- voltage_sag      voltage below NOMINAL_VOLTAGE * (1 - SAG_FRACTION)
+- over_current     current above MAX_CURRENT_A
+- abnormal_power   power more than ABNORMAL_Z standard deviations from
+                   the device's mean, once WARMUP_SAMPLES have been seen
+
+The compact per-device state (everything but the rolling window) is
+snapshotted to the `device_state` collection every SNAPSHOT_INTERVAL
+seconds and on shutdown, and reloaded when a device is first seen, so
+statistics survive restarts and partition moves between workers.
+"""
+
+import os
+import math
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from metrics import counter
+from tuya_api_mongo import insert_events, load_device_states, save_device_states
+
+STATE_KIND = "online_stats"
+ANOMALY_COLLECTION = "anomalies"
+
+EWMA_ALPHA = float(os.getenv("STATS_EWMA_ALPHA", "0.1"))
+ROLLING_SAMPLES = int(os.getenv("STATS_ROLLING_SAMPLES", "360"))    # 1 h at 10 s
+NOMINAL_VOLTAGE = float(os.getenv("STATS_NOMINAL_VOLTAGE", "230"))
+SAG_FRACTION = float(os.getenv("STATS_SAG_FRACTION", "0.10"))
+MAX_CURRENT_A = float(os.getenv("STATS_MAX_CURRENT_A", "10"))
+ABNORMAL_Z = float(os.getenv("STATS_ABNORMAL_Z", "4"))
+WARMUP_SAMPLES = 60
+STANDBY_QUANTILE = 0.10
+SNAPSHOT_INTERVAL = 60
+
+ANOMALIES = counter("collector_anomalies_total", "Anomaly events raised at ingest", ["type"])
+
+
+class DeviceStats:
+    def __init__(self, state: dict = None):
+        state = state or {}
+        self.n = int(state.get("n", 0))
+        self.ewma = state.get("ewma")
+        self.mean = float(state.get("mean", 0.0))
+        self.m2 = float(state.get("m2", 0.0))
+        self.standby = state.get("standby")
+        self.flags = dict(state.get("flags", {}))
+        self.last_ts = state.get("last_ts")
+        # rolling window: (sample index, power); not persisted
+        self._min = deque()
+        self._max = deque()
+
+    def to_state(self) -> dict:
+        return {"n": self.n, "ewma": self.ewma, "mean": self.mean, "m2": self.m2,
+                "standby": self.standby, "flags": self.flags, "last_ts": self.last_ts}
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+    @property
+    def rolling_min(self):
+        return self._min[0][1] if self._min else None
+
+    @property
+    def rolling_max(self):
+        return self._max[0][1] if self._max else None
+
+    def update(self, p: float, v: float, c: float):
+        """Fold one sample in; returns [(event_type, value, threshold)] for
+        states the device has just entered."""
+        # z-score against the statistics *before* this sample
+        z = abs(p - self.mean) / self.std if self.n >= WARMUP_SAMPLES and self.std > 0 else 0.0
+
+        self.n += 1
+        self.ewma = p if self.ewma is None else EWMA_ALPHA * p + (1 - EWMA_ALPHA) * self.ewma
+        delta = p - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (p - self.mean)
+
+        i = self.n
+        while self._min and self._min[-1][1] >= p:
+            self._min.pop()
+        self._min.append((i, p))
+        while self._max and self._max[-1][1] <= p:
+            self._max.pop()
+        self._max.append((i, p))
+        while self._min[0][0] <= i - ROLLING_SAMPLES:
+            self._min.popleft()
+        while self._max[0][0] <= i - ROLLING_SAMPLES:
+            self._max.popleft()
+
+        # streaming quantile (stochastic gradient step scaled to the load)
+        if self.standby is None:
+            self.standby = p
+        else:
+            step = max(0.01, 0.02 * (self.ewma or 0.0))
+            self.standby += step * (STANDBY_QUANTILE - (1.0 if p < self.standby else 0.0))
+            self.standby = max(0.0, self.standby)
+
+        checks = [
+            ("voltage_sag", v > 0 and v < NOMINAL_VOLTAGE * (1 - SAG_FRACTION),
+             v, round(NOMINAL_VOLTAGE * (1 - SAG_FRACTION), 1)),
+            ("over_current", c > MAX_CURRENT_A, c, MAX_CURRENT_A),
+            ("abnormal_power", z > ABNORMAL_Z, p, round(ABNORMAL_Z, 2)),
+        ]
+        events = []
+        for kind, active, value, threshold in checks:
+            if active and not self.flags.get(kind):
+                events.append((kind, value, threshold))
+            self.flags[kind] = bool(active)
+        return events
+
+
+class OnlineAnalytics:
+    """All devices handled by one collector process."""
+
+    def __init__(self):
+        self.devices = {}
+        self._unloaded = set()  # snapshot could not be read; retried next cycle
+        self._pending = []
+        self._last_snapshot = time.monotonic()
+
+    def ensure_loaded(self, device_ids):
+        """Restore snapshots for devices not yet in memory (one query); save
+        and forget devices this worker no longer handles. When the store
+        cannot be read the missing devices stay unloaded (their readings
+        are not analysed) so a saved state is never overwritten by a fresh
+        one; the next call retries."""
+        wanted = set(device_ids)
+        gone = {d: s.to_state() for d, s in self.devices.items() if d not in wanted}
+        if gone:
+            save_device_states(STATE_KIND, gone)
+            for d in gone:
+                del self.devices[d]
+        missing = [d for d in wanted if d not in self.devices]
+        self._unloaded = set()
+        if missing:
+            saved = load_device_states(STATE_KIND, missing)
+            if saved is None:
+                self._unloaded = set(missing)
+                return
+            for d in missing:
+                self.devices[d] = DeviceStats(saved.get(d))
+
+    def update(self, device_id: str, doc: dict):
+        stats = self.devices.get(device_id)
+        if stats is None:
+            if device_id in self._unloaded:
+                return None
+            stats = self.devices[device_id] = DeviceStats()
+        p = float(doc.get("power") or 0.0)
+        v = float(doc.get("voltage") or 0.0)
+        c = float(doc.get("current") or 0.0)
+        ts = doc.get("timestamp") or datetime.now(timezone.utc)
+        for kind, value, threshold in stats.update(p, v, c):
+            ANOMALIES.inc(type=kind)
+            self._pending.append({
+                "device_id": device_id, "device_name": doc.get("device_name", ""),
+                "type": kind, "timestamp": ts, "value": value, "threshold": threshold,
+                "ewma_power": round(stats.ewma or 0.0, 2), "mean_power": round(stats.mean, 2),
+                "std_power": round(stats.std, 2),
+            })
+        stats.last_ts = ts.isoformat() if isinstance(ts, datetime) else ts
+        return stats
+
+    def flush(self, force: bool = False):
+        """Store pending events; snapshot state when due (or forced)."""
+        if self._pending and insert_events(ANOMALY_COLLECTION, self._pending):
+            self._pending = []
+        elif len(self._pending) > 10000:
+            self._pending = self._pending[-10000:]  # store down for long: keep the newest
+        if force or time.monotonic() - self._last_snapshot >= SNAPSHOT_INTERVAL:
+            if save_device_states(STATE_KIND, {d: s.to_state() for d, s in self.devices.items()}):
+                self._last_snapshot = time.monotonic()
@@ -0,0 +1,202 @@
+"""
+profiler.py
+-----------
+Opt-in render profiler for the dashboard.
+
+    prof = Profile("page_device")
+    with activate(prof):
+        with span("mongo:range_docs"):
+            ...
+    save(prof)   # appends one JSON line to the rolling profile log
+
+    python profiler.py           # per-page render times from the log
+
+Spans nest and record their start offset and duration. While a profile is
+active, tuya_api and tuya_api_mongo report every Tuya/Mongo call through
+`record_io`, so each span also carries how many queries it issued and how
+many bytes came back. Outside an active profile `span` and `record_io`
+are no-ops, so instrumented code pays nothing when profiling is off.
+
+Profiles are bound to the current thread; worker threads join a profile
+with `activate(prof)`, or run functions wrapped by `bind` on the caller's
+thread.
+"""
+
+import os
+import json
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+PROFILE_ENV = "DASHBOARD_PROFILE"
+PROFILE_LOG = os.getenv("DASHBOARD_PROFILE_LOG", "profile_log.jsonl")
+PROFILE_LOG_MAX_BYTES = 5 * 1024 * 1024
+PROFILE_LOG_BACKUPS = 3
+
+_local = threading.local()
+
+
+def enabled_by_env() -> bool:
+    return os.getenv(PROFILE_ENV, "").lower() in ("1", "true", "yes", "on")
+
+
+class Span:
+    __slots__ = ("name", "start_ms", "duration_ms", "depth", "thread", "io")
+
+    def __init__(self, name, start_ms, depth, thread):
+        self.name = name
+        self.start_ms = start_ms
+        self.duration_ms = None
+        self.depth = depth
+        self.thread = thread
+        self.io = {}  # kind -> [calls, bytes]
+
+    def as_dict(self):
+        d = {"name": self.name, "start_ms": round(self.start_ms, 2),
+             "duration_ms": round(self.duration_ms or 0.0, 2),
+             "depth": self.depth, "thread": self.thread}
+        for kind, (calls, nbytes) in self.io.items():
+            d[f"{kind}_calls"] = calls
+            d[f"{kind}_bytes"] = nbytes
+        return d
+
+
+class Profile:
+    def __init__(self, name: str):
+        self.name = name
+        self.created = time.time()
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans = []
+
+    def now_ms(self):
+        return (time.perf_counter() - self._t0) * 1000.0
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def total_ms(self):
+        return self.now_ms()
+
+    def as_dict(self):
+        with self._lock:
+            spans = [s.as_dict() for s in self.spans]
+        return {"page": self.name, "ts": round(self.created, 3),
+                "total_ms": round(self.total_ms(), 2), "spans": spans}
+
+
+def current():
+    return getattr(_local, "profile", None)
+
+
+@contextmanager
+def activate(profile):
+    """Make `profile` the active one for this thread (None is allowed)."""
+    prev, prev_stack = current(), getattr(_local, "stack", None)
+    _local.profile, _local.stack = profile, []
+    try:
+        yield profile
+    finally:
+        _local.profile, _local.stack = prev, prev_stack
+
+
+def bind(fn):
+    """Wrap `fn` to run under the calling thread's active profile, for
+    handing work to a thread pool."""
+    prof = current()
+    if prof is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with activate(prof):
+            return fn(*args, **kwargs)
+    return run
+
+
+@contextmanager
+def span(name: str):
+    prof = current()
+    if prof is None:
+        yield None
+        return
+    stack = _local.stack
+    s = Span(name, prof.now_ms(), len(stack), threading.current_thread().name)
+    prof.add(s)
+    stack.append(s)
+    try:
+        yield s
+    finally:
+        stack.pop()
+        s.duration_ms = prof.now_ms() - s.start_ms
+
+
+def record_io(kind: str, nbytes: int = 0):
+    """Attribute one Tuya/Mongo call to every open span of this thread."""
+    if current() is None:
+        return
+    for s in _local.stack:
+        calls, total = s.io.get(kind, (0, 0))
+        s.io[kind] = (calls + 1, total + int(nbytes or 0))
+
+
+# ---------- Rolling log ----------
+_log = None
+_log_lock = threading.Lock()
+
+def _profile_logger():
+    global _log
+    with _log_lock:
+        if _log is None:
+            _log = logging.getLogger("dashboard.profile")
+            _log.propagate = False
+            _log.setLevel(logging.INFO)
+            handler = RotatingFileHandler(PROFILE_LOG, maxBytes=PROFILE_LOG_MAX_BYTES,
+                                          backupCount=PROFILE_LOG_BACKUPS, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _log.addHandler(handler)
+        return _log
+
+def save(profile: Profile):
+    _profile_logger().info(json.dumps(profile.as_dict()))
+
+def load_recent(n: int = 200):
+    """Most recent `n` saved profiles (current log file only)."""
+    if not os.path.exists(PROFILE_LOG):
+        return []
+    with open(PROFILE_LOG, encoding="utf-8") as f:
+        lines = f.readlines()[-n:]
+    out = []
+    for line in lines:
+        try:
+            out.append(json.loads(line))
+        except ValueError:
+            pass
+    return out
+
+def summarize(profiles) -> dict:
+    """{page: {"renders", "p50_ms", "p95_ms", "max_ms"}} of saved profiles."""
+    by_page = {}
+    for p in profiles:
+        by_page.setdefault(p.get("page", "?"), []).append(float(p.get("total_ms") or 0.0))
+    out = {}
+    for page, ms in sorted(by_page.items()):
+        ms.sort()
+        pick = lambda q: ms[max(0, math.ceil(q * len(ms)) - 1)]  # nearest rank
+        out[page] = {"renders": len(ms), "p50_ms": round(pick(0.50), 1),
+                     "p95_ms": round(pick(0.95), 1), "max_ms": round(ms[-1], 1)}
+    return out
+
+
+if __name__ == "__main__":
+    import sys
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rows = summarize(load_recent(n))
+    if not rows:
+        print(f"No profiles in {PROFILE_LOG}; turn on profiling in the dashboard sidebar.")
+    for page, r in rows.items():
+        print(f"{page:<12} {r['renders']:>5} renders  p50 {r['p50_ms']:>8.1f} ms  "
+              f"p95 {r['p95_ms']:>8.1f} ms  max {r['max_ms']:>8.1f} ms")
@@ -0,0 +1,237 @@
+"""
+projection.py
+-------------
+Month-end kWh and bill projection from cached daily baselines.
+
+A closed Dhaka day never changes, so its kWh is computed once (one
+server-side aggregation covering every missing day) and stored as an
+immutable baseline in `daily_baselines`:
+
+    _id "<device_id>:<YYYY-MM-DD>"   device_id, day, kwh, samples
+
+Baselines are also kept in process memory, so after the first call a
+refresh only sums today's open interval: one small query per device, or
+none when the caller already knows today's kWh (the live device view,
+the home page's per-device totals).
+A day is stored only once its readings are all in: SETTLE_SECONDS after
+it ends and once the device's latest stored reading (`latest_state`,
+advanced by the collector or the spool drainer as readings land) is past
+the day's end, so a day spanning a MongoDB outage is not frozen while
+its readings are still spooled. A device with nothing stored past a day
+is settled anyway after STALE_SETTLE_DAYS (it is offline, not lagging).
+Until then the day is recomputed on each call.
+
+The projection is
+
+    expected = month_to_date + mean * remaining_days
+
+where mean and std are taken over the last HISTORY_DAYS closed days with
+readings (crossing into the previous month early on). The band is the
+BAND_Z (80 %) interval of a sum of `remaining` independent days plus the
+uncertainty of the mean; its low end never drops below month-to-date.
+Without closed days to learn from, today's rate is extrapolated once at
+least MIN_ELAPSED_HOURS of the day have passed; before that the
+projection figures are None ("insufficient history").
+Bills are the slab tariff (billing.RATES) applied to each figure.
+
+After repairing readings (energy.py), drop the stored baselines. A reset
+bumps a generation counter kept in the same collection; running
+dashboards check it at most every GENERATION_CHECK_SECONDS and drop their
+in-memory baselines when it changed, so they need no restart.
+
+    python projection.py reset --all
+    python projection.py show bf190540abb03010c9ukey
+    python projection.py show --fleet
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import calendar
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from helpers import dhaka_tz, load_devices
+from billing import _tier_cost, _utc_naive, map_devices
+from tuya_api_mongo import (energy_sum, find_docs, insert_docs_once, get_named_collection,
+                            iter_reading_chunks, latest_states)
+
+COLLECTION = "daily_baselines"
+HISTORY_DAYS = int(os.getenv("PROJECTION_HISTORY_DAYS", "28"))
+SETTLE_SECONDS = int(os.getenv("PROJECTION_SETTLE_SECONDS", "7200"))
+STALE_SETTLE_DAYS = 7
+MIN_ELAPSED_HOURS = 1.0
+GENERATION_CHECK_SECONDS = 60
+GENERATION_ID = "generation"
+BAND_Z = 1.28  # two-sided 80 %
+
+# (device_id, "YYYY-MM-DD") -> (kwh, samples) of settled days
+_baselines = {}
+_generation = {"n": None, "checked": 0.0}
+
+
+def _day_start(day) -> datetime:
+    """Naive UTC start of a Dhaka calendar day."""
+    return _utc_naive(datetime(day.year, day.month, day.day, tzinfo=dhaka_tz))
+
+
+# ---------- Baselines ----------
+def _check_generation():
+    """Drop the in-memory baselines when a reset happened elsewhere."""
+    if time.monotonic() - _generation["checked"] < GENERATION_CHECK_SECONDS:
+        return
+    doc = find_docs(COLLECTION, [GENERATION_ID], {"n": 1}).get(GENERATION_ID)
+    n = (doc or {}).get("n", 0)
+    if n != _generation["n"]:
+        _baselines.clear()
+    _generation.update(n=n, checked=time.monotonic())
+
+def closed_days(device_id: str, first_day, last_day, now: datetime = None) -> dict:
+    """{YYYY-MM-DD: (kWh, samples)} for the Dhaka days first_day..last_day.
+    Cached and stored days cost nothing; the rest come from one aggregation."""
+    now = now or datetime.now(timezone.utc)
+    days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+    out = {d.isoformat(): _baselines.get((device_id, d.isoformat())) for d in days}
+
+    missing = [k for k, v in out.items() if v is None]
+    if missing:
+        stored = find_docs(COLLECTION, [f"{device_id}:{k}" for k in missing], {"kwh": 1, "samples": 1, "day": 1})
+        for doc in stored.values():
+            out[doc["day"]] = _baselines[(device_id, doc["day"])] = (doc["kwh"], doc["samples"])
+        missing = [k for k, v in out.items() if v is None]
+    if not missing:
+        return out
+
+    lo = datetime.strptime(missing[0], "%Y-%m-%d").date()
+    hi = datetime.strptime(missing[-1], "%Y-%m-%d").date() + timedelta(days=1)
+    fresh = dict.fromkeys(missing, (0.0, 0))
+    for chunk in iter_reading_chunks(device_id, _day_start(lo), _day_start(hi) - timedelta(microseconds=1),
+                                     resolution_s=86400):
+        for b in chunk:
+            day = (b["timestamp"] + timedelta(hours=6)).date().isoformat()  # bucket start, Dhaka midnight
+            if day in fresh:
+                fresh[day] = (float(b.get("energy_kWh") or 0.0), int(b.get("samples") or 0))
+
+    settled = _utc_naive(now) - timedelta(seconds=SETTLE_SECONDS)
+    drained = (latest_states([device_id]).get(device_id) or {}).get("timestamp")
+    if drained is not None and drained.tzinfo is not None:
+        drained = _utc_naive(drained)
+    docs = []
+    for k, v in fresh.items():
+        out[k] = v
+        end = _day_start(datetime.strptime(k, "%Y-%m-%d").date() + timedelta(days=1))
+        if end <= settled and ((drained is not None and drained >= end)
+                               or end <= settled - timedelta(days=STALE_SETTLE_DAYS)):
+            _baselines[(device_id, k)] = v
+            docs.append({"_id": f"{device_id}:{k}", "device_id": device_id, "day": k,
+                         "kwh": v[0], "samples": v[1]})
+    insert_docs_once(COLLECTION, docs)
+    return out
+
+def reset_baselines(device_ids=None) -> int:
+    """Forget stored baselines (all, or of `device_ids`); they are rebuilt
+    on the next projection. Returns how many documents were removed."""
+    for key in [k for k in _baselines if device_ids is None or k[0] in device_ids]:
+        del _baselines[key]
+    coll = get_named_collection(COLLECTION)
+    if coll is None:
+        return 0
+    match = {"device_id": {"$exists": True} if device_ids is None else {"$in": list(device_ids)}}
+    removed = coll.delete_many(match).deleted_count
+    coll.update_one({"_id": GENERATION_ID}, {"$inc": {"n": 1}}, upsert=True)
+    return removed
+
+
+# ---------- Projection ----------
+def _window(now: datetime):
+    """(today, first day of the month, first history day) in Dhaka."""
+    today = now.astimezone(dhaka_tz).date()
+    month_start = today.replace(day=1)
+    return today, month_start, min(month_start, today - timedelta(days=HISTORY_DAYS))
+
+def _project(daily: dict, today_kwh: float, now: datetime) -> dict:
+    today, month_start, _ = _window(now)
+    hist = [kwh for day, (kwh, n) in sorted(daily.items())[-HISTORY_DAYS:] if n]
+    mtd = sum(kwh for day, (kwh, _) in daily.items() if day >= month_start.isoformat()) + today_kwh
+
+    elapsed = (_utc_naive(now) - _day_start(today)).total_seconds() / 86400
+    remaining = calendar.monthrange(today.year, today.month)[1] - (today.day - 1) - elapsed
+    n = len(hist)
+    out = {"mtd_kwh": round(mtd, 4), "today_kwh": round(today_kwh, 4), "mtd_bdt": _tier_cost(mtd),
+           "history_days": n, "days_remaining": round(remaining, 2)}
+    if n:
+        mean = sum(hist) / n
+        std = math.sqrt(sum((x - mean) ** 2 for x in hist) / (n - 1)) if n > 1 else mean
+    elif elapsed * 24 >= MIN_ELAPSED_HOURS:
+        # no history yet: extrapolate today's rate, with a wide band
+        mean = std = today_kwh / elapsed
+    else:
+        # minutes into the first day: any rate would be noise
+        return dict(out, expected_kwh=None, low_kwh=None, high_kwh=None, expected_bdt=None,
+                    low_bdt=None, high_bdt=None, daily_mean_kwh=None, daily_std_kwh=None)
+    band = BAND_Z * std * math.sqrt(remaining + remaining ** 2 / max(n, 1))
+
+    expected = mtd + mean * remaining
+    low, high = max(mtd, expected - band), expected + band
+    return dict(out, expected_kwh=round(expected, 3), low_kwh=round(low, 3), high_kwh=round(high, 3),
+                expected_bdt=_tier_cost(expected), low_bdt=_tier_cost(low), high_bdt=_tier_cost(high),
+                daily_mean_kwh=round(mean, 4), daily_std_kwh=round(std, 4))
+
+def _device_inputs(device_id: str, now: datetime, today_kwh: float = None):
+    today, _, first = _window(now)
+    daily = closed_days(device_id, first, today - timedelta(days=1), now) if first < today else {}
+    if today_kwh is None:
+        today_kwh = energy_sum(device_id, _day_start(today), _utc_naive(now))
+    return daily, today_kwh
+
+def project_device(device_id: str, today_kwh: float = None, now: datetime = None) -> dict:
+    """Month-end projection for one device. Pass `today_kwh` when it is
+    already known to skip the only query."""
+    now = now or datetime.now(timezone.utc)
+    _check_generation()
+    return _project(*_device_inputs(device_id, now, today_kwh), now)
+
+def project_fleet(device_ids: list = None, now: datetime = None, today_kwh: dict = None) -> dict:
+    """{"fleet": projection of the summed daily series, "devices": {id: projection}}.
+    `today_kwh` ({device_id: kWh}) skips the query for the devices in it."""
+    now = now or datetime.now(timezone.utc)
+    _check_generation()
+    ids = list(device_ids or [d["id"] for d in load_devices() if d.get("id")])
+    today_kwh = today_kwh or {}
+    inputs = map_devices(lambda did: _device_inputs(did, now, today_kwh.get(did)), ids)
+    total, today_total = {}, 0.0
+    for daily, today_kwh in inputs:
+        today_total += today_kwh
+        for day, (kwh, n) in daily.items():
+            k, s = total.get(day, (0.0, 0))
+            total[day] = (k + kwh, s + n)
+    return {"fleet": _project(total, today_total, now),
+            "devices": {did: _project(daily, t, now) for did, (daily, t) in zip(ids, inputs)}}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Month-end kWh and bill projection")
+    sub = ap.add_subparsers(dest="action", required=True)
+    p = sub.add_parser("show", help="print projections as JSON")
+    p.add_argument("device", nargs="?")
+    p.add_argument("--fleet", action="store_true")
+    p = sub.add_parser("reset", help="drop stored daily baselines (after repairing readings)")
+    who = p.add_mutually_exclusive_group(required=True)
+    who.add_argument("--device", action="append")
+    who.add_argument("--all", action="store_true")
+    args = ap.parse_args(argv)
+
+    if args.action == "reset":
+        print(f"[projection] removed {reset_baselines(args.device)} baseline(s)")
+        return
+    if not args.device and not args.fleet:
+        ap.error("give a device id or --fleet")
+    out = project_fleet() if args.fleet else project_device(args.device)
+    json.dump(out, sys.stdout, indent=1)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+ringbuf.py
+----------
+Shared-memory ring buffer of recent readings, written by the collector and
+read by the dashboard without touching MongoDB.
+
+The buffer is one memory-mapped file (under /dev/shm when available) laid
+out as NumPy arrays:
+
+    header      magic, max_devices, slots, period
+    directory   max_devices x (device_id, seq, head, count)
+    data        max_devices x slots x (epoch_s, voltage, current, power)
+
+Each device owns one row of `data` holding its last `slots` readings
+(RING_HOURS at the collector interval). Writers follow a seqlock per
+device: bump `seq` to odd, write the sample and advance `head`/`count`,
+bump `seq` to even. Readers snapshot `seq`, read, and retry if it was odd
+or changed, so they never see a half-written sample and never block the
+collector. Readers map the file directly; only the requested window is
+copied out under the seqlock.
+
+`period` is the collector's measured cycle period (its interval, or
+longer when cycles overrun), updated after every cycle, so readers can
+tell a stalled collector from a slow one.
+
+Several collector processes on one host can share the file: the directory
+slot for a new device is claimed under an flock.
+"""
+
+import os
+import time
+import fcntl
+import tempfile
+
+import numpy as np
+
+RING_HOURS = float(os.getenv("RING_HOURS", "6"))
+RING_INTERVAL_SECONDS = 10
+RING_MAX_DEVICES = int(os.getenv("RING_MAX_DEVICES", "512"))
+RING_PATH = os.getenv("RING_PATH") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "tuya_ring.bin")
+
+MAGIC = b"TUYARNG2"
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("max_devices", "<u4"), ("slots", "<u4"), ("period", "<f8")])
+DIR_DTYPE = np.dtype([("device_id", "S64"), ("seq", "<u8"), ("head", "<u8"), ("count", "<u8")])
+FIELDS = ("ts", "voltage", "current", "power")
+READ_RETRIES = 50
+
+
+def _layout(max_devices: int, slots: int):
+    dir_off = 64  # header padded to a cache line
+    data_off = dir_off + DIR_DTYPE.itemsize * max_devices
+    data_off += (-data_off) % 64
+    size = data_off + 8 * len(FIELDS) * max_devices * slots
+    return dir_off, data_off, size
+
+
+class _Ring:
+    def _map(self, mode: str):
+        self._mm = np.memmap(self.path, dtype=np.uint8, mode=mode)
+        self._header = np.ndarray((1,), HEADER_DTYPE, buffer=self._mm, offset=0)
+        hdr = self._header[0]
+        if hdr["magic"] != MAGIC:
+            raise ValueError(f"{self.path} is not a ring buffer")
+        self.max_devices, self.slots = int(hdr["max_devices"]), int(hdr["slots"])
+        dir_off, data_off, _ = _layout(self.max_devices, self.slots)
+        self.directory = np.ndarray((self.max_devices,), DIR_DTYPE, buffer=self._mm, offset=dir_off)
+        self.data = np.ndarray((self.max_devices, self.slots, len(FIELDS)), np.float64,
+                               buffer=self._mm, offset=data_off)
+        self._ino = os.stat(self.path).st_ino
+        self._index = {}
+
+    def _find(self, device_id: str):
+        idx = self._index.get(device_id)
+        if idx is not None:
+            return idx
+        key = device_id.encode("utf-8")[:64]
+        hits = np.nonzero(self.directory["device_id"] == key)[0]
+        if len(hits):
+            self._index[device_id] = int(hits[0])
+            return int(hits[0])
+        return None
+
+
+class RingWriter(_Ring):
+    def __init__(self, path: str = RING_PATH, max_devices: int = RING_MAX_DEVICES,
+                 hours: float = RING_HOURS, interval: int = RING_INTERVAL_SECONDS):
+        self.path = path
+        self.interval = interval
+        slots = max(1, int(hours * 3600 / interval))
+        with open(path + ".lock", "a") as lk:
+            fcntl.flock(lk, fcntl.LOCK_EX)
+            try:
+                if not self._compatible(max_devices, slots):
+                    self._create(max_devices, slots)
+            finally:
+                fcntl.flock(lk, fcntl.LOCK_UN)
+        self._map("r+")
+
+    def _compatible(self, max_devices, slots) -> bool:
+        try:
+            with open(self.path, "rb") as f:
+                hdr = np.frombuffer(f.read(HEADER_DTYPE.itemsize), HEADER_DTYPE)[0]
+            return hdr["magic"] == MAGIC and hdr["max_devices"] == max_devices and hdr["slots"] == slots
+        except (OSError, IndexError, ValueError):
+            return False
+
+    def _create(self, max_devices, slots):
+        _, _, size = _layout(max_devices, slots)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.truncate(size)
+            f.write(np.array([(MAGIC, max_devices, slots, self.interval)], HEADER_DTYPE).tobytes())
+        os.replace(tmp, self.path)  # readers of an old file notice the new inode
+
+    def _claim(self, device_id: str):
+        with open(self.path + ".lock", "a") as lk:
+            fcntl.flock(lk, fcntl.LOCK_EX)
+            try:
+                self._index.pop(device_id, None)
+                idx = self._find(device_id)
+                if idx is None:
+                    free = np.nonzero(self.directory["device_id"] == b"")[0]
+                    if not len(free):
+                        return None
+                    idx = int(free[0])
+                    entry = self.directory[idx:idx + 1]
+                    entry["seq"], entry["head"], entry["count"] = 0, 0, 0
+                    entry["device_id"] = device_id.encode("utf-8")[:64]
+                    self._index[device_id] = idx
+                return idx
+            finally:
+                fcntl.flock(lk, fcntl.LOCK_UN)
+
+    def publish(self, device_id: str, ts: float, voltage: float, current: float, power: float) -> bool:
+        """Append one sample; False when the directory is full."""
+        idx = self._find(device_id)
+        if idx is None:
+            idx = self._claim(device_id)
+            if idx is None:
+                return False
+        entry = self.directory[idx:idx + 1]
+        seq = int(entry["seq"][0])
+        entry["seq"] = seq + 1                      # odd: write in progress
+        head = int(entry["head"][0])
+        self.data[idx, head] = (ts, voltage, current, power)
+        entry["head"] = (head + 1) % self.slots
+        entry["count"] = min(int(entry["count"][0]) + 1, self.slots)
+        entry["seq"] = seq + 2                      # even: consistent again
+        return True
+
+    def set_period(self, seconds: float):
+        """Record the last cycle's period (at least the interval)."""
+        self._header["period"] = max(float(seconds), self.interval)
+
+    def publish_doc(self, device_id: str, doc: dict) -> bool:
+        ts = doc.get("timestamp")
+        ts = ts.timestamp() if hasattr(ts, "timestamp") else time.time()
+        return self.publish(device_id, ts, float(doc.get("voltage") or 0.0),
+                            float(doc.get("current") or 0.0), float(doc.get("power") or 0.0))
+
+
+class RingReader(_Ring):
+    """Read-only view; returns None/empty when the device is not in the ring."""
+
+    def __init__(self, path: str = RING_PATH):
+        self.path = path
+        self._map("r")
+
+    def _refresh(self):
+        # The collector recreates the file when its size settings change
+        try:
+            if os.stat(self.path).st_ino != self._ino:
+                self._map("r")
+        except OSError:
+            pass
+
+    def _read(self, device_id: str, n: int):
+        self._refresh()
+        idx = self._find(device_id)
+        if idx is None:
+            return None
+        entry = self.directory[idx:idx + 1]
+        for _ in range(READ_RETRIES):
+            s1 = int(entry["seq"][0])
+            if s1 & 1:
+                time.sleep(0)
+                continue
+            head, count = int(entry["head"][0]), int(entry["count"][0])
+            k = min(n, count)
+            rows = np.take(self.data[idx], np.arange(head - k, head) % self.slots, axis=0)
+            if int(entry["seq"][0]) == s1:
+                return rows
+        return None
+
+    @property
+    def period(self) -> float:
+        """Collector cycle period in seconds, as last published."""
+        self._refresh()
+        return float(self._header["period"][0]) or RING_INTERVAL_SECONDS
+
+    def latest(self, device_id: str):
+        """dict(ts, voltage, current, power) of the newest sample, or None."""
+        rows = self._read(device_id, 1)
+        if rows is None or not len(rows):
+            return None
+        return dict(zip(FIELDS, (float(x) for x in rows[-1])))
+
+    def window(self, device_id: str, seconds: float):
+        """(n, 4) array of samples from the last `seconds`, oldest first."""
+        n = int(seconds / RING_INTERVAL_SECONDS) + 2
+        rows = self._read(device_id, n)
+        if rows is None or not len(rows):
+            return np.empty((0, len(FIELDS)))
+        return rows[rows[:, 0] >= rows[-1, 0] - seconds]
+
+
+def open_reader(path: str = RING_PATH):
+    """RingReader if the collector has created the ring, else None."""
+    try:
+        return RingReader(path)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,265 @@
+"""
+sharding.py
+-----------
+Lease-based device ownership for running several collectors at once.
+
+- Devices are hashed into a fixed number of partitions
+- Live workers are placed on a consistent-hash ring; each partition has
+  one desired owner
+- A worker only collects a partition while it holds the lease for it.
+  Leases expire unless renewed, so a dead worker's partitions are picked
+  up by the survivors and a new worker takes its share once the current
+  owner lets go
+- Leases are renewed every TTL/3 by a background thread, independent of
+  how long a collection cycle takes; a partition whose renewal has not
+  succeeded for 2/3 of the TTL is treated as lost until the next renewal
+
+Leases live in MongoDB (collections `collector_workers` and
+`collector_leases`) or, when MONGODB_URI is not set, in a local JSON file
+guarded by flock, which is enough for several processes on one box.
+
+Lease expiry compares wall clocks, so nodes must keep their clocks in sync
+(NTP) to within a fraction of COLLECTOR_LEASE_TTL.
+"""
+
+import os
+import json
+import time
+import bisect
+import fcntl
+import hashlib
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+
+from tuya_api_mongo import get_named_collection
+
+PARTITIONS = int(os.getenv("COLLECTOR_PARTITIONS", "64"))
+LEASE_TTL_SECONDS = int(os.getenv("COLLECTOR_LEASE_TTL", "30"))
+LEASE_FILE = os.getenv("COLLECTOR_LEASE_FILE", ".collector_leases.json")
+VNODES = 64
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest(), 16)
+
+def partition_for(device_id: str, partitions: int = PARTITIONS) -> int:
+    return _hash(device_id) % partitions
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes so load spreads evenly and
+    adding/removing one worker only moves ~1/N of the partitions."""
+
+    def __init__(self, workers, vnodes: int = VNODES):
+        self._points = sorted(
+            (_hash(f"{w}#{i}"), w) for w in workers for i in range(vnodes)
+        )
+        self._keys = [h for h, _ in self._points]
+
+    def owner(self, partition: int):
+        if not self._points:
+            return None
+        i = bisect.bisect(self._keys, _hash(f"partition-{partition}")) % len(self._keys)
+        return self._points[i][1]
+
+
+# ---------- Lease stores ----------
+class MongoLeaseStore:
+    def __init__(self):
+        self.workers = get_named_collection("collector_workers")
+        self.leases = get_named_collection("collector_leases")
+        if self.workers is None or self.leases is None:
+            raise RuntimeError("MongoDB is not configured (MONGODB_URI)")
+
+    def heartbeat(self, worker_id: str, ttl: int):
+        now = datetime.now(timezone.utc)
+        self.workers.update_one(
+            {"_id": worker_id},
+            {"$set": {"heartbeat": now, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True,
+        )
+
+    def live_workers(self):
+        now = datetime.now(timezone.utc)
+        return sorted(d["_id"] for d in self.workers.find({"expires_at": {"$gt": now}}, {"_id": 1}))
+
+    def acquire(self, partition: int, worker_id: str, ttl: int) -> bool:
+        """Take or renew the lease; False if another live worker holds it."""
+        from pymongo.errors import DuplicateKeyError
+        now = datetime.now(timezone.utc)
+        q = {"_id": partition, "$or": [
+            {"owner": worker_id}, {"owner": None}, {"expires_at": {"$lt": now}},
+        ]}
+        try:
+            self.leases.update_one(
+                q, {"$set": {"owner": worker_id, "expires_at": now + timedelta(seconds=ttl)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            # Upsert tried to insert an existing _id: someone else holds it
+            return False
+
+    def release(self, partition: int, worker_id: str):
+        self.leases.update_one(
+            {"_id": partition, "owner": worker_id},
+            {"$set": {"owner": None, "expires_at": datetime.now(timezone.utc)}},
+        )
+
+    def retire(self, worker_id: str):
+        self.leases.update_many(
+            {"owner": worker_id},
+            {"$set": {"owner": None, "expires_at": datetime.now(timezone.utc)}},
+        )
+        self.workers.delete_one({"_id": worker_id})
+
+
+class FileLeaseStore:
+    """Same contract as MongoLeaseStore, backed by one flock'ed JSON file."""
+
+    def __init__(self, path: str = LEASE_FILE):
+        self.path = path
+
+    def _update(self, fn):
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                state = json.loads(raw) if raw.strip() else {}
+                state.setdefault("workers", {})
+                state.setdefault("leases", {})
+                result = fn(state, time.time())
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def heartbeat(self, worker_id: str, ttl: int):
+        def fn(state, now):
+            state["workers"][worker_id] = now + ttl
+        self._update(fn)
+
+    def live_workers(self):
+        def fn(state, now):
+            state["workers"] = {w: exp for w, exp in state["workers"].items() if exp > now}
+            return sorted(state["workers"])
+        return self._update(fn)
+
+    def acquire(self, partition: int, worker_id: str, ttl: int) -> bool:
+        def fn(state, now):
+            lease = state["leases"].get(str(partition))
+            if lease and lease["owner"] not in (None, worker_id) and lease["expires_at"] > now:
+                return False
+            state["leases"][str(partition)] = {"owner": worker_id, "expires_at": now + ttl}
+            return True
+        return self._update(fn)
+
+    def release(self, partition: int, worker_id: str):
+        def fn(state, now):
+            lease = state["leases"].get(str(partition))
+            if lease and lease["owner"] == worker_id:
+                state["leases"][str(partition)] = {"owner": None, "expires_at": now}
+        self._update(fn)
+
+    def retire(self, worker_id: str):
+        def fn(state, now):
+            for p, lease in state["leases"].items():
+                if lease["owner"] == worker_id:
+                    state["leases"][p] = {"owner": None, "expires_at": now}
+            state["workers"].pop(worker_id, None)
+        self._update(fn)
+
+
+def default_store():
+    if os.getenv("MONGODB_URI"):
+        return MongoLeaseStore()
+    return FileLeaseStore()
+
+
+# ---------- Worker membership ----------
+class ShardMember:
+    """One collector's view of the cluster. Call `rebalance()` once per
+    cycle; it heartbeats, gives up partitions that moved to another
+    worker, and claims/renews the ones this worker should own. Between
+    cycles `start_renewal()` keeps heartbeat and leases fresh."""
+
+    def __init__(self, store, worker_id: str = None,
+                 partitions: int = PARTITIONS, ttl: int = LEASE_TTL_SECONDS):
+        self.store = store
+        self.worker_id = worker_id or default_worker_id()
+        self.partitions = partitions
+        self.ttl = ttl
+        self.owned = set()
+        self._valid_until = {}  # partition -> monotonic time the lease is trusted until
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def _claim(self, partitions) -> set:
+        t0 = time.monotonic()
+        got = {p for p in partitions if self.store.acquire(p, self.worker_id, self.ttl)}
+        for p in got:
+            # leave a third of the TTL as margin for clock skew and slow calls
+            self._valid_until[p] = t0 + self.ttl * 2 / 3
+        return got
+
+    def rebalance(self) -> set:
+        with self._lock:
+            self.store.heartbeat(self.worker_id, self.ttl)
+            live = self.store.live_workers()
+            if self.worker_id not in live:
+                live.append(self.worker_id)
+            ring = HashRing(live)
+            desired = {p for p in range(self.partitions) if ring.owner(p) == self.worker_id}
+
+            for p in self.owned - desired:
+                self.store.release(p, self.worker_id)
+            self.owned = self._claim(desired)
+            return self.owned
+
+    def renew(self) -> set:
+        """Heartbeat and extend the leases already held; partitions taken
+        over by another worker are dropped."""
+        with self._lock:
+            self.store.heartbeat(self.worker_id, self.ttl)
+            self.owned = self._claim(self.owned)
+            return self.owned
+
+    def start_renewal(self, interval: float = None, on_error=None):
+        """Renew leases every `interval` seconds (default TTL/3) on a
+        daemon thread until `leave()`. A failed renewal is passed to
+        `on_error(exc)`; the leases then lapse on their own and owns()
+        stops trusting them."""
+        interval = interval or self.ttl / 3
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.renew()
+                except Exception as e:
+                    if on_error is not None:
+                        on_error(e)
+
+        self._stop.clear()
+        self._renewer = threading.Thread(target=loop, name="lease-renewal", daemon=True)
+        self._renewer.start()
+
+    def owns(self, device_id: str) -> bool:
+        p = partition_for(device_id, self.partitions)
+        return p in self.owned and time.monotonic() < self._valid_until.get(p, 0.0)
+
+    def leave(self):
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join(timeout=5)
+        with self._lock:
+            self.store.retire(self.worker_id)
+            self.owned = set()
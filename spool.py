@@ -0,0 +1,281 @@
+"""
+spool.py
+--------
+Durable on-disk spool between the collector and MongoDB.
+
+The collector appends each reading to an append-only segment file and
+moves on; a background Drainer replays the spool into the store in bulk.
+A slow or unreachable MongoDB therefore never stalls collection, and
+readings taken during an outage are stored once it comes back.
+
+Layout of a spool directory:
+    LOCK                      flock held by the owning process
+    seg-000000000001.log      JSON lines: {"d": device_id, "t": spooled_at, "doc": {...}}
+    seg-000000000002.log
+    checkpoint.json           {"segment": n, "offset": bytes} already drained
+
+- Appends are flushed and fsync'ed in batches (every FSYNC_EVERY records
+  or FSYNC_INTERVAL seconds, whichever comes first), and the collector
+  calls sync() at the end of every cycle, so a crash loses at most that
+  window and never the tail of a cycle that already finished.
+- Every spooled reading gets a deterministic _id "<device>:<epoch ms>", so
+  replaying a batch twice (crash between insert and checkpoint) is a no-op.
+- Segments rotate at SEGMENT_BYTES and are deleted once fully drained.
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from datetime import datetime
+
+from metrics import counter, gauge, histogram
+from tuya_api_mongo import insert_readings_bulk, upsert_latest_states
+
+SPOOL_DIR = os.getenv("COLLECTOR_SPOOL_DIR", "spool")
+SEGMENT_BYTES = 8 * 1024 * 1024
+FSYNC_EVERY = 200
+FSYNC_INTERVAL = 1.0
+DRAIN_BATCH = 2000
+DRAIN_INTERVAL = 1.0
+MAX_BACKOFF = 30.0
+
+log = logging.getLogger("spool")
+
+SPOOL_DEPTH = gauge("spool_depth_records", "Readings spooled but not yet stored")
+SPOOL_LAG = gauge("spool_lag_seconds", "Age of the oldest undrained reading")
+SPOOL_APPENDS = counter("spool_appended_total", "Readings appended to the spool")
+SPOOL_DRAINED = counter("spool_drained_total", "Readings replayed into the store")
+SPOOL_DRAIN_ERRORS = counter("spool_drain_errors_total", "Failed drain batches")
+SPOOL_DRAIN_SECONDS = histogram("spool_drain_batch_seconds", "Time to store one drained batch")
+
+
+def reading_id(device_id: str, ts: datetime) -> str:
+    return f"{device_id}:{int(ts.timestamp() * 1000)}"
+
+def _encode(doc: dict) -> dict:
+    return {k: {"$date": v.isoformat()} if isinstance(v, datetime) else v for k, v in doc.items()}
+
+def _decode(doc: dict) -> dict:
+    return {k: datetime.fromisoformat(v["$date"]) if isinstance(v, dict) and "$date" in v else v
+            for k, v in doc.items()}
+
+def _seg_name(n: int) -> str:
+    return f"seg-{n:012d}.log"
+
+
+class Spool:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, "LOCK"), "a")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)  # raises if taken
+
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        segs = self.segments()
+        # Always start a fresh segment: the tail of the last one may be torn
+        self._seg = (segs[-1] + 1) if segs else 1
+        self._fh = open(os.path.join(path, _seg_name(self._seg)), "ab")
+        self._depth = self._count_undrained()
+        SPOOL_DEPTH.set(self._depth)
+
+    @classmethod
+    def open_slot(cls, root: str = SPOOL_DIR):
+        """Open the first spool slot under `root` no other process holds, so
+        a restarted collector picks up what its predecessor left behind."""
+        i = 0
+        while True:
+            try:
+                return cls(os.path.join(root, f"slot-{i}"))
+            except BlockingIOError:
+                i += 1
+
+    # ---------- writer side ----------
+    def append(self, device_id: str, doc: dict) -> bool:
+        doc = dict(doc)
+        doc.setdefault("_id", reading_id(device_id, doc["timestamp"]))
+        line = json.dumps({"d": device_id, "t": time.time(), "doc": _encode(doc)}) + "\n"
+        with self._lock:
+            self._fh.write(line.encode("utf-8"))
+            self._unsynced += 1
+            self._depth += 1
+            if self._fh.tell() >= SEGMENT_BYTES:
+                self._sync_locked()
+                self._fh.close()
+                self._seg += 1
+                self._fh = open(os.path.join(self.path, _seg_name(self._seg)), "ab")
+            elif (self._unsynced >= FSYNC_EVERY
+                  or time.monotonic() - self._last_sync >= FSYNC_INTERVAL):
+                self._sync_locked()
+        SPOOL_APPENDS.inc()
+        SPOOL_DEPTH.set(self._depth)
+        return True
+
+    def _sync_locked(self):
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self):
+        with self._lock:
+            if self._unsynced:
+                self._sync_locked()
+
+    def close(self):
+        with self._lock:
+            self._sync_locked()
+            self._fh.close()
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+
+    # ---------- reader side ----------
+    def segments(self):
+        return sorted(int(f[4:16]) for f in os.listdir(self.path)
+                      if f.startswith("seg-") and f.endswith(".log"))
+
+    def _checkpoint_path(self):
+        return os.path.join(self.path, "checkpoint.json")
+
+    def checkpoint(self):
+        try:
+            with open(self._checkpoint_path()) as f:
+                cp = json.load(f)
+            return int(cp["segment"]), int(cp["offset"])
+        except (OSError, ValueError, KeyError):
+            segs = self.segments()
+            return (segs[0] if segs else 1), 0
+
+    def commit(self, segment: int, offset: int, drained: int):
+        tmp = self._checkpoint_path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._checkpoint_path())
+        for seg in self.segments():
+            if seg < segment:
+                os.remove(os.path.join(self.path, _seg_name(seg)))
+        with self._lock:
+            self._depth = max(0, self._depth - drained)
+        SPOOL_DEPTH.set(self._depth)
+
+    def read_batch(self, limit: int = DRAIN_BATCH):
+        """Up to `limit` undrained records plus the (segment, offset) to
+        commit once they are stored."""
+        with self._lock:
+            self._fh.flush()  # make buffered appends visible to the reader
+            active = self._seg
+        seg, offset = self.checkpoint()
+        records = []
+        for s in self.segments():
+            if s < seg:
+                continue
+            start = offset if s == seg else 0
+            with open(os.path.join(self.path, _seg_name(s)), "rb") as f:
+                f.seek(start)
+                pos = start
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break  # partial line: still being written, or torn by a crash
+                    pos += len(raw)
+                    try:
+                        records.append(json.loads(raw))
+                    except ValueError:
+                        log.warning("Skipping corrupt spool record in %s", _seg_name(s))
+                    if len(records) >= limit:
+                        return records, (s, pos)
+            if s == active:
+                return records, (s, pos)
+            seg, offset = s + 1, 0  # finished an old segment (any torn tail is dropped)
+        return records, (seg, offset)
+
+    def _count_undrained(self) -> int:
+        n, (seg, offset) = 0, self.checkpoint()
+        for s in self.segments():
+            if s < seg:
+                continue
+            with open(os.path.join(self.path, _seg_name(s)), "rb") as f:
+                f.seek(offset if s == seg else 0)
+                n += sum(1 for raw in f if raw.endswith(b"\n"))
+        return n
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+
+class Drainer(threading.Thread):
+    """Background thread replaying the spool into MongoDB in bulk. Each
+    batch also refreshes the devices' `latest_state` (`latest`)."""
+
+    def __init__(self, spool: Spool, store=insert_readings_bulk, latest=upsert_latest_states):
+        super().__init__(name="spool-drainer", daemon=True)
+        self.spool = spool
+        self.store = store
+        self.latest = latest
+        self._stopping = threading.Event()
+        self._drain_lock = threading.Lock()  # one reader of the checkpoint at a time
+
+    def drain_once(self) -> int:
+        """Store one batch; returns how many readings were drained (0 if
+        the spool is empty), raises if the store rejected the batch."""
+        with self._drain_lock:
+            return self._drain_locked()
+
+    def _drain_locked(self) -> int:
+        records, (seg, offset) = self.spool.read_batch()
+        if not records:
+            if (seg, offset) != self.spool.checkpoint():
+                self.spool.commit(seg, offset, 0)  # skip past a torn tail / drop old segments
+            SPOOL_LAG.set(0)
+            return 0
+        SPOOL_LAG.set(max(0.0, time.time() - records[0]["t"]))
+
+        by_device = {}
+        for r in records:
+            by_device.setdefault(r["d"], []).append(_decode(r["doc"]))
+        with SPOOL_DRAIN_SECONDS.time():
+            for device_id, docs in by_device.items():
+                if not self.store(device_id, docs):
+                    raise RuntimeError(f"store rejected {len(docs)} readings for {device_id}")
+        self.spool.commit(seg, offset, len(records))
+        SPOOL_DRAINED.inc(len(records))
+        if self.latest is not None and not self.latest([d for docs in by_device.values() for d in docs]):
+            log.warning("Could not update latest_state for %d devices", len(by_device))
+        return len(records)
+
+    def run(self):
+        backoff = DRAIN_INTERVAL
+        while not self._stopping.is_set():
+            try:
+                while self.drain_once() >= DRAIN_BATCH and not self._stopping.is_set():
+                    pass  # keep going while there is a backlog
+                backoff = DRAIN_INTERVAL
+            except Exception as e:
+                SPOOL_DRAIN_ERRORS.inc()
+                log.warning("Drain failed (%s), %d readings spooled; retrying in %.0fs",
+                            e, self.spool.depth, backoff)
+                backoff = min(MAX_BACKOFF, backoff * 2)
+            self._stopping.wait(backoff)
+
+    def stop(self, timeout: float = 10.0):
+        """Stop the thread, then try to flush what is left for `timeout` s.
+        If the thread is still stuck in a slow store, leave the rest in the
+        spool for the next start."""
+        self._stopping.set()
+        self.join(timeout)
+        if self.is_alive():
+            log.warning("Drainer still busy after %.0fs; %d readings stay spooled", timeout, self.spool.depth)
+            return
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if self.drain_once() == 0:
+                    return
+            except Exception:
+                return
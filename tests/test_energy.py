@@ -0,0 +1,82 @@
+from datetime import datetime, timezone
+
+import energy
+from energy import DeviceIntegrator
+
+
+def _run(scales, samples_per_advance=6):
+    """10 s samples at 360 W; the meter advances every minute by the
+    integrated energy divided by scales[k] for interval k. Yields
+    (booked, meter delta, integrator) after each meter advance."""
+    integ = DeviceIntegrator()
+    meter = start = 100.0
+    integ.step(0.0, 360.0, meter)
+    booked, t = 0.0, 0.0
+    for scale in scales:
+        for i in range(1, samples_per_advance + 1):
+            t += 10.0
+            if i == samples_per_advance:
+                meter += 360.0 * 10 * samples_per_advance / 3600 / 1000 / scale
+            booked += integ.step(t, 360.0, meter)
+        yield booked, meter - start, integ
+
+
+def test_booked_energy_matches_meter_below_and_above():
+    # integration below the meter, then above, then below again
+    scales = [0.5, 0.8, 1.0, 1.5, 2.0, 0.4, 0.5, 0.5]
+    for booked, delta, integ in _run(scales):
+        # anything booked beyond the meter is carried as positive debt
+        assert integ.pending >= 0.0
+        assert abs(booked - integ.pending - delta) < 1e-12
+    assert integ.pending == 0.0
+    assert abs(booked - delta) < 1e-12
+
+
+def test_persistent_overshoot_does_not_drift():
+    per_interval = 360.0 * 60 / 3600 / 1000
+    for scale in (1.5, 2.0):
+        for booked, delta, integ in _run([scale] * 50):
+            assert abs(booked - integ.pending - delta) < 1e-12
+            assert booked - delta <= per_interval
+
+
+def test_overshoot_is_repaid_by_next_advance():
+    integ = DeviceIntegrator()
+    integ.step(0.0, 0.0, 10.0)
+    booked = integ.step(60.0, 7200.0, 10.0)       # 0.06 kWh integrated, meter still
+    booked += integ.step(120.0, 7200.0, 10.03)    # meter +0.03 after 0.12 kWh integrated
+    assert abs(booked - 0.06) < 1e-12 and abs(integ.pending - 0.03) < 1e-12
+    booked += integ.step(180.0, 0.0, 10.2)        # meter +0.17
+    assert abs(booked - 0.2) < 1e-12
+
+
+def test_unreadable_snapshots_are_not_replaced(monkeypatch):
+    saved = {}
+    monkeypatch.setattr(energy, "save_device_states", lambda kind, states: saved.update(states) or True)
+    monkeypatch.setattr(energy, "load_device_states", lambda kind, ids: None)
+    integ = energy.EnergyIntegrator()
+    integ.ensure_loaded(["dev1"])
+    assert integ.update("dev1", datetime(2025, 10, 1, tzinfo=timezone.utc), 100.0, 5.0) == 0.0
+    integ.flush(force=True)
+    assert "dev1" not in saved
+
+
+def test_restart_resumes_from_newer_stored_reading(monkeypatch):
+    snapshot = {"ts": 1000.0, "power": 360.0, "meter": 5.0, "pending": 0.001, "debt": 0.0}
+    monkeypatch.setattr(energy, "load_device_states", lambda kind, ids: {"dev1": snapshot})
+    # the process crashed after storing a reading at t=1010 but before snapshotting it
+    monkeypatch.setattr(energy, "latest_states", lambda ids: {
+        "dev1": {"timestamp": datetime.fromtimestamp(1010.0, timezone.utc).replace(tzinfo=None), "power": 360.0}})
+    integ = energy.EnergyIntegrator()
+    integ.ensure_loaded(["dev1"])
+    e = integ.update("dev1", datetime.fromtimestamp(1020.0, timezone.utc), 360.0, 5.0)
+    assert abs(e - energy.trapezoid_kwh(360.0, 360.0, 10.0)) < 1e-12  # 10 s, not 20 s
+
+
+def test_restart_keeps_snapshot_when_it_is_current(monkeypatch):
+    snapshot = {"ts": 1000.0, "power": 360.0, "meter": 5.0, "pending": 0.001, "debt": 0.0}
+    monkeypatch.setattr(energy, "load_device_states", lambda kind, ids: {"dev1": snapshot})
+    monkeypatch.setattr(energy, "latest_states", lambda ids: {})
+    integ = energy.EnergyIntegrator()
+    integ.ensure_loaded(["dev1"])
+    assert integ.devices["dev1"].to_state() == snapshot
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta, timezone
+
+import live
+from live import LiveDeviceView
+
+
+def test_late_reading_is_counted_after_resync(monkeypatch):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    stored = [{"timestamp": now - timedelta(seconds=5), "energy_kWh": 0.01}]
+    monkeypatch.setattr(live, "readings_since", lambda did, since: [d for d in stored if d["timestamp"] >= since])
+    monkeypatch.setattr(live, "energy_sum", lambda did, lo, hi: 1.0 + sum(
+        d["energy_kWh"] for d in stored if d["timestamp"] <= hi))
+
+    view = LiveDeviceView("dev1", today_kwh=1.0, month_kwh=1.0)
+    assert view.poll() == 1
+    assert view.today_kwh == 1.0          # taken before the view opened: already in the seed
+
+    # a drained spool lands a reading far behind the watermark
+    stored.append({"timestamp": now - timedelta(minutes=30), "energy_kWh": 0.5})
+    view.poll()
+    assert view.today_kwh == 1.0
+
+    monkeypatch.setattr(view, "_resynced", view._resynced - live.RESYNC_SECONDS)
+    view.poll()
+    assert abs(view.today_kwh - 1.51) < 1e-9 and abs(view.month_kwh - 1.51) < 1e-9
+
+    stored.append({"timestamp": datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=1),
+                   "energy_kWh": 0.02})
+    view.poll()
+    assert abs(view.today_kwh - 1.53) < 1e-9
@@ -0,0 +1,35 @@
+from datetime import datetime, timezone
+
+import online_stats
+from online_stats import OnlineAnalytics
+
+READING = {"power": 50.0, "voltage": 230.0, "current": 0.2,
+           "timestamp": datetime(2025, 10, 1, tzinfo=timezone.utc)}
+
+
+def test_unreadable_store_leaves_devices_unloaded(monkeypatch):
+    saved = {}
+    monkeypatch.setattr(online_stats, "save_device_states", lambda kind, states: saved.update(states) or True)
+    monkeypatch.setattr(online_stats, "load_device_states", lambda kind, ids: None)
+    a = OnlineAnalytics()
+    a.ensure_loaded(["dev1"])
+    assert a.update("dev1", READING) is None
+    a.flush(force=True)
+    assert "dev1" not in saved  # the stored snapshot is not overwritten
+
+    # the store is back: the snapshot is restored on the next cycle
+    monkeypatch.setattr(online_stats, "load_device_states",
+                        lambda kind, ids: {"dev1": {"n": 500, "mean": 40.0}})
+    a.ensure_loaded(["dev1"])
+    assert a.update("dev1", READING).n == 501
+
+
+def test_devices_moved_away_are_saved_first(monkeypatch):
+    saved = {}
+    monkeypatch.setattr(online_stats, "save_device_states", lambda kind, states: saved.update(states) or True)
+    monkeypatch.setattr(online_stats, "load_device_states", lambda kind, ids: {})
+    a = OnlineAnalytics()
+    a.ensure_loaded(["dev1", "dev2"])
+    a.update("dev2", READING)
+    a.ensure_loaded(["dev1"])
+    assert saved["dev2"]["n"] == 1 and "dev2" not in a.devices
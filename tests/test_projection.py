@@ -0,0 +1,64 @@
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from billing import _tier_cost
+from helpers import dhaka_tz
+from projection import _project, HISTORY_DAYS
+
+
+def at(y, m, d, hour=0, minute=0):
+    return datetime(y, m, d, hour, minute, tzinfo=dhaka_tz).astimezone(timezone.utc)
+
+def series(last_day: date, kwh, days=HISTORY_DAYS):
+    """{YYYY-MM-DD: (kWh, samples)} for `days` days ending at last_day."""
+    vals = kwh if isinstance(kwh, list) else [kwh] * days
+    return {(last_day - timedelta(days=len(vals) - 1 - i)).isoformat(): (v, 8640)
+            for i, v in enumerate(vals)}
+
+
+def test_constant_history_projects_exactly_with_no_band():
+    # Oct 11, noon: 10 closed October days at 5 kWh, 2.5 kWh so far today
+    p = _project(series(date(2025, 10, 10), 5.0), 2.5, at(2025, 10, 11, 12))
+    assert p["mtd_kwh"] == pytest.approx(52.5)
+    assert p["days_remaining"] == pytest.approx(20.5)
+    assert p["expected_kwh"] == pytest.approx(155.0)
+    assert p["low_kwh"] == p["high_kwh"] == p["expected_kwh"]
+    assert p["expected_bdt"] == _tier_cost(155.0)
+    assert p["history_days"] == HISTORY_DAYS
+
+
+def test_band_widens_with_spread_and_is_clamped_at_month_to_date():
+    steady = _project(series(date(2025, 10, 10), [4.0, 6.0] * 14), 0.0, at(2025, 10, 11, 12))
+    noisy = _project(series(date(2025, 10, 10), [0.0, 10.0] * 14), 0.0, at(2025, 10, 11, 12))
+    assert steady["expected_kwh"] == pytest.approx(noisy["expected_kwh"])
+    assert steady["high_kwh"] - steady["expected_kwh"] < noisy["high_kwh"] - noisy["expected_kwh"]
+    assert steady["low_kwh"] < steady["expected_kwh"] < steady["high_kwh"]
+    # near month end the band is tiny, and low never drops below what is already used
+    wild = _project(series(date(2025, 10, 30), [0.0, 50.0] * 14), 1.0, at(2025, 10, 31, 23, 30))
+    assert wild["low_kwh"] >= wild["mtd_kwh"]
+
+
+def test_month_rollover_counts_only_this_month():
+    # Nov 1, 06:00: the history is all October, month-to-date is today only
+    p = _project(series(date(2025, 10, 31), 5.0), 1.0, at(2025, 11, 1, 6))
+    assert p["mtd_kwh"] == pytest.approx(1.0)
+    assert p["days_remaining"] == pytest.approx(29.75)
+    assert p["expected_kwh"] == pytest.approx(1.0 + 5.0 * 29.75)
+
+
+def test_days_without_readings_are_not_history():
+    daily = series(date(2025, 10, 10), 5.0)
+    daily["2025-10-09"] = (0.0, 0)   # collector down all day
+    p = _project(daily, 0.0, at(2025, 10, 11, 0, 30))
+    assert p["history_days"] == HISTORY_DAYS - 1
+    assert p["daily_mean_kwh"] == pytest.approx(5.0)
+
+
+def test_no_history_needs_an_hour_of_today():
+    early = _project({}, 0.01, at(2025, 10, 11, 0, 1))
+    assert early["expected_kwh"] is None and early["expected_bdt"] is None
+    assert early["mtd_kwh"] == pytest.approx(0.01)
+    later = _project({}, 0.5, at(2025, 10, 11, 6))
+    assert later["daily_mean_kwh"] == pytest.approx(2.0)     # 0.5 kWh in a quarter day
+    assert later["low_kwh"] >= later["mtd_kwh"]
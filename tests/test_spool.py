@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import spool
+from spool import Spool, Drainer
+
+T0 = datetime(2025, 10, 1, tzinfo=timezone.utc)
+
+
+def reading(i: int) -> dict:
+    return {"timestamp": T0 + timedelta(seconds=10 * i), "power": float(i)}
+
+
+class Store:
+    """insert_readings_bulk stand-in: keyed by _id, like the unique index."""
+
+    def __init__(self):
+        self.docs, self.calls = {}, 0
+
+    def __call__(self, device_id, docs):
+        self.calls += 1
+        for d in docs:
+            self.docs.setdefault(d["_id"], d)
+        return True
+
+
+def drain_all(sp, store):
+    d = Drainer(sp, store=store, latest=None)
+    while d.drain_once():
+        pass
+
+
+def test_roundtrip_with_deterministic_ids(tmp_path):
+    sp = Spool(str(tmp_path))
+    for i in range(5):
+        sp.append("dev1", reading(i))
+    store = Store()
+    drain_all(sp, store)
+    assert sorted(store.docs) == sorted(spool.reading_id("dev1", reading(i)["timestamp"]) for i in range(5))
+    assert store.docs[spool.reading_id("dev1", T0)]["timestamp"] == T0
+    assert sp.depth == 0
+
+
+def test_torn_tail_is_skipped_after_crash(tmp_path):
+    sp = Spool(str(tmp_path))
+    for i in range(3):
+        sp.append("dev1", reading(i))
+    sp.sync()
+    seg = os.path.join(str(tmp_path), spool._seg_name(sp.segments()[-1]))
+    with open(seg, "ab") as f:
+        f.write(b'{"d": "dev1", "t": 1, "doc": {"pow')  # crash mid-write
+    sp.close()
+
+    sp = Spool(str(tmp_path))  # restart: writes go to a fresh segment
+    assert sp.depth == 3
+    sp.append("dev1", reading(3))
+    store = Store()
+    drain_all(sp, store)
+    assert len(store.docs) == 4
+    assert sp.segments() == [sp._seg]  # the drained old segment is gone
+
+
+def test_replay_after_crash_between_insert_and_checkpoint(tmp_path, monkeypatch):
+    sp = Spool(str(tmp_path))
+    for i in range(4):
+        sp.append("dev1", reading(i))
+    store = Store()
+
+    def crash(*a, **k):
+        raise OSError("killed before the checkpoint was written")
+    monkeypatch.setattr(sp, "commit", crash)
+    try:
+        Drainer(sp, store=store, latest=None).drain_once()
+    except OSError:
+        pass
+    assert len(store.docs) == 4 and sp.checkpoint()[1] == 0
+    monkeypatch.undo()
+
+    sp.close()
+    sp = Spool(str(tmp_path))
+    assert sp.depth == 4
+    drain_all(sp, store)  # replayed: same _ids, nothing doubled
+    assert len(store.docs) == 4 and store.calls == 2 and sp.depth == 0
+
+
+def test_segments_rotate_and_are_deleted_once_drained(tmp_path, monkeypatch):
+    monkeypatch.setattr(spool, "SEGMENT_BYTES", 300)
+    monkeypatch.setattr(spool, "DRAIN_BATCH", 3)
+    sp = Spool(str(tmp_path))
+    for i in range(20):
+        sp.append("dev1", reading(i))
+    assert len(sp.segments()) > 3
+    store = Store()
+    d = Drainer(sp, store=store, latest=None)
+    records, _ = sp.read_batch(limit=3)
+    assert len(records) == 3
+    while d.drain_once():
+        pass
+    assert len(store.docs) == 20
+    assert sp.segments() == [sp._seg]
+
+
+def test_stop_does_not_drain_alongside_a_busy_thread(tmp_path):
+    sp = Spool(str(tmp_path))
+    sp.append("dev1", reading(0))
+    entered, release = threading.Event(), threading.Event()
+    active, overlaps = [0], []
+
+    def slow_store(device_id, docs):
+        active[0] += 1
+        overlaps.append(active[0])
+        entered.set()
+        release.wait(5)
+        active[0] -= 1
+        return True
+
+    d = Drainer(sp, store=slow_store, latest=None)
+    d.start()
+    assert entered.wait(5)
+    sp.append("dev1", reading(1))
+    t0 = time.monotonic()
+    d.stop(timeout=0.2)      # thread still inside drain_once
+    assert time.monotonic() - t0 < 2
+    release.set()
+    d.join(5)
+    assert max(overlaps) == 1
@@ -1,11 +1,59 @@
-import os, time, json, hmac, hashlib, requests
+import os, time, json, hmac, hashlib, threading, requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from metrics import counter, histogram
+from profiler import record_io
 
 load_dotenv()
 ACCESS_ID = os.getenv("TUYA_ACCESS_ID", "")
 ACCESS_SECRET = os.getenv("TUYA_ACCESS_SECRET", "")
 API_ENDPOINT = os.getenv("TUYA_API_ENDPOINT", "https://openapi.tuyaeu.com")
 HTTP_TIMEOUT = 15
+RATE_LIMIT_QPS = float(os.getenv("TUYA_RATE_LIMIT_QPS", "20"))  # 0 = unlimited
+POOL_SIZE = int(os.getenv("TUYA_POOL_SIZE", "16"))
+
+# More Tuya projects / regions: TUYA_ACCOUNTS=us,cn plus, for each name,
+#   TUYA_US_ACCESS_ID, TUYA_US_ACCESS_SECRET, TUYA_US_API_ENDPOINT
+#   and optionally TUYA_US_RATE_LIMIT_QPS.
+# The TUYA_ACCESS_ID/... settings above are the "default" account. Devices
+# pick an account with an "account" field in devices.json.
+DEFAULT_ACCOUNT = "default"
+ACCOUNTS = [a.strip() for a in os.getenv("TUYA_ACCOUNTS", "").split(",") if a.strip()]
+
+TUYA_LATENCY = histogram("tuya_request_seconds", "Tuya OpenAPI call latency", ["account", "endpoint"])
+TUYA_ERRORS = counter("tuya_errors_total", "Failed Tuya OpenAPI calls", ["account", "endpoint", "type"])
+TUYA_THROTTLE = histogram("tuya_throttle_wait_seconds", "Time spent waiting for the rate limiter", ["account"],
+                          buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+class RateLimiter:
+    """Token bucket shared by all threads: at most `rate` calls per second
+    on average, bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: int = None, name: str = DEFAULT_ACCOUNT):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.name = name
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        t0 = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+        TUYA_THROTTLE.observe(time.monotonic() - t0, account=self.name)
+
 
 def _make_sign(client_id, secret, method, url, access_token: str = "", body: str = ""):
     t = str(int(time.time() * 1000))
@@ -20,41 +68,121 @@ def _make_sign(client_id, secret, method, url, access_token: str = "", body: str
     sign = hmac.new(secret.encode("utf-8"), sign_str.encode("utf-8"), hashlib.sha256).hexdigest().upper()
     return sign, t
 
-_token_cache = {"value": None, "ts": 0, "ttl": 55}  # seconds
 
+class TuyaClient:
+    """One Tuya cloud project: its own credentials, endpoint, token cache,
+    pooled keep-alive session and rate limiter. Safe to share between threads."""
+
+    def __init__(self, name: str, access_id: str, access_secret: str, endpoint: str,
+                 rate: float = RATE_LIMIT_QPS, pool_size: int = POOL_SIZE):
+        self.name = name
+        self.access_id = access_id
+        self.access_secret = access_secret
+        self.endpoint = endpoint
+        self.limiter = RateLimiter(rate, name=name)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._token_cache = {"value": None, "ts": 0, "ttl": 55}  # seconds
+        self._token_lock = threading.Lock()
+
+    def _timed_call(self, endpoint: str, send):
+        """Run one HTTP call within the rate limit, recording latency and error type."""
+        self.limiter.acquire()
+        t0 = time.perf_counter()
+        try:
+            res = send()
+            record_io("tuya", len(res.content))
+            data = res.json()
+        except Exception as e:
+            TUYA_ERRORS.inc(account=self.name, endpoint=endpoint, type=type(e).__name__)
+            raise
+        finally:
+            TUYA_LATENCY.observe(time.perf_counter() - t0, account=self.name, endpoint=endpoint)
+        if not data.get("success"):
+            TUYA_ERRORS.inc(account=self.name, endpoint=endpoint, type=f"api_{data.get('code', 'unknown')}")
+        return data
+
+    def _headers(self, method, path, token="", body=""):
+        sign, t = _make_sign(self.access_id, self.access_secret, method, path, token, body)
+        headers = {"client_id": self.access_id, "sign": sign, "t": t, "sign_method": "HMAC-SHA256"}
+        if token:
+            headers["access_token"] = token
+        return headers
+
+    def _fresh_token(self):
+        c = self._token_cache
+        return c["value"] if c["value"] and (time.time() - c["ts"] < c["ttl"]) else None
+
+    def get_token(self):
+        token = self._fresh_token()
+        if token:
+            return token
+        with self._token_lock:  # concurrent callers share one refresh
+            return self._fresh_token() or self._refresh_token()
+
+    def _refresh_token(self):
+        now = time.time()
+        path = "/v1.0/token?grant_type=1"
+        headers = self._headers("GET", path)
+        data = self._timed_call("token", lambda: self.session.get(self.endpoint + path, headers=headers,
+                                                                   timeout=HTTP_TIMEOUT))
+        if not data.get("success"):
+            raise RuntimeError(f"Failed to get token for account {self.name}: {data}")
+        self._token_cache["value"] = data["result"]["access_token"]
+        self._token_cache["ts"] = now
+        return self._token_cache["value"]
+
+    def get_device_status(self, device_id: str, token: str = None):
+        path = f"/v1.0/devices/{device_id}/status"
+        headers = self._headers("GET", path, token or self.get_token())
+        return self._timed_call("status", lambda: self.session.get(self.endpoint + path, headers=headers,
+                                                                    timeout=HTTP_TIMEOUT))
+
+    def control_device(self, device_id: str, token: str, command: str, value):
+        path = f"/v1.0/devices/{device_id}/commands"
+        body = json.dumps({"commands": [{"code": command, "value": value}]})
+        headers = self._headers("POST", path, token or self.get_token(), body)
+        headers["Content-Type"] = "application/json"
+        return self._timed_call("commands", lambda: self.session.post(self.endpoint + path, headers=headers,
+                                                                       data=body, timeout=HTTP_TIMEOUT))
+
+
+# ---------- Accounts ----------
+_clients = {}
+_clients_lock = threading.Lock()
+
+def accounts() -> list:
+    return [DEFAULT_ACCOUNT] + [a for a in ACCOUNTS if a != DEFAULT_ACCOUNT]
+
+def account_of(device: dict) -> str:
+    return (device or {}).get("account") or DEFAULT_ACCOUNT
+
+def get_client(account: str = None) -> TuyaClient:
+    """The shared client of `account` (default: the TUYA_* account)."""
+    name = account or DEFAULT_ACCOUNT
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            if name == DEFAULT_ACCOUNT:
+                client = TuyaClient(name, ACCESS_ID, ACCESS_SECRET, API_ENDPOINT)
+            elif name in ACCOUNTS:
+                env = f"TUYA_{name.upper()}_"
+                client = TuyaClient(name, os.getenv(env + "ACCESS_ID", ""), os.getenv(env + "ACCESS_SECRET", ""),
+                                    os.getenv(env + "API_ENDPOINT", API_ENDPOINT),
+                                    float(os.getenv(env + "RATE_LIMIT_QPS", RATE_LIMIT_QPS)))
+            else:
+                raise KeyError(f"Unknown Tuya account {name!r}; add it to TUYA_ACCOUNTS")
+            _clients[name] = client
+        return client
+
+
+# Default-account shortcuts (the original single-account API)
 def get_token():
-    now = time.time()
-    if _token_cache["value"] and (now - _token_cache["ts"] < _token_cache["ttl"]):
-        return _token_cache["value"]
-    path = "/v1.0/token?grant_type=1"
-    sign, t = _make_sign(ACCESS_ID, ACCESS_SECRET, "GET", path)
-    headers = {"client_id": ACCESS_ID, "sign": sign, "t": t, "sign_method": "HMAC-SHA256"}
-    res = requests.get(API_ENDPOINT + path, headers=headers, timeout=HTTP_TIMEOUT)
-    data = res.json()
-    if not data.get("success"):
-        raise RuntimeError(f"Failed to get token: {data}")
-    _token_cache["value"] = data["result"]["access_token"]
-    _token_cache["ts"] = now
-    return _token_cache["value"]
+    return get_client().get_token()
 
 def get_device_status(device_id: str, token: str):
-    path = f"/v1.0/devices/{device_id}/status"
-    sign, t = _make_sign(ACCESS_ID, ACCESS_SECRET, "GET", path, token)
-    headers = {
-        "client_id": ACCESS_ID, "sign": sign, "t": t,
-        "access_token": token, "sign_method": "HMAC-SHA256"
-    }
-    res = requests.get(API_ENDPOINT + path, headers=headers, timeout=HTTP_TIMEOUT)
-    return res.json()
+    return get_client().get_device_status(device_id, token)
 
 def control_device(device_id: str, token: str, command: str, value):
-    path = f"/v1.0/devices/{device_id}/commands"
-    body = json.dumps({"commands": [{"code": command, "value": value}]})
-    sign, t = _make_sign(ACCESS_ID, ACCESS_SECRET, "POST", path, token, body)
-    headers = {
-        "client_id": ACCESS_ID, "sign": sign, "t": t,
-        "access_token": token, "sign_method": "HMAC-SHA256",
-        "Content-Type": "application/json"
-    }
-    res = requests.post(API_ENDPOINT + path, headers=headers, data=body, timeout=HTTP_TIMEOUT)
-    return res.json()
+    return get_client().control_device(device_id, token, command, value)
@@ -1,10 +1,19 @@
 import os
-from typing import List, Tuple
-from datetime import datetime
-import pandas as pd
-from pymongo import MongoClient, ASCENDING, DESCENDING
-from pymongo.errors import PyMongoError
+import time
+from contextlib import contextmanager
+from typing import List, Tuple, TYPE_CHECKING
+from datetime import datetime, timedelta
+import bson
+from pymongo import MongoClient, ASCENDING, DESCENDING, monitoring
+from pymongo.errors import PyMongoError, BulkWriteError
 from dotenv import load_dotenv
+from metrics import counter, histogram
+import profiler
+
+# pandas is only needed by the DataFrame queries below, which the dashboard
+# uses; the collector never calls them, so keep it out of its import graph.
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 
@@ -12,11 +21,38 @@ load_dotenv()
 MONGODB_URI = os.getenv("MONGODB_URI", "")
 MONGODB_DB  = os.getenv("MONGODB_DB", "tuya_energy")
 
+MONGO_LATENCY = histogram("mongo_op_seconds", "MongoDB operation latency", ["op"])
+MONGO_ERRORS = counter("mongo_errors_total", "Failed MongoDB operations", ["op", "type"])
+
+@contextmanager
+def _read_op(op: str):
+    """Time a read and count it in MONGO_ERRORS if it fails; the error still
+    reaches the caller."""
+    try:
+        with MONGO_LATENCY.time(op=op):
+            yield
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op=op, type=type(e).__name__)
+        raise
+
+class _ProfilerListener(monitoring.CommandListener):
+    """Feeds query counts/reply sizes to the dashboard profiler when active."""
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if profiler.current() is not None:
+            profiler.record_io("mongo", len(bson.encode(event.reply)))
+
+    def failed(self, event):
+        if profiler.current() is not None:
+            profiler.record_io("mongo", 0)
+
 _client = None
 def get_client():
     global _client
     if _client is None and MONGODB_URI:
-        _client = MongoClient(MONGODB_URI, tls=True)
+        _client = MongoClient(MONGODB_URI, tls=True, event_listeners=[_ProfilerListener()])
     return _client
 
 def _get_db(client):
@@ -42,14 +78,211 @@ def get_collection(device_id: str):
         pass
     return coll
 
+def get_named_collection(name: str):
+    """Non-reading collections (leases, state, ...) in the same database."""
+    client = get_client()
+    if client is None:
+        return None
+    return _get_db(client)[name]
+
 def insert_reading(device_id: str, doc: dict) -> bool:
     coll = get_collection(device_id)
     if coll is None:
         return False
+    t0 = time.perf_counter()
     try:
         coll.insert_one(doc)
         return True
-    except PyMongoError:
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op="insert", type=type(e).__name__)
+        return False
+    finally:
+        MONGO_LATENCY.observe(time.perf_counter() - t0, op="insert")
+
+def insert_readings_bulk(device_id: str, docs: list) -> bool:
+    """Insert many readings at once. Docs carrying an _id that is already
+    stored are skipped, so replaying the same batch is safe."""
+    coll = get_collection(device_id)
+    if coll is None:
+        return False
+    t0 = time.perf_counter()
+    try:
+        coll.insert_many(docs, ordered=False)
+        return True
+    except BulkWriteError as e:
+        # 11000 = duplicate key: that reading was stored by an earlier attempt
+        others = [w for w in e.details.get("writeErrors", []) if w.get("code") != 11000]
+        if others or e.details.get("writeConcernErrors"):
+            MONGO_ERRORS.inc(op="insert_many", type="BulkWriteError")
+            return False
+        return True
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op="insert_many", type=type(e).__name__)
+        return False
+    finally:
+        MONGO_LATENCY.observe(time.perf_counter() - t0, op="insert_many")
+
+def insert_events(collection: str, events: list) -> bool:
+    """Append event documents (anomalies, ...) to a named collection.
+    insert_many sets _id on the dicts, so retrying a partly stored batch
+    only meets duplicate keys for the events already stored: that counts
+    as success."""
+    coll = get_named_collection(collection)
+    if coll is None or not events:
+        return coll is not None
+    try:
+        coll.insert_many(events, ordered=False)
+        return True
+    except BulkWriteError as e:
+        others = [w for w in e.details.get("writeErrors", []) if w.get("code") != 11000]
+        if others or e.details.get("writeConcernErrors"):
+            MONGO_ERRORS.inc(op="insert_events", type="BulkWriteError")
+            return False
+        return True
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op="insert_events", type=type(e).__name__)
+        return False
+
+# ---------- Incrementally maintained documents (rollups) ----------
+INC_TOKENS_KEPT = 32
+
+def inc_docs(collection: str, incs: dict, token: str = None) -> bool:
+    """Apply {doc_id: {field path: delta}} as $inc upserts in one bulk write.
+
+    With a `token` the write is idempotent: each document remembers the
+    last INC_TOKENS_KEPT tokens applied to it and skips a token it has
+    seen, so a batch can be retried after a partial failure or a lost
+    reply without counting twice."""
+    from pymongo import UpdateOne
+    coll = get_named_collection(collection)
+    if coll is None:
+        return False
+    if not incs:
+        return True
+    now = datetime.utcnow()
+    ops = []
+    for _id, inc in incs.items():
+        if not inc:
+            continue
+        if token is None:
+            ops.append(UpdateOne({"_id": _id}, {"$inc": inc, "$set": {"updated": now}}, upsert=True))
+        else:
+            # already applied: the filter misses and the upsert hits a duplicate _id
+            ops.append(UpdateOne({"_id": _id, "inc_tokens": {"$ne": token}},
+                                 {"$inc": inc, "$set": {"updated": now},
+                                  "$push": {"inc_tokens": {"$each": [token], "$slice": -INC_TOKENS_KEPT}}},
+                                 upsert=True))
+    try:
+        with MONGO_LATENCY.time(op="inc_docs"):
+            coll.bulk_write(ops, ordered=False)
+        return True
+    except BulkWriteError as e:
+        others = [w for w in e.details.get("writeErrors", []) if w.get("code") != 11000]
+        if token is not None and not others and not e.details.get("writeConcernErrors"):
+            return True
+        MONGO_ERRORS.inc(op="inc_docs", type="BulkWriteError")
+        return False
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op="inc_docs", type=type(e).__name__)
+        return False
+
+def insert_docs_once(collection: str, docs: list) -> bool:
+    """Insert docs with fixed _ids; ones already stored are left as they are."""
+    coll = get_named_collection(collection)
+    if coll is None or not docs:
+        return coll is not None
+    try:
+        coll.insert_many(docs, ordered=False)
+        return True
+    except BulkWriteError as e:
+        return not [w for w in e.details.get("writeErrors", []) if w.get("code") != 11000]
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op="insert_once", type=type(e).__name__)
+        return False
+
+def find_docs(collection: str, ids: list, projection: dict = None) -> dict:
+    """{_id: doc} for the given ids in one query."""
+    coll = get_named_collection(collection)
+    if coll is None or not ids:
+        return {}
+    with _read_op("find_docs"):
+        return {d["_id"]: d for d in coll.find({"_id": {"$in": list(ids)}}, projection)}
+
+
+# ---------- Latest reading per device (device list status) ----------
+LATEST_FIELDS = ("device_id", "device_name", "timestamp", "voltage", "current", "power")
+
+def upsert_latest_states(docs: list) -> bool:
+    """Keep one `latest_state` document per device, in one bulk write. A
+    doc older than the stored one is ignored."""
+    from pymongo import UpdateOne
+    coll = get_named_collection("latest_state")
+    if coll is None:
+        return False
+    newest = {}
+    for d in docs:
+        cur = newest.get(d["device_id"])
+        if cur is None or d["timestamp"] > cur["timestamp"]:
+            newest[d["device_id"]] = d
+    if not newest:
+        return True
+    ops = [UpdateOne({"_id": did, "timestamp": {"$lt": d["timestamp"]}},
+                     {"$set": {k: d.get(k) for k in LATEST_FIELDS}}, upsert=True)
+           for did, d in newest.items()]
+    try:
+        coll.bulk_write(ops, ordered=False)
+        return True
+    except BulkWriteError as e:
+        # 11000: the stored state is newer, so the upsert collided with it
+        return not [w for w in e.details.get("writeErrors", []) if w.get("code") != 11000]
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op="upsert_latest", type=type(e).__name__)
+        return False
+
+def latest_states(device_ids: list) -> dict:
+    """{device_id: latest reading} for many devices in one query."""
+    coll = get_named_collection("latest_state")
+    if coll is None or not device_ids:
+        return {}
+    try:
+        with MONGO_LATENCY.time(op="latest_states"):
+            return {d["_id"]: d for d in coll.find({"_id": {"$in": list(device_ids)}})}
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op="latest_states", type=type(e).__name__)
+        return {}
+
+# ---------- Per-device state snapshots (survive collector restarts) ----------
+def load_device_states(kind: str, device_ids: list) -> dict:
+    """{device_id: state} for the devices that have a saved `kind` snapshot,
+    or None when the store could not be read (not the same as "no
+    snapshot": callers must not start those devices from scratch)."""
+    coll = get_named_collection("device_state")
+    if coll is None or not device_ids:
+        return {}
+    try:
+        cur = coll.find({"_id": {"$in": [f"{kind}:{d}" for d in device_ids]}})
+        return {doc["device_id"]: doc["state"] for doc in cur}
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op="load_state", type=type(e).__name__)
+        return None
+
+def save_device_states(kind: str, states: dict) -> bool:
+    """Upsert {device_id: state} snapshots in one bulk write."""
+    from pymongo import ReplaceOne
+    coll = get_named_collection("device_state")
+    if coll is None:
+        return False
+    if not states:
+        return True
+    now = datetime.utcnow()
+    ops = [ReplaceOne({"_id": f"{kind}:{d}"},
+                      {"kind": kind, "device_id": d, "state": state, "updated": now}, upsert=True)
+           for d, state in states.items()]
+    try:
+        coll.bulk_write(ops, ordered=False)
+        return True
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op="save_state", type=type(e).__name__)
         return False
 
 # # ---------- NEW: Queries ----------
@@ -68,12 +301,14 @@ def insert_reading(device_id: str, doc: dict) -> bool:
 
 
 # ---------- UPDATED: Queries ----------
-def latest_docs(device_id: str, n: int = 100) -> pd.DataFrame:
+def latest_docs(device_id: str, n: int = 100) -> "pd.DataFrame":
+    import pandas as pd
     coll = get_collection(device_id)
     if coll is None:
         return pd.DataFrame()
-    cur = coll.find({}, {"_id": 0}).sort("timestamp", DESCENDING).limit(n)
-    df = pd.DataFrame(list(cur))
+    with _read_op("latest"):
+        cur = coll.find({}, {"_id": 0}).sort("timestamp", DESCENDING).limit(n)
+        df = pd.DataFrame(list(cur))
     if df.empty:
         return df
 
@@ -85,13 +320,89 @@ def latest_docs(device_id: str, n: int = 100) -> pd.DataFrame:
     return df
 
 
-def range_docs(device_id: str, start_dt: datetime, end_dt: datetime) -> pd.DataFrame:
+def readings_since(device_id: str, after: datetime, limit: int = 5000) -> list:
+    """Raw readings with timestamp > `after` (naive UTC), oldest first.
+    Cheap watermark query for live views: it only touches new documents."""
+    coll = get_collection(device_id)
+    if coll is None:
+        return []
+    with _read_op("since"):
+        cur = coll.find({"timestamp": {"$gt": after}}, {"_id": 0}) \
+                  .sort("timestamp", ASCENDING).limit(limit)
+        return list(cur)
+
+
+DHAKA_OFFSET_MS = 6 * 3600 * 1000
+
+
+def iter_reading_chunks(device_id: str, start_dt: datetime, end_dt: datetime,
+                        chunk_size: int = 5000, resolution_s: int = None):
+    """Yield readings in [start_dt, end_dt] as lists of at most `chunk_size`
+    dicts, oldest first, without materialising the range. With
+    `resolution_s` the server averages readings into buckets of that many
+    seconds (energy is summed, `samples` counts the readings per bucket)."""
+    coll = get_collection(device_id)
+    if coll is None:
+        return
+    match = {"timestamp": {"$gte": start_dt, "$lte": end_dt}}
+    chunk = []
+    try:
+        if resolution_s:
+            ms = int(resolution_s * 1000)
+            epoch = datetime(1970, 1, 1)
+            ts_ms = {"$subtract": ["$timestamp", epoch]}  # date - date = milliseconds
+            cur = coll.aggregate([
+                {"$match": match},
+                {"$group": {
+                    # buckets line up with Dhaka (UTC+6) hours and days
+                    "_id": {"$subtract": [ts_ms, {"$mod": [{"$add": [ts_ms, DHAKA_OFFSET_MS]}, ms]}]},
+                    "voltage": {"$avg": "$voltage"},
+                    "current": {"$avg": "$current"},
+                    "power": {"$avg": "$power"},
+                    "energy_kWh": {"$sum": "$energy_kWh"},
+                    "samples": {"$sum": 1},
+                    "device_name": {"$last": "$device_name"},
+                }},
+                {"$sort": {"_id": 1}},
+            ], allowDiskUse=True, batchSize=chunk_size)
+            cur = (dict(d, device_id=device_id, timestamp=epoch + timedelta(milliseconds=d.pop("_id")))
+                   for d in cur)
+        else:
+            cur = coll.find(match, {"_id": 0}).sort("timestamp", ASCENDING).batch_size(chunk_size)
+        for doc in cur:
+            chunk.append(doc)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    except PyMongoError as e:
+        MONGO_ERRORS.inc(op="chunks", type=type(e).__name__)
+        raise
+    if chunk:
+        yield chunk
+
+
+def energy_sum(device_id: str, start_dt: datetime, end_dt: datetime) -> float:
+    """Total energy_kWh in [start_dt, end_dt], summed by the server."""
+    coll = get_collection(device_id)
+    if coll is None:
+        return 0.0
+    with _read_op("energy_sum"):
+        res = list(coll.aggregate([
+            {"$match": {"timestamp": {"$gte": start_dt, "$lte": end_dt}}},
+            {"$group": {"_id": None, "kwh": {"$sum": "$energy_kWh"}}},
+        ]))
+    return float(res[0]["kwh"] or 0.0) if res else 0.0
+
+
+def range_docs(device_id: str, start_dt: datetime, end_dt: datetime) -> "pd.DataFrame":
+    import pandas as pd
     coll = get_collection(device_id)
     if coll is None:
         return pd.DataFrame()
     q = {"timestamp": {"$gte": start_dt, "$lte": end_dt}}
-    cur = coll.find(q, {"_id": 0}).sort("timestamp", ASCENDING)
-    df = pd.DataFrame(list(cur))
+    with _read_op("range"):
+        cur = coll.find(q, {"_id": 0}).sort("timestamp", ASCENDING)
+        df = pd.DataFrame(list(cur))
     if df.empty:
         return df
     df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)